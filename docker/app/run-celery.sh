@@ -11,5 +11,6 @@ exec celery \
   --without-heartbeat \
   --without-mingle \
   --concurrency="${QUEUE_WORKERS}" \
+  --pool="${QUEUE_POOL:-prefork}" \
   --loglevel="${LOKOLE_LOG_LEVEL}" \
   --queues="${CELERY_QUEUE_NAMES}"
@@ -2,6 +2,7 @@ from abc import ABCMeta
 from abc import abstractmethod
 from os import getenv
 from os import path
+from typing import Optional
 from urllib.parse import urlencode
 
 from requests import get as http_get
@@ -15,14 +16,23 @@ class EmailServerClient(metaclass=ABCMeta):
         raise NotImplementedError  # pragma: no cover
 
     @abstractmethod
-    def download(self) -> str:
+    def download(self, acknowledged_resource_id: Optional[str] = None) -> str:
         raise NotImplementedError  # pragma: no cover
 
 
 class HttpEmailServerClient(EmailServerClient):
 
-    def __init__(self, compression: str, endpoint: str, client_id: str):
+    def __init__(self,
+                 compression: str,
+                 endpoint: str,
+                 client_id: str,
+                 format: str = 'jsonl',
+                 attachments: str = 'embedded',
+                 dictionary: bool = False):
         self._compression = compression
+        self._format = format
+        self._attachments = attachments
+        self._dictionary = dictionary
         self._endpoint = endpoint
         self._client_id = client_id
 
@@ -37,26 +47,36 @@ class HttpEmailServerClient(EmailServerClient):
             client_id=self._client_id,
         )
 
-    @property
-    def _download_url(self) -> str:
+    def _download_url(self, acknowledged_resource_id: Optional[str]) -> str:
+        query = {
+            'compression': self._compression,
+            'format': self._format,
+            'attachments': self._attachments,
+            'delivery': 'acknowledged',
+        }
+        if acknowledged_resource_id:
+            query['acknowledged_resource_id'] = acknowledged_resource_id
+        if self._dictionary:
+            query['dictionary'] = 'true'
+
         return '{base_url}/download/{client_id}?{query}'.format(
             base_url=self._base_url,
             client_id=self._client_id,
-            query=urlencode({
-                'compression': self._compression,
-            }),
+            query=urlencode(query),
         )
 
     def upload(self, resource_id, container):
         payload = {
             'resource_id': resource_id,
+            'format': self._format,
+            'attachments': self._attachments,
         }
 
         response = http_post(self._upload_url, json=payload)
         response.raise_for_status()
 
-    def download(self):
-        response = http_get(self._download_url)
+    def download(self, acknowledged_resource_id=None):
+        response = http_get(self._download_url(acknowledged_resource_id))
         response.raise_for_status()
         resource_id = response.json()['resource_id']
 
@@ -65,7 +85,7 @@ class HttpEmailServerClient(EmailServerClient):
 
 class LocalEmailServerClient(EmailServerClient):
 
-    def download(self) -> str:
+    def download(self, acknowledged_resource_id: Optional[str] = None) -> str:
         root = getenv('OPWEN_REMOTE_ACCOUNT_NAME')
         container = getenv('OPWEN_REMOTE_RESOURCE_CONTAINER')
         resource_id = 'sync.tar.gz'
@@ -227,9 +227,8 @@ class _SqlalchemyEmailStore(EmailStore):
 
     @classmethod
     def _create_attachment(cls, db, attachment):
-        uid_exists = exists().where(_Attachment.uid == attachment['_uid'])
-        if not db.query(uid_exists).scalar():
-            db.add(_Attachment.from_dict(db, attachment))
+        # attachments that were already synced are re-used and linked to the new emails
+        db.add(_Attachment.from_dict(db, attachment))
 
     def _mark_sent(self, uids):
         now = datetime.utcnow()
@@ -285,7 +284,7 @@ class _SqlalchemyEmailStore(EmailStore):
 
         return emails
 
-    def inbox(self, email_address, page):
+    def inbox(self, email_address, page, cursor=None):
         return self._query(_Email.is_received_by(email_address), page)
 
     def outbox(self, email_address, page):
@@ -325,7 +324,7 @@ class _SqlalchemyEmailStore(EmailStore):
     def get_attachment(self, email_id, attachment_id):
         return self._find(_Attachment.uid == attachment_id, table=_Attachment)
 
-    def sent(self, email_address, page):
+    def sent(self, email_address, page, cursor=None):
         return self._query(_Email.is_sent_by(email_address) & _Email.sent_at.isnot(None), page)
 
 
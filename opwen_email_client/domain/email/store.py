@@ -8,6 +8,14 @@ from typing import Union
 from uuid import uuid4
 
 
+class EmailPage(list):
+
+    def __init__(self, emails: Iterable[dict] = (), next_cursor: Optional[str] = None):
+        super().__init__(emails)
+        # opaque position after the last email of the page that the store can resume listing from
+        self.next_cursor = next_cursor
+
+
 class EmailStore(metaclass=ABCMeta):
 
     def __init__(self, restricted: Optional[Dict[str, Set[str]]] = None):
@@ -30,7 +38,7 @@ class EmailStore(metaclass=ABCMeta):
         raise NotImplementedError  # pragma: no cover
 
     @abstractmethod
-    def inbox(self, email_address: str, page: int) -> Iterable[dict]:
+    def inbox(self, email_address: str, page: int, cursor: Optional[str] = None) -> Iterable[dict]:
         raise NotImplementedError  # pragma: no cover
 
     @abstractmethod
@@ -38,7 +46,7 @@ class EmailStore(metaclass=ABCMeta):
         raise NotImplementedError  # pragma: no cover
 
     @abstractmethod
-    def sent(self, email_address: str, page: int) -> Iterable[dict]:
+    def sent(self, email_address: str, page: int, cursor: Optional[str] = None) -> Iterable[dict]:
         raise NotImplementedError  # pragma: no cover
 
     @abstractmethod
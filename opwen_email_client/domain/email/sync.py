@@ -2,25 +2,39 @@ from abc import ABCMeta
 from abc import abstractmethod
 from collections import namedtuple
 from contextlib import contextmanager
+from hashlib import sha256
+from json import dumps
+from os import makedirs
 from os import remove
+from os import scandir
+from os.path import getsize
+from os.path import isdir
+from os.path import isfile
+from os.path import join
 from tarfile import TarFile
 from tempfile import NamedTemporaryFile
 from typing import IO
+from typing import Dict
 from typing import Iterable
+from typing import Optional
 from typing import Tuple
 from typing import TypeVar
 from uuid import uuid4
 
 from cached_property import cached_property
+from libcloud.common.types import LibcloudError
 from libcloud.storage.base import Container
 from libcloud.storage.providers import Provider
-from libcloud.storage.providers import get_driver
 from libcloud.storage.types import ObjectDoesNotExistError
 from xtarfile import open as tarfile_open
+from zstandard import ZstdCompressionDict
+from zstandard import ZstdError
+from zstandard import get_frame_parameters
 
 from opwen_email_client.domain.email.client import EmailServerClient
 from opwen_email_client.domain.email.user_store import User
 from opwen_email_client.util.serialization import Serializer
+from opwen_email_server.utils.drivers import DriverRegistry
 
 T = TypeVar('T')
 
@@ -37,19 +51,29 @@ class Sync(metaclass=ABCMeta):
     def download(self) -> Iterable[T]:
         raise NotImplementedError  # pragma: no cover
 
+    def download_parts(self) -> Iterable[Iterable[T]]:
+        yield self.download()
 
-class AzureSync(Sync):
-    _emails_file = 'emails.jsonl'
-    _attachments_file = 'zattachments.jsonl'
-    _users_file = 'zzusers.jsonl'
-
-    _download_files = (
-        Download(name=_emails_file, optional=False, type_='email'),
-        Download(name=_attachments_file, optional=True, type_='attachment'),
-    )
 
-    def __init__(self, container: str, serializer: Serializer, account_name: str, account_key: str, account_host: str,
-                 account_secure: bool, email_server_client: EmailServerClient, provider: str, compression: str):
+class AzureSync(Sync):
+    _acknowledged_file = '.acknowledged'
+    _dictionary_prefix = 'dictionaries/'
+
+    def __init__(self,
+                 container: str,
+                 serializer: Serializer,
+                 account_name: str,
+                 account_key: str,
+                 account_host: str,
+                 account_secure: bool,
+                 email_server_client: EmailServerClient,
+                 provider: str,
+                 compression: str,
+                 drivers: Optional[DriverRegistry] = None,
+                 download_dir: Optional[str] = None,
+                 download_retries: int = 3,
+                 deduplicate_attachments: bool = False,
+                 dictionary_dir: Optional[str] = None):
 
         self._container = container
         self._serializer = serializer
@@ -60,12 +84,37 @@ class AzureSync(Sync):
         self._email_server_client = email_server_client
         self._provider = getattr(Provider, provider)
         self._compression = compression
+        self._drivers = drivers or DriverRegistry()
+        self._download_dir = download_dir
+        self._download_retries = download_retries
+        self._deduplicate_attachments = deduplicate_attachments
+        self._dictionary_dir = dictionary_dir
+        self._dictionaries: Dict[int, ZstdCompressionDict] = {}
+        self._acknowledged_resource_id: Optional[str] = None
+
+    @property
+    def _emails_file(self) -> str:
+        return 'emails.{}'.format(self._serializer.extension)
+
+    @property
+    def _attachments_file(self) -> str:
+        return 'zattachments.{}'.format(self._serializer.extension)
+
+    @property
+    def _users_file(self) -> str:
+        return 'zzusers.{}'.format(self._serializer.extension)
+
+    @property
+    def _download_files(self) -> Tuple[Download, ...]:
+        return (
+            Download(name=self._emails_file, optional=False, type_='email'),
+            Download(name=self._attachments_file, optional=True, type_='attachment'),
+        )
 
     @cached_property
     def _azure_client(self) -> Container:
-        driver = get_driver(self._provider)
-        client = driver(self._account, self._key, host=self._host, secure=self._secure)
-        return client.get_container(self._container)
+        driver = self._drivers.get(self._provider, self._account, self._key, self._host, self._secure)
+        return driver.get_container(self._container)
 
     @classmethod
     @contextmanager
@@ -88,20 +137,78 @@ class AzureSync(Sync):
         else:
             compression = self._compression
 
+        kwargs = {}
+        if mode == 'r' and compression in ('zstd', 'zst'):
+            dictionary = self._dictionary_for(path)
+            if dictionary is not None:
+                kwargs['dict_data'] = dictionary
+
         mode = '{}|{}'.format(mode, compression)
 
-        return tarfile_open(path, mode=mode)
+        return tarfile_open(path, mode=mode, **kwargs)
 
-    def _download_to_stream(self, blobname: str, stream: IO) -> bool:
+    def _dictionary_for(self, path: str) -> Optional[ZstdCompressionDict]:
+        # the server compresses small packages against a shared dictionary whose id is
+        # recorded in the zstd frame header; plain zstd packages have an id of zero
+        with open(path, 'rb') as fobj:
+            header = fobj.read(18)
 
+        try:
+            dictionary_id = get_frame_parameters(header).dict_id
+        except ZstdError:
+            return None
+
+        if not dictionary_id:
+            return None
+
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            dictionary = ZstdCompressionDict(self._fetch_dictionary(dictionary_id))
+            self._dictionaries[dictionary_id] = dictionary
+        return dictionary
+
+    def _fetch_dictionary(self, dictionary_id: int) -> bytes:
+        # dictionaries never change once published, so each version is downloaded only once
+        if self._dictionary_dir is not None:
+            path = join(self._dictionary_dir, str(dictionary_id))
+            if isfile(path):
+                with open(path, 'rb') as fobj:
+                    return fobj.read()
+
+        resource = self._azure_client.get_object('{}{}'.format(self._dictionary_prefix, dictionary_id))
+        content = b''.join(resource.as_stream())
+
+        if self._dictionary_dir is not None:
+            makedirs(self._dictionary_dir, exist_ok=True)
+            with open(join(self._dictionary_dir, str(dictionary_id)), 'wb') as fobj:
+                fobj.write(content)
+
+        return content
+
+    def _download_to_file(self, blobname: str, path: str) -> bool:
         try:
             resource = self._azure_client.get_object(blobname)
         except ObjectDoesNotExistError:
             return False
-        else:
-            for chunk in resource.as_stream():
-                stream.write(chunk)
-            return True
+
+        for attempt in range(self._download_retries):
+            offset = getsize(path) if isfile(path) else 0
+            if offset > resource.size:
+                remove(path)
+                offset = 0
+            if offset == resource.size:
+                break
+
+            # bytes that made it to disk before a dropped connection are not downloaded again
+            try:
+                with open(path, 'ab') as fobj:
+                    for chunk in resource.driver.download_object_range_as_stream(resource, start_bytes=offset):
+                        fobj.write(chunk)
+            except (OSError, LibcloudError):
+                if attempt == self._download_retries - 1:
+                    raise
+
+        return True
 
     def _upload_from_stream(self, blobname: str, stream: IO):
         self._azure_client.upload_object_via_stream(stream, blobname)
@@ -132,24 +239,99 @@ class AzureSync(Sync):
             raise FileNotFoundError(','.join(missing_downloads))
 
     def download(self):
-        resource_id = self._email_server_client.download()
-        if not resource_id:
+        for part in self.download_parts():
+            yield from part
+
+    def download_parts(self):
+        # a part is only acknowledged when the next one is requested, so callers must have
+        # stored all the emails of a part before moving on to the next one
+        for resource_id in self._iter_download_ids():
+            yield self._download_part(resource_id)
+
+    def _iter_download_ids(self) -> Iterable[str]:
+        acknowledged_resource_id = self._load_acknowledged()
+
+        # parts that were interrupted during a previous sync are resumed first
+        if self._download_dir is not None and isdir(self._download_dir):
+            paths = sorted(scandir(self._download_dir), key=lambda entry: entry.stat().st_mtime)
+            for entry in paths:
+                if entry.name == self._acknowledged_file:
+                    continue
+                yield entry.name
+                acknowledged_resource_id = entry.name
+                self._save_acknowledged(acknowledged_resource_id)
+
+        # the server hands out one part per call until there are no pending emails left and only
+        # marks a part as delivered once it is acknowledged by the call for the next part
+        previous_resource_id = None
+        while True:
+            resource_id = self._email_server_client.download(acknowledged_resource_id)
+            self._save_acknowledged(None)
+            if not resource_id or resource_id == previous_resource_id:
+                break
+            yield resource_id
+            acknowledged_resource_id = previous_resource_id = resource_id
+            self._save_acknowledged(acknowledged_resource_id)
+
+    def _load_acknowledged(self) -> Optional[str]:
+        if self._download_dir is None:
+            return self._acknowledged_resource_id
+
+        try:
+            with open(join(self._download_dir, self._acknowledged_file), 'r') as fobj:
+                return fobj.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _save_acknowledged(self, resource_id: Optional[str]):
+        # parts that were imported but not yet acknowledged are acknowledged on the next sync
+        self._acknowledged_resource_id = resource_id
+        if self._download_dir is None:
             return
 
-        with self._workspace(resource_id) as workspace:
-            if not self._download_to_stream(resource_id, workspace):
+        path = join(self._download_dir, self._acknowledged_file)
+        if resource_id is None:
+            if isfile(path):
+                remove(path)
+        else:
+            makedirs(self._download_dir, exist_ok=True)
+            with open(path, 'w') as fobj:
+                fobj.write(resource_id)
+
+    def _download_part(self, resource_id: str) -> Iterable[dict]:
+        if self._download_dir is not None:
+            makedirs(self._download_dir, exist_ok=True)
+            path = join(self._download_dir, resource_id)
+        else:
+            with NamedTemporaryFile(suffix=resource_id, delete=False) as temp:
+                path = temp.name
+
+        completed = False
+        try:
+            if not self._download_to_file(resource_id, path):
+                completed = True
                 return
 
-            workspace.seek(0)
-            with self._open(workspace.name, 'r') as archive:
+            with self._open(path, 'r') as archive:
                 for download, fobj in self._get_file_from_download(archive, self._download_files):
-                    for line in fobj:
-                        obj = self._serializer.deserialize(line, download.type_)
+                    for obj in self._serializer.load(fobj, download.type_):
                         obj['_type'] = download.type_
                         yield obj
 
+            completed = True
+        finally:
+            if (completed or self._download_dir is None) and isfile(path):
+                remove(path)
+
+    @classmethod
+    def _attachment_id(cls, attachment: dict) -> str:
+        digest = sha256(attachment.get('content') or b'')
+        digest.update(dumps([attachment.get('filename'), attachment.get('cid')], separators=(',', ':')).encode('utf-8'))
+        return digest.hexdigest()
+
     def _upload_emails(self, items, archive):
         uploaded_ids = []
+        attachments: Dict[str, dict] = {}
 
         with self._workspace(self._emails_file) as uploaded:
             for item in items:
@@ -157,16 +339,33 @@ class AzureSync(Sync):
                 item.pop('read', False)
                 for attachment in item.get('attachments', []):
                     attachment.pop('_uid', '')
-                serialized = self._serializer.serialize(item)
-                uploaded.write(serialized)
-                uploaded.write(b'\n')
+
+                # each distinct attachment is uploaded once and points back to the emails that contain it
+                if self._deduplicate_attachments:
+                    for attachment in item.pop('attachments', None) or []:
+                        attachment_id = self._attachment_id(attachment)
+                        attachments.setdefault(attachment_id, dict(attachment, _uid=attachment_id, emails=[]))
+                        attachments[attachment_id]['emails'].append(item.get('_uid'))
+
+                self._serializer.dump(item, uploaded)
                 uploaded_ids.append(item.get('_uid'))
 
             uploaded.seek(0)
             archive.add(uploaded.name, self._emails_file)
 
+        if attachments:
+            self._upload_attachments(attachments.values(), archive)
+
         return uploaded_ids
 
+    def _upload_attachments(self, attachments, archive):
+        with self._workspace(self._attachments_file) as uploaded:
+            for attachment in attachments:
+                self._serializer.dump(attachment, uploaded, 'attachment')
+
+            uploaded.seek(0)
+            archive.add(uploaded.name, self._attachments_file)
+
     def _upload_users(self, users, archive):
         if not users:
             return
@@ -174,9 +373,7 @@ class AzureSync(Sync):
         with self._workspace(self._users_file) as uploaded:
             for user in users:
                 item = {'email': user.email, 'password': user.password}
-                serialized = self._serializer.serialize(item)
-                uploaded.write(serialized)
-                uploaded.write(b'\n')
+                self._serializer.dump(item, uploaded)
 
             uploaded.seek(0)
             archive.add(uploaded.name, self._users_file)
@@ -1,16 +1,26 @@
 from abc import ABCMeta
 from abc import abstractmethod
-from base64 import b64decode
-from base64 import b64encode
-from copy import deepcopy
+from binascii import a2b_base64
+from binascii import b2a_base64
+from io import BytesIO
 from json import dumps
 from json import loads
+from typing import IO
+from typing import Any
+from typing import Callable
+from typing import Iterable
 from typing import TypeVar
 
+from msgpack import Unpacker
+from msgpack import packb
+from msgpack import unpackb
+
 T = TypeVar('T')
 
 
 class Serializer(metaclass=ABCMeta):
+    extension = ''
+    _delimiter = b''
 
     @abstractmethod
     def serialize(self, obj: T, type_: str = '') -> bytes:
@@ -20,63 +30,106 @@ class Serializer(metaclass=ABCMeta):
     def deserialize(self, serialized: bytes, type_: str = '') -> T:
         raise NotImplementedError  # pragma: no cover
 
+    def dump(self, obj: T, fobj: IO[bytes], type_: str = '') -> None:
+        fobj.write(self.serialize(obj, type_))
+        fobj.write(self._delimiter)
+
+    def load(self, fobj: IO[bytes], type_: str = '') -> Iterable[T]:
+        for serialized in fobj:
+            yield self.deserialize(serialized, type_)
+
 
 class JsonSerializer(Serializer):
+    extension = 'jsonl'
+    _delimiter = b'\n'
     _encoding = 'utf-8'
     _separators = (',', ':')
+    _base64_chunk_size = 3 * 64 * 1024
 
     def serialize(self, obj: dict, type_: str = '') -> bytes:
-        if not type_ or type_ == 'email':
-            obj = self._encode_attachments(obj)
-        elif type_ == 'attachment':
-            self._encode_attachment(obj)
-
-        serialized = dumps(obj, separators=self._separators, sort_keys=True)
-        return serialized.encode(self._encoding)
+        fobj = BytesIO()
+        self._write(obj, fobj, type_)
+        return fobj.getvalue()
 
     def deserialize(self, serialized: bytes, type_: str = '') -> dict:
-        decoded = serialized.decode(self._encoding)
-        obj = loads(decoded)
+        # json accepts the utf-8 bytes directly and the parsed object is new,
+        # so attachments are decoded in place instead of on a copy
+        obj = loads(serialized)
 
         if not type_ or type_ == 'email':
-            email = obj
-            email = self._decode_attachments(email)
-            return email
+            for attachment in obj.get('attachments') or []:
+                self._decode_attachment(attachment)
         elif type_ == 'attachment':
-            attachment = obj
-            self._decode_attachment(attachment)
-            return attachment
+            self._decode_attachment(obj)
 
-    @classmethod
-    def _encode_attachments(cls, email: dict) -> dict:
-        attachments = email.get('attachments', [])
-        if not attachments:
-            return email
+        return obj
 
-        email = deepcopy(email)
-        for attachment in email['attachments']:
-            cls._encode_attachment(attachment)
-        return email
+    def dump(self, obj: dict, fobj: IO[bytes], type_: str = '') -> None:
+        self._write(obj, fobj, type_)
+        fobj.write(self._delimiter)
 
-    @classmethod
-    def _encode_attachment(cls, attachment: dict) -> None:
-        content = attachment.get('content', b'')
-        if content:
-            attachment['content'] = b64encode(content).decode('ascii')
+    def _write(self, obj: dict, fobj: IO[bytes], type_: str) -> None:
+        # attachment content is base64 encoded straight into the output in chunks,
+        # so neither the email nor its attachments are ever copied
+        if not type_ or type_ == 'email':
+            self._write_object(obj, fobj, self._write_email_value)
+        elif type_ == 'attachment':
+            self._write_object(obj, fobj, self._write_attachment_value)
+        else:
+            fobj.write(self._dumps(obj))
+
+    def _write_email_value(self, key: str, value: Any, fobj: IO[bytes]) -> None:
+        if key == 'attachments' and value:
+            fobj.write(b'[')
+            for i, attachment in enumerate(value):
+                if i > 0:
+                    fobj.write(b',')
+                self._write_object(attachment, fobj, self._write_attachment_value)
+            fobj.write(b']')
+        else:
+            fobj.write(self._dumps(value))
+
+    def _write_attachment_value(self, key: str, value: Any, fobj: IO[bytes]) -> None:
+        if key == 'content' and isinstance(value, (bytes, bytearray, memoryview)):
+            content = memoryview(value)
+            fobj.write(b'"')
+            for offset in range(0, len(content), self._base64_chunk_size):
+                fobj.write(b2a_base64(content[offset:offset + self._base64_chunk_size], newline=False))
+            fobj.write(b'"')
+        else:
+            fobj.write(self._dumps(value))
 
     @classmethod
-    def _decode_attachments(cls, email: dict) -> dict:
-        attachments = email.get('attachments', [])
-        if not attachments:
-            return email
+    def _write_object(cls, obj: dict, fobj: IO[bytes], write_value: Callable[[str, Any, IO[bytes]], None]) -> None:
+        fobj.write(b'{')
+        for i, key in enumerate(sorted(obj)):
+            if i > 0:
+                fobj.write(b',')
+            fobj.write(cls._dumps(key))
+            fobj.write(b':')
+            write_value(key, obj[key], fobj)
+        fobj.write(b'}')
 
-        email = deepcopy(email)
-        for attachment in email['attachments']:
-            cls._decode_attachment(attachment)
-        return email
+    @classmethod
+    def _dumps(cls, value: Any) -> bytes:
+        return dumps(value, separators=cls._separators, sort_keys=True).encode(cls._encoding)
 
     @classmethod
     def _decode_attachment(cls, attachment: dict) -> None:
         content = attachment.get('content', '')
         if content:
-            attachment['content'] = b64decode(content)
+            attachment['content'] = a2b_base64(content)
+
+
+class MsgpackSerializer(Serializer):
+    extension = 'msgpack'
+
+    def serialize(self, obj: dict, type_: str = '') -> bytes:
+        return packb(obj, use_bin_type=True)
+
+    def deserialize(self, serialized: bytes, type_: str = '') -> dict:
+        return unpackb(serialized, raw=False)
+
+    def load(self, fobj: IO[bytes], type_: str = '') -> Iterable[dict]:
+        # msgpack objects delimit themselves, so attachment bytes can contain newlines
+        yield from Unpacker(fobj, raw=False)
@@ -63,11 +63,11 @@ class SyncEmails(object):
     def _download(self):
         # noinspection PyBroadException
         try:
-            downloaded = self._email_sync.download()
+            # each part is committed before the next download acknowledges it to the server
+            for downloaded in self._email_sync.download_parts():
+                self._email_store.create(downloaded)
         except Exception:
             self._log.exception('Unable to download emails')
-        else:
-            self._email_store.create(downloaded)
 
     def _sync(self):
         self._upload()
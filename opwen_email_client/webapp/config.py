@@ -19,6 +19,11 @@ root_domain = env('OPWEN_ROOT_DOMAIN', 'lokole.ca')
 class ImageDimensions(object):
     MAX_WIDTH_IMAGES = env.int('LOKOLE_MAX_WIDTH_EMAIL_IMAGES', 200)
     MAX_HEIGHT_IMAGES = env.int('LOKOLE_MAX_HEIGHT_EMAIL_IMAGES', 200)
+    MAX_BYTES_IMAGE = env.int('LOKOLE_MAX_BYTES_EMAIL_IMAGE', 50 * 1024)
+    MAX_BYTES_IMAGES = env.int('LOKOLE_MAX_BYTES_EMAIL_IMAGES', 200 * 1024)
+    # emails written on the client go out to arbitrary mail programs, not all of which can display webp
+    IMAGE_FORMATS = env.list('LOKOLE_EMAIL_IMAGE_FORMATS', ['JPEG'])
+    IMAGE_QUALITIES = env.list('LOKOLE_EMAIL_IMAGE_QUALITIES', [85, 70, 55, 40, 25], subcast=int)
 
 
 # noinspection PyPep8Naming
@@ -103,6 +108,8 @@ class AppConfig(object):
     MODEM_CONFIG_DIR = path.join(STATE_BASEDIR, 'usb_modeswitch')
     SIM_CONFIG_DIR = path.join(STATE_BASEDIR, 'wvdial')
     LOCAL_EMAIL_STORE = path.join(STATE_BASEDIR, 'emails.sqlite3')
+    DOWNLOAD_DIRECTORY = path.join(STATE_BASEDIR, 'downloads')
+    DICTIONARY_DIRECTORY = path.join(STATE_BASEDIR, 'dictionaries')
     SIM_TYPE = env('OPWEN_SIM_TYPE', None)
     RESTART_PATHS = env.dict('OPWEN_RESTART_PATH', {})
     MAX_UPLOAD_SIZE_MB = env.int('OPWEN_MAX_UPLOAD_SIZE_MB', 0)
@@ -118,6 +125,9 @@ class AppConfig(object):
 
     EMAIL_SEARCHABLE = env.bool('OPWEN_CAN_SEARCH_EMAIL', True)
     COMPRESSION = env('OPWEN_COMPRESSION', 'zstd')
+    SYNC_FORMAT = env('OPWEN_SYNC_FORMAT', 'jsonl')
+    SYNC_ATTACHMENTS = env('OPWEN_SYNC_ATTACHMENTS', 'deduplicated')
+    SYNC_DICTIONARY = env.bool('OPWEN_SYNC_DICTIONARY', True)
     EMAIL_SERVER_ENDPOINT = env('OPWEN_EMAIL_SERVER_ENDPOINT', None)
     EMAIL_SERVER_HOSTNAME = env('OPWEN_EMAIL_SERVER_HOSTNAME', None)
     EMAIL_HOST_FORMAT = '{}.' + root_domain
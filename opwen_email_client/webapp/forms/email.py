@@ -1,7 +1,7 @@
 from datetime import datetime
-from io import BytesIO
 from itertools import chain
 from mimetypes import guess_type
+from os.path import splitext
 from typing import Iterable
 from typing import List
 from typing import Optional
@@ -11,7 +11,6 @@ from flask import render_template
 from flask import request
 from flask_login import current_user
 from flask_wtf import FlaskForm
-from PIL import Image
 from werkzeug.datastructures import FileStorage
 from wtforms import FileField
 from wtforms import SelectMultipleField
@@ -26,6 +25,7 @@ from opwen_email_client.util.wtforms import HtmlTextAreaField
 from opwen_email_client.webapp.config import AppConfig
 from opwen_email_client.webapp.config import ImageDimensions
 from opwen_email_client.webapp.config import i8n
+from opwen_email_server.utils.images import ImageTranscoder
 
 
 class NewEmailForm(FlaskForm):
@@ -235,48 +235,44 @@ class ForwardEmailForm(NewEmailForm):
 def _attachments_as_dict(filestorages: Iterable[FileStorage]) \
         -> Iterable[dict]:
 
-    for filestorage in filestorages:
-        filename = filestorage.filename
-        content = filestorage.stream.read()
+    attachments = [(filestorage.filename, filestorage.stream.read()) for filestorage in filestorages]
+    budget_bytes = _image_transcoder.budget_for(sum(1 for filename, _ in attachments if _is_image(filename)))
 
-        formatted_content = _format_attachment(filename, content)
+    for filename, content in attachments:
+        filename, formatted_content = _format_attachment(filename, content, budget_bytes)
 
         if filename and formatted_content:
             yield {'filename': filename, 'content': formatted_content}
 
 
-def _format_attachment(filename: str, content: bytes) -> bytes:
-    attachment_type = guess_type(filename)[0]
+def _is_image(filename: Optional[str]) -> bool:
+    attachment_type = guess_type(filename or '')[0]
+    return bool(attachment_type) and 'image' in attachment_type.lower()
 
-    if not attachment_type:
-        return content
 
-    if 'image' in attachment_type.lower():
-        content = _change_image_size(content)
+def _format_attachment(filename: str, content: bytes, budget_bytes: int) -> Tuple[str, bytes]:
+    if not content or not _is_image(filename):
+        return filename, content
 
-    return content
+    transcoded = _image_transcoder.transcode(content, budget_bytes)
 
+    if transcoded.content == content:
+        return filename, content
 
-def _is_already_small(size: Tuple[int, int]) -> bool:
-    width, height = size
-    return width <= ImageDimensions.MAX_WIDTH_IMAGES and height <= ImageDimensions.MAX_HEIGHT_IMAGES
+    if transcoded.extension and guess_type(filename)[0] != transcoded.mimetype:
+        filename = f'{splitext(filename)[0]}.{transcoded.extension}'
 
+    return filename, transcoded.content
 
-def _change_image_size(image_content_bytes: bytes) -> bytes:
-    image_bytes = BytesIO(image_content_bytes)
-    image_bytes.seek(0)
-    image = Image.open(image_bytes)
 
-    if _is_already_small(image.size):
-        return image_content_bytes
-
-    new_size = (ImageDimensions.MAX_WIDTH_IMAGES, ImageDimensions.MAX_HEIGHT_IMAGES)
-    image.thumbnail(new_size, Image.ANTIALIAS)
-    new_image = BytesIO()
-    image.save(new_image, image.format)
-    new_image.seek(0)
-    new_image_bytes = new_image.read()
-    return new_image_bytes
+_image_transcoder = ImageTranscoder(
+    max_width=ImageDimensions.MAX_WIDTH_IMAGES,
+    max_height=ImageDimensions.MAX_HEIGHT_IMAGES,
+    max_image_bytes=ImageDimensions.MAX_BYTES_IMAGE,
+    max_email_bytes=ImageDimensions.MAX_BYTES_IMAGES,
+    formats=ImageDimensions.IMAGE_FORMATS,
+    qualities=ImageDimensions.IMAGE_QUALITIES,
+)
 
 
 def _is_local_message(address: str) -> bool:
@@ -7,6 +7,7 @@ from opwen_email_client.domain.email.client import LocalEmailServerClient
 from opwen_email_client.domain.email.sql_store import SqliteEmailStore
 from opwen_email_client.domain.email.sync import AzureSync
 from opwen_email_client.util.serialization import JsonSerializer
+from opwen_email_client.util.serialization import MsgpackSerializer
 from opwen_email_client.webapp.config import AppConfig
 from opwen_email_client.webapp.forms.login import LoginForm
 from opwen_email_client.webapp.login import FlaskLoginUserStore
@@ -38,9 +39,15 @@ class Ioc:
                 compression=AppConfig.COMPRESSION,
                 endpoint=endpoint,
                 client_id=AppConfig.CLIENT_ID,
+                format=AppConfig.SYNC_FORMAT,
+                attachments=AppConfig.SYNC_ATTACHMENTS,
+                dictionary=AppConfig.SYNC_DICTIONARY,
             )
 
-        serializer = JsonSerializer()
+        if AppConfig.SYNC_FORMAT == MsgpackSerializer.extension:
+            serializer = MsgpackSerializer()
+        else:
+            serializer = JsonSerializer()
 
         return AzureSync(
             compression=AppConfig.COMPRESSION,
@@ -52,6 +59,9 @@ class Ioc:
             container=AppConfig.STORAGE_CONTAINER,
             provider=AppConfig.STORAGE_PROVIDER,
             serializer=serializer,
+            download_dir=AppConfig.DOWNLOAD_DIRECTORY,
+            deduplicate_attachments=AppConfig.SYNC_ATTACHMENTS == 'deduplicated',
+            dictionary_dir=AppConfig.DICTIONARY_DIRECTORY,
         )
 
     @cached_property
@@ -21,6 +21,23 @@
       })
     })();
 
+    (function loadEmailBodyOnOpen () {
+      $('.panel-collapse').on('show.bs.collapse', function () {
+        var $body = $(this).find('.email-body[data-body-url]')
+        var bodyUrl = $body.data('body-url')
+        if (bodyUrl) {
+          $body.removeAttr('data-body-url').removeData('body-url')
+          $.ajax({
+            url: bodyUrl,
+            success: function (body) {
+              $body.html(body)
+              $body.find('img').lazyload()
+            }
+          })
+        }
+      })
+    })();
+
     (function printEmailOnPrintButtonClick () {
       $('.print-trigger').click(function () {
         var $printRoot = $(this).closest('.print-root')
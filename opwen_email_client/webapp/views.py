@@ -29,6 +29,7 @@ from opwen_email_client.webapp.config import i8n
 from opwen_email_client.webapp.forms.email import NewEmailForm
 from opwen_email_client.webapp.forms.register import RegisterForm
 from opwen_email_client.webapp.forms.settings import SettingsForm
+from opwen_email_client.webapp.jinja import render_body
 from opwen_email_client.webapp.security import login_required
 from opwen_email_client.webapp.session import Session
 from opwen_email_client.webapp.session import track_history
@@ -62,7 +63,9 @@ def about() -> Response:
 def news(page: int) -> Response:
     email_store = app.ioc.email_store
 
-    return _emails_view(email_store.inbox(AppConfig.NEWS_INBOX, page), page, 'news.html')
+    cursor = request.args.get('cursor')
+
+    return _emails_view(email_store.inbox(AppConfig.NEWS_INBOX, page, cursor), page, 'news.html')
 
 
 @app.route(AppConfig.APP_ROOT + '/email')
@@ -74,7 +77,9 @@ def email_inbox(page: int) -> Response:
     email_store = app.ioc.email_store
     user = current_user
 
-    return _emails_view(email_store.inbox(user.email, page), page, type='inbox')
+    cursor = request.args.get('cursor')
+
+    return _emails_view(email_store.inbox(user.email, page, cursor), page, type='inbox')
 
 
 @app.route(AppConfig.APP_ROOT + '/email/outbox', defaults={'page': 1})
@@ -96,7 +101,9 @@ def email_sent(page: int) -> Response:
     email_store = app.ioc.email_store
     user = current_user
 
-    return _emails_view(email_store.sent(user.email, page), page, type='sent')
+    cursor = request.args.get('cursor')
+
+    return _emails_view(email_store.sent(user.email, page, cursor), page, type='sent')
 
 
 @app.route(AppConfig.APP_ROOT + '/email/search', defaults={'page': 1})
@@ -134,6 +141,18 @@ def email_read(email_uid: str) -> Response:
     return Response('OK', status=200, mimetype='text/plain')
 
 
+@app.route(AppConfig.APP_ROOT + '/email/body/<email_uid>')
+@login_required
+def email_body(email_uid: str) -> Response:
+    email_store = app.ioc.email_store
+
+    email = email_store.get(email_uid)
+    if email is None:
+        return abort(404)
+
+    return Response(render_body(email), status=200, mimetype='text/html')
+
+
 @app.route(AppConfig.APP_ROOT + '/email/delete/<email_uid>')
 @login_required
 def email_delete(email_uid: str) -> Response:
@@ -454,6 +473,7 @@ def _emails_view(emails: Iterable[dict], page: int, template: str = 'email.html'
     offset_minutes = getattr(current_user, 'timezone_offset_minutes', None) or 0
     timezone_offset = timedelta(minutes=offset_minutes)
 
+    next_cursor = getattr(emails, 'next_cursor', None)
     emails = list(emails)
 
     for email in emails:
@@ -468,8 +488,17 @@ def _emails_view(emails: Iterable[dict], page: int, template: str = 'email.html'
                  page=page,
                  has_prevpage=page > 1,
                  has_nextpage=len(emails) == AppConfig.EMAILS_PER_PAGE,
+                 prevpage_args=_page_args(),
+                 nextpage_args=_page_args(cursor=next_cursor),
                  **kwargs)
 
 
+def _page_args(**kwargs) -> dict:
+    # a cursor only continues from the page it was issued for, other pages fall back to their number
+    args = {key: value for key, value in request.args.items() if key != 'cursor'}
+    args.update((key, value) for key, value in kwargs.items() if value is not None)
+    return args
+
+
 def _view(template: str, **kwargs) -> Response:
     return render_template(template, **kwargs)
@@ -1,10 +1,17 @@
 from abc import ABC
+from collections import namedtuple
 from hashlib import sha256
+from operator import attrgetter
+from tempfile import SpooledTemporaryFile
+from typing import IO
 from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import Iterable
+from typing import List
+from typing import Optional
 from typing import Tuple
+from typing import TypeVar
 from typing import Union
 
 from libcloud.storage.types import ObjectDoesNotExistError
@@ -14,25 +21,43 @@ from opwen_email_server.constants import mailbox
 from opwen_email_server.constants import sync
 from opwen_email_server.services.auth import Auth
 from opwen_email_server.services.sendgrid import SendSendgridEmail
+from opwen_email_server.services.storage import AzureBundleStorage
+from opwen_email_server.services.storage import AzureEmailStorage
+from opwen_email_server.services.storage import AzureMailboxIndex
 from opwen_email_server.services.storage import AzureObjectsStorage
 from opwen_email_server.services.storage import AzureObjectStorage
+from opwen_email_server.services.storage import AzurePendingStorage
 from opwen_email_server.services.storage import AzureTextStorage
+from opwen_email_server.services.storage import BundledEmail
+from opwen_email_server.services.storage import Delivery
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.services.storage import PendingEmails
+from opwen_email_server.utils.archive import FramesMember
+from opwen_email_server.utils.collections import chunks
 from opwen_email_server.utils.email_parser import MimeEmailParser
+from opwen_email_server.utils.email_parser import delivery_priority
 from opwen_email_server.utils.email_parser import descending_timestamp
 from opwen_email_server.utils.email_parser import ensure_has_sent_at
+from opwen_email_server.utils.email_parser import estimate_delivery_size
 from opwen_email_server.utils.email_parser import get_domain
 from opwen_email_server.utils.email_parser import get_domains
 from opwen_email_server.utils.email_parser import get_recipients
+from opwen_email_server.utils.email_parser import summarize_email
 from opwen_email_server.utils.log import LogMixin
 from opwen_email_server.utils.serialization import from_base64
 from opwen_email_server.utils.serialization import from_jsonl_bytes
+from opwen_email_server.utils.serialization import from_msgpack_record
 from opwen_email_server.utils.serialization import to_base64
+from opwen_email_server.utils.serialization import to_json
 from opwen_email_server.utils.serialization import to_jsonl_bytes
+from opwen_email_server.utils.serialization import to_msgpack_record
 from opwen_email_server.utils.string import is_lowercase
 from opwen_email_server.utils.unique import new_email_id
 
 Response = Union[dict, Tuple[str, int]]
 
+T = TypeVar('T', BundledEmail, '_PendingEmail', Union[BundledEmail, '_PendingEmail'])
+
 
 class _Action(ABC, LogMixin):
 
@@ -76,9 +101,9 @@ class StoreInboundEmails(_Action):
     def __init__(self,
                  raw_email_storage: AzureTextStorage,
                  email_storage: AzureObjectStorage,
-                 pending_storage: AzureTextStorage,
+                 pending_storage: AzurePendingStorage,
                  next_task: Callable[[str], None],
-                 email_parser: Callable[[str], dict] = None):
+                 email_parser: Callable[[IO[bytes]], dict] = None):
 
         self._raw_email_storage = raw_email_storage
         self._email_storage = email_storage
@@ -88,12 +113,12 @@ class StoreInboundEmails(_Action):
 
     def _action(self, resource_id):  # type: ignore
         try:
-            mime_email = self._raw_email_storage.fetch_text(resource_id)
+            with self._raw_email_storage.open_bytes(resource_id) as mime_email:
+                email = self._email_parser(mime_email)
         except ObjectDoesNotExistError:
             self.log_warning('Inbound email %s does not exist', resource_id)
             return 'skipped', 202
 
-        email = self._email_parser(mime_email)
         email_id = self._store_inbound_email(email)
 
         self._raw_email_storage.delete(resource_id)
@@ -107,30 +132,33 @@ class StoreInboundEmails(_Action):
         email_id = new_email_id(email)
         email['_uid'] = email_id
 
+        size = estimate_delivery_size(email)
+        priority = delivery_priority(email)
         self._email_storage.store_object(email_id, email)
 
         for domain in get_domains(email):
             if domain.endswith(mailbox.MAILBOX_DOMAIN):
-                self._pending_storage.store_text(f'{domain}/{email_id}', 'pending')
+                self._pending_storage.enqueue(domain, email_id, size, priority)
 
         return email_id
 
 
 class _IndexEmailForMailbox(_Action):
 
-    def __init__(self, email_storage: AzureObjectStorage, mailbox_storage: AzureTextStorage):
+    def __init__(self, email_storage: AzureEmailStorage, mailbox_index: AzureMailboxIndex):
         self._email_storage = email_storage
-        self._mailbox_storage = mailbox_storage
+        self._mailbox_index = mailbox_index
 
     def _action(self, resource_id):  # type: ignore
-        email = self._email_storage.fetch_object(resource_id)
+        email = self._email_storage.fetch_object(resource_id, with_attachments=False)
+        summary = summarize_email(email)
+        sort_key = f"{descending_timestamp(email['sent_at'])}/{resource_id}"
 
         for email_address in self._get_pivot(email):
             domain = get_domain(email_address)
-            desc_prefix = descending_timestamp(email['sent_at'])
             if domain.endswith(mailbox.MAILBOX_DOMAIN):
-                index = f"{domain}/{email_address}/{self._folder}/{desc_prefix}/{resource_id}"
-                self._mailbox_storage.store_text(index, 'indexed')
+                mailbox_id = f"{domain}/{email_address}/{self._folder}"
+                self._mailbox_index.add(mailbox_id, [MailboxEntry(sort_key, resource_id, summary)])
 
         self.log_event(events.MAILBOX_EMAIL_INDEXED, {'folder': self._folder})  # noqa: E501  # yapf: disable
         return 'OK', 200
@@ -170,21 +198,31 @@ class StoreWrittenClientEmails(_Action):
         self._user_storage = user_storage
         self._next_task = next_task
 
-    def _action(self, resource_id):  # type: ignore
-        self._store_emails(resource_id)
-        self._store_users(resource_id)
+    def _action(self, resource_id, wire_format='jsonl', attachments='embedded'):  # type: ignore
+        self._store_emails(resource_id, wire_format, attachments)
+        self._store_users(resource_id, wire_format)
         self._client_storage.delete(resource_id)
 
         return 'OK', 200
 
-    def _store_emails(self, resource_id):
-        emails = self._client_storage.fetch_objects(resource_id, (sync.EMAILS_FILE, from_jsonl_bytes))
+    def _store_emails(self, resource_id, wire_format, attachments):
+        if attachments == 'deduplicated':
+            attachments_by_email = self._fetch_attachments(resource_id, wire_format)
+        else:
+            attachments_by_email = {}
+
+        if wire_format == 'msgpack':
+            emails = self._client_storage.fetch_records(resource_id, sync.EMAILS_MSGPACK_FILE)
+        else:
+            emails = self._client_storage.fetch_objects(resource_id, (sync.EMAILS_FILE, from_jsonl_bytes))
+            emails = (self._decode_attachments(email) for email in emails)
 
         domain = ''
         num_stored = 0
         for email in emails:
             email_id = email['_uid']
-            email = self._decode_attachments(email)
+            if email_id in attachments_by_email:
+                email['attachments'] = (email.get('attachments') or []) + attachments_by_email[email_id]
             self._email_storage.store_object(email_id, email)
 
             self._next_task(email_id)
@@ -194,8 +232,11 @@ class StoreWrittenClientEmails(_Action):
 
         self.log_event(events.EMAIL_STORED_FROM_CLIENT, {'domain': domain, 'num_emails': num_stored})  # noqa: E501  # yapf: disable
 
-    def _store_users(self, resource_id):
-        users = self._client_storage.fetch_objects(resource_id, (sync.USERS_FILE, from_jsonl_bytes))
+    def _store_users(self, resource_id, wire_format):
+        if wire_format == 'msgpack':
+            users = self._client_storage.fetch_records(resource_id, sync.USERS_MSGPACK_FILE)
+        else:
+            users = self._client_storage.fetch_objects(resource_id, (sync.USERS_FILE, from_jsonl_bytes))
 
         domain = ''
         num_stored = 0
@@ -208,6 +249,27 @@ class StoreWrittenClientEmails(_Action):
 
         self.log_event(events.USER_STORED_FROM_CLIENT, {'domain': domain, 'num_users': num_stored})  # noqa: E501  # yapf: disable
 
+    def _fetch_attachments(self, resource_id: str, wire_format: str) -> Dict[str, List[dict]]:
+        if wire_format == 'msgpack':
+            attachments = self._client_storage.fetch_records(resource_id, sync.ATTACHMENTS_MSGPACK_FILE)
+        else:
+            attachments = self._client_storage.fetch_objects(resource_id, (sync.ATTACHMENTS_FILE, from_jsonl_bytes))
+
+        # each distinct attachment is uploaded once and points back to all the emails that contain it
+        attachments_by_email: Dict[str, List[dict]] = {}
+        try:
+            for attachment in attachments:
+                email_ids = attachment.pop('emails', [])
+                attachment.pop('_uid', None)
+                if wire_format != 'msgpack':
+                    attachment['content'] = from_base64(attachment['content'])
+                for email_id in email_ids:
+                    attachments_by_email.setdefault(email_id, []).append(attachment)
+        except ObjectDoesNotExistError:
+            self.log_debug('no separate attachments in %s', resource_id)
+
+        return attachments_by_email
+
     @classmethod
     def _decode_attachments(cls, email: dict) -> dict:
         if not email.get('attachments'):
@@ -235,9 +297,11 @@ class ReceiveInboundEmail(_Action):
             self.log_event(events.UNREGISTERED_CLIENT, {'client_id': client_id})  # noqa: E501  # yapf: disable
             return 'client is not registered', 403
 
-        email_id = self._new_email_id(email)
+        # keep the raw bytes so that the email can be parsed as a stream later on
+        mime_email = email.encode('utf-8')
+        email_id = self._new_email_id(mime_email)
 
-        self._raw_email_storage.store_text(email_id, email)
+        self._raw_email_storage.store_bytes(email_id, mime_email)
 
         self._next_task(email_id)
 
@@ -245,8 +309,8 @@ class ReceiveInboundEmail(_Action):
         return 'received', 200
 
     @classmethod
-    def _new_email_id(cls, email: str) -> str:
-        return sha256(email.encode('utf-8')).hexdigest()
+    def _new_email_id(cls, mime_email: bytes) -> str:
+        return sha256(mime_email).hexdigest()
 
 
 class ProcessServiceEmail(_Action):
@@ -256,7 +320,7 @@ class ProcessServiceEmail(_Action):
                  email_storage: AzureObjectStorage,
                  next_task: Callable[[str], None],
                  registry: Dict[str, Any],
-                 email_parser: Callable[[dict], dict] = None):
+                 email_parser: Callable[[IO[bytes]], dict] = None):
 
         self._raw_email_storage = raw_email_storage
         self._email_storage = email_storage
@@ -266,13 +330,12 @@ class ProcessServiceEmail(_Action):
 
     def _action(self, resource_id):  # type: ignore
         try:
-            mime_email = self._raw_email_storage.fetch_text(resource_id)
+            with self._raw_email_storage.open_bytes(resource_id) as mime_email:
+                email = self._email_parser(mime_email)
         except ObjectDoesNotExistError:
             self.log_warning('Inbound email %s does not exist', resource_id)
             return 'skipped', 202
 
-        email = self._email_parser(mime_email)
-
         for address in email.get('to', []):
             try:
                 mailer_service = self._registry[address]
@@ -294,17 +357,168 @@ class ProcessServiceEmail(_Action):
         return 'OK', 200
 
 
+def _encode_attachment(attachment: dict) -> dict:
+    attachment['content'] = to_base64(attachment['content'])
+    return attachment
+
+
+def _encode_attachments(email: dict) -> dict:
+    for attachment in email.get('attachments') or []:
+        _encode_attachment(attachment)
+
+    return email
+
+
+def _to_client_bytes(email: dict, wire_format: str) -> bytes:
+    if wire_format == 'msgpack':
+        return to_msgpack_record(email)
+    return to_jsonl_bytes(_encode_attachments(email))
+
+
+def _attachment_id(attachment: dict) -> str:
+    digest = sha256(attachment['content'])
+    digest.update(to_json([attachment.get('filename'), attachment.get('cid')]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _split_attachments(email: dict) -> List[dict]:
+    # attachments are keyed by their content so that copies in other emails can be sent once
+    attachments = email.pop('attachments', None) or []
+    return [dict(attachment, _uid=_attachment_id(attachment)) for attachment in attachments]
+
+
+def _attachment_to_client_bytes(attachment: dict, wire_format: str) -> bytes:
+    if wire_format == 'msgpack':
+        return to_msgpack_record(attachment)
+    return to_jsonl_bytes(_encode_attachment(attachment))
+
+
+def _back_references_prefix(email_ids: List[str]) -> bytes:
+    return b'{"emails":' + to_json(email_ids).encode('utf-8') + b','
+
+
+def _with_back_references(encoded: bytes, email_ids: List[str], wire_format: str) -> bytes:
+    if wire_format == 'msgpack':
+        attachment = from_msgpack_record(encoded)
+        attachment['emails'] = email_ids
+        return to_msgpack_record(attachment)
+
+    # splicing the references into the json line avoids parsing the attachment content again
+    return _back_references_prefix(email_ids) + encoded[1:]
+
+
+def _back_references(emails: Iterable[Union['_SpooledEmail', BundledEmail]]) -> Dict[str, List[str]]:
+    references: Dict[str, List[str]] = {}
+    for email in emails:
+        for attachment_id in email.attachment_ids:
+            references.setdefault(attachment_id, []).append(email.email_id)
+    return references
+
+
+class _SpooledAttachments:
+
+    def __init__(self, spool: IO[bytes], wire_format: str):
+        self._spool = spool
+        self._wire_format = wire_format
+        self._attachments: Dict[str, Tuple[int, int]] = {}
+
+    def add(self, attachments: Iterable[dict]) -> List[str]:
+        attachment_ids = []
+        for attachment in attachments:
+            attachment_id = attachment['_uid']
+            if attachment_id not in self._attachments:
+                content = _attachment_to_client_bytes(attachment, self._wire_format)
+                self._attachments[attachment_id] = (self._spool.tell(), len(content))
+                self._spool.write(content)
+            attachment_ids.append(attachment_id)
+        return attachment_ids
+
+    def size(self, attachment_ids: Iterable[str]) -> int:
+        return sum(self._attachments[attachment_id][1] for attachment_id in attachment_ids)
+
+    def read(self, references: Dict[str, List[str]]) -> Iterable[bytes]:
+        for attachment_id, email_ids in references.items():
+            offset, size = self._attachments[attachment_id]
+            self._spool.seek(offset)
+            yield _with_back_references(self._spool.read(size), email_ids, self._wire_format)
+
+
+_SpooledEmail = namedtuple('_SpooledEmail', ['email_id', 'offset', 'length', 'attachment_ids'])
+
+_PendingEmail = namedtuple('_PendingEmail', ['email_id', 'priority', 'size'])
+
+
+def _select_part(candidates: List[T], max_bytes: int, size_of: Callable[[T], int] = attrgetter('size')) -> List[T]:
+    # smaller, text-only emails go first so that a sync over a slow link is useful early
+    if max_bytes <= 0:
+        return candidates
+
+    # a part ends before the first email that would take it over the cap, and an email
+    # that is larger than the cap on its own still goes out in a part of its own
+    part: List[T] = []
+    num_bytes = 0
+    for candidate in sorted(candidates, key=lambda candidate: (candidate.priority, size_of(candidate))):
+        size = size_of(candidate)
+        if part and num_bytes + size > max_bytes:
+            break
+        part.append(candidate)
+        num_bytes += size
+    return part
+
+
+class AddEmailToClientBundles(_Action):
+
+    def __init__(self, email_storage: AzureObjectStorage, bundle_storage: AzureBundleStorage):
+        self._email_storage = email_storage
+        self._bundle_storage = bundle_storage
+
+    def _action(self, resource_id):  # type: ignore
+        email = self._email_storage.fetch_object(resource_id)
+        domains = sorted(domain for domain in get_domains(email) if domain.endswith(mailbox.MAILBOX_DOMAIN))
+
+        if domains:
+            priority = delivery_priority(email)
+            # attachments are stored without their leading brace so that the emails that reference
+            # them can be spliced in when the part for a client is put together
+            attachments = [(attachment['_uid'], _attachment_to_client_bytes(attachment, 'jsonl')[1:])
+                           for attachment in _split_attachments(email)]
+            self._bundle_storage.add(domains, resource_id, to_jsonl_bytes(email), priority, attachments)
+
+        self.log_event(events.EMAIL_BUNDLED_FOR_CLIENT, {'num_domains': len(domains)})  # noqa: E501  # yapf: disable
+        return 'OK', 200
+
+
 class DownloadClientEmails(_Action):
+    _prebuilt_compressions = ('zstd', 'zst')
+    _delivery_modes = ('immediate', 'acknowledged')
+    _spool_max_bytes = 16 * 1024 * 1024
+    _measure_batch_size = 64
+    _max_measured_emails = 4096
 
-    def __init__(self, auth: Auth, client_storage: AzureObjectsStorage, email_storage: AzureObjectStorage,
-                 pending_storage: AzureTextStorage):
+    def __init__(self,
+                 auth: Auth,
+                 client_storage: AzureObjectsStorage,
+                 email_storage: AzureObjectStorage,
+                 pending_storage: AzurePendingStorage,
+                 bundle_storage: Optional[AzureBundleStorage] = None,
+                 max_part_bytes: int = 0):
 
         self._auth = auth
         self._client_storage = client_storage
         self._email_storage = email_storage
         self._pending_storage = pending_storage
-
-    def _action(self, client_id, compression):  # type: ignore
+        self._bundle_storage = bundle_storage
+        self._max_part_bytes = max_part_bytes
+
+    def _action(  # type: ignore
+            self,
+            client_id,
+            compression,
+            format='jsonl',
+            attachments='embedded',
+            delivery='immediate',
+            acknowledged_resource_id=None,
+            dictionary=False):
         domain = self._auth.domain_for(client_id)
         if not domain:
             self.log_event(events.UNREGISTERED_CLIENT, {'client_id': client_id})  # noqa: E501  # yapf: disable
@@ -314,48 +528,211 @@ class DownloadClientEmails(_Action):
             self.log_event(events.UNKNOWN_COMPRESSION_FORMAT, {'client_id': client_id})  # noqa: E501  # yapf: disable
             return f'unknown compression format "{compression}"', 400
 
-        delivered = set()
-
-        def mark_delivered(email: dict) -> dict:
-            delivered.add(email['_uid'])
-            return email
-
-        pending = self._fetch_pending_emails(domain)
-        pending = (mark_delivered(email) for email in pending)
-        pending = (self._encode_attachments(email) for email in pending)
-
-        resource_id = self._client_storage.store_objects((sync.EMAILS_FILE, pending, to_jsonl_bytes), compression)
-
-        self._mark_emails_as_delivered(domain, delivered)
-
-        self.log_event(events.EMAILS_DELIVERED_TO_CLIENT, {'domain': domain, 'num_emails': len(delivered)})  # noqa: E501  # yapf: disable
+        if format not in sync.FORMATS:
+            return f'unknown format "{format}"', 400
+
+        if attachments not in sync.ATTACHMENT_MODES:
+            return f'unknown attachments mode "{attachments}"', 400
+
+        if delivery not in self._delivery_modes:
+            return f'unknown delivery mode "{delivery}"', 400
+
+        if delivery == 'acknowledged':
+            outstanding = self._pending_storage.fetch_delivery(domain)
+            if outstanding is not None:
+                if outstanding.resource_id != acknowledged_resource_id:
+                    # the client did not get the last part, so hand it out again instead of rebuilding it
+                    self.log_debug('re-sending unacknowledged part %s to %s', outstanding.resource_id, domain)
+                    return {
+                        'resource_id': outstanding.resource_id,
+                    }
+
+                self._complete(outstanding)
+                self._pending_storage.delete_delivery(domain)
+
+        pending = self._pending_storage.fetch(domain)
+
+        deduplicate = attachments == 'deduplicated'
+
+        # prebuilt bundles hold json lines, so msgpack parts are always built on demand
+        if self._bundle_storage is not None and compression in self._prebuilt_compressions and format == 'jsonl':
+            part = self._store_prebuilt(self._bundle_storage, pending, deduplicate)
+        elif self._max_part_bytes > 0 or deduplicate:
+            part = self._store_part(pending, compression, format, deduplicate, dictionary)
+        else:
+            emails = self._email_storage.fetch_many_objects(pending.email_ids)
+            if format == 'msgpack':
+                upload = (sync.EMAILS_MSGPACK_FILE, emails, to_msgpack_record)
+            else:
+                upload = (sync.EMAILS_FILE, (_encode_attachments(email) for email in emails), to_jsonl_bytes)
+            resource_id = self._client_storage.store_objects(upload, compression, dictionary)
+            part = Delivery(resource_id, pending, pending.email_ids)
+
+        if delivery == 'acknowledged' and part.resource_id is not None:
+            self._pending_storage.store_delivery(part)
+        else:
+            self._complete(part)
+
+        self.log_event(events.EMAILS_DELIVERED_TO_CLIENT, {'domain': domain, 'num_emails': len(part.email_ids), **self._email_storage.cache_stats})  # noqa: E501  # yapf: disable
         return {
-            'resource_id': resource_id,
+            'resource_id': part.resource_id,
         }
 
-    def _fetch_pending_emails(self, domain: str) -> Iterable[dict]:
-        for email_id in self._pending_storage.iter(f'{domain}/'):
-            yield self._email_storage.fetch_object(email_id)
-
-    @classmethod
-    def _encode_attachments(cls, email: dict) -> dict:
-        if not email.get('attachments'):
-            return email
-
-        for attachment in email['attachments']:
-            content_bytes = attachment['content']
-            attachment['content'] = to_base64(content_bytes)
-
-        return email
+    def _complete(self, delivery: Delivery):
+        self._pending_storage.acknowledge(delivery.pending, delivery.email_ids)
+
+        # bundled emails go out on every delivery path, so the bundles are trimmed whichever path was taken
+        if self._bundle_storage is not None:
+            domain = delivery.pending.domain
+            self._bundle_storage.acknowledge(domain, self._pending_storage.fetch(domain).email_ids)
+
+    def _store_part(self, pending: PendingEmails, compression: str, wire_format: str, deduplicate: bool,
+                    dictionary: bool) -> Delivery:
+        candidates, fetched = self._estimate_pending(pending, pending.email_ids)
+
+        # the part is chosen from the estimates so that only the emails in it are fetched
+        part_ids = [email.email_id for email in _select_part(candidates, self._max_part_bytes)]
+        emails = self._fetch_missing(fetched, part_ids)
+
+        with SpooledTemporaryFile(max_size=self._spool_max_bytes) as spool:
+            attachments = _SpooledAttachments(spool, wire_format)
+            part = []
+            for email_id in part_ids:
+                email = emails[email_id]
+                attachment_ids = attachments.add(_split_attachments(email)) if deduplicate else []
+                content = _to_client_bytes(email, wire_format)
+                part.append(_SpooledEmail(email_id, spool.tell(), len(content), attachment_ids))
+                spool.write(content)
+
+            def read_part() -> Iterable[bytes]:
+                for email in part:
+                    spool.seek(email.offset)
+                    yield spool.read(email.length)
+
+            if wire_format == 'msgpack':
+                uploads = [(sync.EMAILS_MSGPACK_FILE, read_part(), bytes)]
+                uploads.append((sync.ATTACHMENTS_MSGPACK_FILE, attachments.read(_back_references(part)), bytes))
+            else:
+                uploads = [(sync.EMAILS_FILE, read_part(), bytes)]
+                uploads.append((sync.ATTACHMENTS_FILE, attachments.read(_back_references(part)), bytes))
+
+            resource_id = self._client_storage.store_archive(uploads, compression, dictionary)
+
+        return Delivery(resource_id, pending, part_ids)
+
+    def _store_prebuilt(self, bundle_storage: AzureBundleStorage, pending: PendingEmails,
+                        deduplicate: bool) -> Delivery:
+        bundle = bundle_storage.fetch(pending.domain, pending.email_ids)
+
+        # prebuilt emails hold their attachments separately, which only clients that
+        # understand deduplicated attachments can use
+        usable_emails = [
+            email for email in bundle.emails
+            if not email.attachment_ids or deduplicate and all(a in bundle.attachments for a in email.attachment_ids)
+        ]
+
+        # emails that the bundle worker did not get to yet are compressed on demand
+        bundled_email_ids = {email.email_id for email in usable_emails}
+        missing_email_ids = [email_id for email_id in pending.email_ids if email_id not in bundled_email_ids]
+        missing_candidates, fetched = self._estimate_pending(pending, missing_email_ids)
+
+        attachment_sizes = {attachment_id: attachment.size for attachment_id, attachment in bundle.attachments.items()}
+
+        def size_of(email: Union[BundledEmail, _PendingEmail]) -> int:
+            if isinstance(email, _PendingEmail):
+                return email.size
+            return email.size + sum(attachment_sizes[attachment_id] for attachment_id in email.attachment_ids)
+
+        candidates: List[Union[BundledEmail, _PendingEmail]] = [*usable_emails, *missing_candidates]
+        selected = _select_part(candidates, self._max_part_bytes, size_of)
+        selected_email_ids = [email.email_id for email in selected if isinstance(email, _PendingEmail)]
+        emails = self._fetch_missing(fetched, selected_email_ids)
+
+        part = []
+        missing_contents = {}
+        missing_attachments: Dict[str, bytes] = {}
+        for candidate in selected:
+            if isinstance(candidate, BundledEmail):
+                part.append(candidate)
+                continue
 
-    def _mark_emails_as_delivered(self, domain: str, email_ids: Iterable[str]) -> None:
+            email = emails[candidate.email_id]
+            attachment_ids = []
+            if deduplicate:
+                for attachment in _split_attachments(email):
+                    attachment_ids.append(attachment['_uid'])
+                    if attachment['_uid'] not in bundle.attachments:
+                        content = _attachment_to_client_bytes(attachment, 'jsonl')[1:]
+                        missing_attachments.setdefault(attachment['_uid'], content)
+            content = to_jsonl_bytes(_encode_attachments(email))
+            part.append(BundledEmail(candidate.email_id, candidate.priority, len(content), None, attachment_ids))
+            missing_contents[candidate.email_id] = content
+
+        attachment_sizes.update((attachment_id, len(content)) for attachment_id, content in missing_attachments.items())
+
+        frames = (email.frame or bundle_storage.compress(missing_contents[email.email_id]) for email in part)
+        members: List[FramesMember] = [(sync.EMAILS_FILE, frames, sum(email.size for email in part))]
+
+        if deduplicate:
+            prefixes = {
+                attachment_id: _back_references_prefix(email_ids)
+                for attachment_id, email_ids in _back_references(part).items()
+            }
+
+            def attachment_frames() -> Iterable[bytes]:
+                for attachment_id, prefix in prefixes.items():
+                    yield bundle_storage.compress(prefix)
+                    bundled = bundle.attachments.get(attachment_id)
+                    if bundled is not None:
+                        yield bundled.frame
+                    else:
+                        yield bundle_storage.compress(missing_attachments[attachment_id])
+
+            num_bytes = sum(len(prefix) + attachment_sizes[attachment_id] for attachment_id, prefix in prefixes.items())
+            members.append((sync.ATTACHMENTS_FILE, attachment_frames(), num_bytes))
+
+        resource_id = self._client_storage.store_frames(members)
+
+        self.log_debug('prepared %d of %d emails with %d compressed on demand', len(part), len(candidates),
+                       len(missing_contents))
+        return Delivery(resource_id, pending, [email.email_id for email in part])
+
+    def _estimate_pending(self, pending: PendingEmails,
+                          email_ids: List[str]) -> Tuple[List[_PendingEmail], Dict[str, dict]]:
+        # emails that were enqueued without an estimate are fetched in batches to measure them; only as many
+        # as fit in one part are kept for the part to reuse and the rest are left for later parts
+        estimates = dict(pending.estimates or {})
+        unknown_ids = [email_id for email_id in email_ids if email_id not in estimates]
+        unknown_ids = unknown_ids[:self._max_measured_emails]
+
+        fetched: Dict[str, dict] = {}
+        fetched_bytes = 0
+        for batch in chunks(unknown_ids, self._measure_batch_size):
+            for email_id, email in zip(batch, self._email_storage.fetch_many_objects(list(batch))):
+                size = estimate_delivery_size(email)
+                estimates[email_id] = [size, delivery_priority(email)]
+                if self._max_part_bytes <= 0 or fetched_bytes + size <= self._max_part_bytes:
+                    fetched[email_id] = email
+                    fetched_bytes += size
+
+        candidates = []
         for email_id in email_ids:
-            self._pending_storage.delete(f'{domain}/{email_id}')
+            estimate = estimates.get(email_id)
+            if estimate is not None:
+                size, priority = estimate
+                candidates.append(_PendingEmail(email_id, priority, size))
+        return candidates, fetched
+
+    def _fetch_missing(self, fetched: Dict[str, dict], email_ids: List[str]) -> Dict[str, dict]:
+        missing_ids = [email_id for email_id in email_ids if email_id not in fetched]
+        if missing_ids:
+            fetched.update(zip(missing_ids, self._email_storage.fetch_many_objects(missing_ids)))
+        return fetched
 
 
 class UploadClientEmails(_Action):
 
-    def __init__(self, auth: Auth, next_task: Callable[[str], None]):
+    def __init__(self, auth: Auth, next_task: Callable[[str, str, str], None]):
         self._auth = auth
         self._next_task = next_task
 
@@ -366,8 +743,15 @@ class UploadClientEmails(_Action):
             return 'client is not registered', 403
 
         resource_id = upload_info['resource_id']
+        wire_format = upload_info.get('format', 'jsonl')
+        if wire_format not in sync.FORMATS:
+            return f'unknown format "{wire_format}"', 400
 
-        self._next_task(resource_id)
+        attachments = upload_info.get('attachments', 'embedded')
+        if attachments not in sync.ATTACHMENT_MODES:
+            return f'unknown attachments mode "{attachments}"', 400
+
+        self._next_task(resource_id, wire_format, attachments)
 
         self.log_event(events.EMAILS_RECEIVED_FROM_CLIENT, {'domain': domain})  # noqa: E501  # yapf: disable
         return 'uploaded', 200
@@ -459,13 +843,14 @@ class GetClient(_Action):
 class DeleteClient(_Action):
 
     def __init__(self, auth: Auth, delete_mailbox: Callable[[str, str], None], delete_mx_records: Callable[[str], None],
-                 mailbox_storage: AzureTextStorage, pending_storage: AzureTextStorage,
-                 user_storage: AzureObjectStorage):
+                 mailbox_index: AzureMailboxIndex, pending_storage: AzurePendingStorage,
+                 bundle_storage: AzureBundleStorage, user_storage: AzureObjectStorage):
         self._auth = auth
         self._delete_mailbox = delete_mailbox
         self._delete_mx_records = delete_mx_records
-        self._mailbox_storage = mailbox_storage
+        self._mailbox_index = mailbox_index
         self._pending_storage = pending_storage
+        self._bundle_storage = bundle_storage
         self._user_storage = user_storage
 
     def _action(self, domain, user, **auth_args):  # type: ignore
@@ -482,17 +867,22 @@ class DeleteClient(_Action):
         self._delete_mailbox(client_id, domain)
         self._delete_mx_records(domain)
         self._delete_index(self._pending_storage, domain)
-        self._delete_index(self._mailbox_storage, domain)
+        self._delete_index(self._bundle_storage, domain)
+        self._delete_index(self._mailbox_index, domain)
         self._delete_index(self._user_storage, domain)
         self._auth.delete(client_id, domain)
 
         self.log_event(events.CLIENT_DELETED, {'domain': domain})  # noqa: E501  # yapf: disable
         return 'OK', 200
 
-    @classmethod
-    def _delete_index(cls, storage: Union[AzureTextStorage, AzureObjectStorage], domain: str) -> None:
-        for prefix in storage.iter(f'{domain}/'):
-            storage.delete(f'{domain}/{prefix}')
+    def _delete_index(self, storage: Union[AzureMailboxIndex, AzureObjectStorage, AzurePendingStorage,
+                                           AzureBundleStorage], domain: str) -> None:
+        prefix = f'{domain}/'
+
+        def on_progress(num_deleted: int) -> None:
+            self.log_info('Deleted %d resources at %s in %s', num_deleted, prefix, storage.access_info().container)
+
+        storage.delete_prefix(prefix, on_progress)
 
 
 class CalculateNumberOfUsersMetric(_Action):
@@ -514,7 +904,7 @@ class CalculateNumberOfUsersMetric(_Action):
 
 class CalculatePendingEmailsMetric(_Action):
 
-    def __init__(self, auth: Auth, pending_storage: AzureTextStorage):
+    def __init__(self, auth: Auth, pending_storage: AzurePendingStorage):
         self._auth = auth
         self._pending_storage = pending_storage
 
@@ -522,7 +912,7 @@ class CalculatePendingEmailsMetric(_Action):
         if not self._auth.is_owner(domain, user):
             return 'client does not belong to the user', 403
 
-        pending_emails = sum(1 for _ in self._pending_storage.iter(f'{domain}/'))
+        pending_emails = self._pending_storage.count(domain)
 
         return {
             'pending_emails': pending_emails,
@@ -6,6 +6,28 @@ RANDOM_SEED = env.int('LOKOLE_RANDOM_SEED', None)
 
 STORAGE_PROVIDER = env('LOKOLE_STORAGE_PROVIDER', 'AZURE_BLOBS')
 
+STORAGE_MAX_CONCURRENCY = env.int('LOKOLE_STORAGE_MAX_CONCURRENCY', 8)
+STORAGE_POOL_SIZE = env.int('LOKOLE_STORAGE_POOL_SIZE', 10)
+STORAGE_CODEC = env('LOKOLE_STORAGE_CODEC', 'zst')
+STORAGE_ZSTD_DICTIONARIES = env.list('LOKOLE_STORAGE_ZSTD_DICTIONARIES', [])
+STORAGE_LEGACY_CODECS = env.bool('LOKOLE_STORAGE_LEGACY_CODECS', True)
+
+EMAIL_CACHE_MEMORY_BYTES = env.int('LOKOLE_EMAIL_CACHE_MEMORY_BYTES', 0)
+EMAIL_CACHE_DISK_BYTES = env.int('LOKOLE_EMAIL_CACHE_DISK_BYTES', 0)
+EMAIL_CACHE_DISK_PATH = env('LOKOLE_EMAIL_CACHE_DISK_PATH', '')
+EMAIL_SEPARATE_ATTACHMENTS = env.bool('LOKOLE_EMAIL_SEPARATE_ATTACHMENTS', False)
+PENDING_LEGACY_READS = env.bool('LOKOLE_PENDING_LEGACY_READS', True)
+MAILBOX_INDEX_MAX_SEGMENTS = env.int('LOKOLE_MAILBOX_INDEX_MAX_SEGMENTS', 8)
+MAILBOX_INDEX_SEGMENT_ENTRIES = env.int('LOKOLE_MAILBOX_INDEX_SEGMENT_ENTRIES', 1000)
+PREBUILT_BUNDLES = env.bool('LOKOLE_PREBUILT_BUNDLES', False)
+BUNDLE_COMPRESSION_LEVEL = env.int('LOKOLE_BUNDLE_COMPRESSION_LEVEL', 20)
+DOWNLOAD_MAX_PART_BYTES = env.int('LOKOLE_DOWNLOAD_MAX_PART_BYTES', 0)
+PACKAGE_MAX_ZSTD_LEVEL = env.int('LOKOLE_PACKAGE_MAX_ZSTD_LEVEL', 15)
+PACKAGE_ZSTD_THREADS = env.int('LOKOLE_PACKAGE_ZSTD_THREADS', -1)
+PACKAGE_CPU_BUDGET_SECONDS = env.float('LOKOLE_PACKAGE_CPU_BUDGET_SECONDS', 2.0)
+PACKAGE_LONG_DISTANCE_BYTES = env.int('LOKOLE_PACKAGE_LONG_DISTANCE_BYTES', 64 * 1024 * 1024)
+PACKAGE_DICTIONARY_MAX_BYTES = env.int('LOKOLE_PACKAGE_DICTIONARY_MAX_BYTES', 1024 * 1024)
+
 BLOBS_ACCOUNT = env('LOKOLE_EMAIL_SERVER_AZURE_BLOBS_NAME', '')
 BLOBS_KEY = env('LOKOLE_EMAIL_SERVER_AZURE_BLOBS_KEY', '')
 BLOBS_HOST = env('LOKOLE_EMAIL_SERVER_AZURE_BLOBS_HOST', '') or None
@@ -25,10 +47,15 @@ resource_suffix = env('LOKOLE_RESOURCE_SUFFIX', '')
 
 CONTAINER_CLIENT_PACKAGES = f'compressedpackages{resource_suffix}'
 CONTAINER_EMAILS = f'emails{resource_suffix}'
+CONTAINER_ATTACHMENTS = f'attachments{resource_suffix}'
+CONTAINER_INLINE_IMAGES = f'inlineimages{resource_suffix}'
 CONTAINER_MAILBOX = f'mailbox{resource_suffix}'
+CONTAINER_MAILBOX_INDEX = f'mailboxindex{resource_suffix}'
 CONTAINER_USERS = f'users{resource_suffix}'
 CONTAINER_SENDGRID_MIME = f'sendgridinboundemails{resource_suffix}'
 CONTAINER_PENDING = f'pendingemails{resource_suffix}'
+CONTAINER_PENDING_LOG = f'pendinglog{resource_suffix}'
+CONTAINER_BUNDLES = f'bundles{resource_suffix}'
 CONTAINER_AUTH = f'clientsauth{resource_suffix}'
 
 REGISTER_CLIENT_QUEUE = f'register{resource_suffix}'
@@ -38,6 +65,7 @@ PROCESS_SERVICE_QUEUE = f'service{resource_suffix}'
 SEND_QUEUE = f'send{resource_suffix}'
 MAILBOX_RECEIVED_QUEUE = f'mailboxreceived{resource_suffix}'
 MAILBOX_SENT_QUEUE = f'mailboxsent{resource_suffix}'
+BUNDLE_QUEUE = f'bundle{resource_suffix}'
 
 SENDGRID_MAX_RETRIES = env.int('LOKOLE_SENDGRID_MAX_RETRIES', 20)
 SENDGRID_RETRY_INTERVAL_SECONDS = env.float('LOKOLE_SENDGRID_RETRY_INTERVAL_SECONDS', 5)
@@ -59,6 +87,23 @@ REGISTRATION_SUDO_TEAM = env('LOKOLE_REGISTRATION_SUDO_TEAM', 'lokole-sudo')
 
 MAX_WIDTH_IMAGES = env.int('LOKOLE_MAX_WIDTH_EMAIL_IMAGES', 200)
 MAX_HEIGHT_IMAGES = env.int('LOKOLE_MAX_HEIGHT_EMAIL_IMAGES', 200)
+IMAGE_MAX_BYTES = env.int('LOKOLE_MAX_BYTES_EMAIL_IMAGE', 50 * 1024)
+EMAIL_IMAGES_MAX_BYTES = env.int('LOKOLE_MAX_BYTES_EMAIL_IMAGES', 200 * 1024)
+IMAGE_FORMATS = env.list('LOKOLE_EMAIL_IMAGE_FORMATS', ['WEBP', 'JPEG'])
+IMAGE_QUALITIES = env.list('LOKOLE_EMAIL_IMAGE_QUALITIES', [85, 70, 55, 40, 25], subcast=int)
+# 0 parses emails inside the worker, a negative number starts one parser process per core
+EMAIL_PARSER_PROCESSES = env.int('LOKOLE_EMAIL_PARSER_PROCESSES', 0)
+# inbound attachments larger than this are spooled to disk and stored without loading them into memory
+INBOUND_SPOOL_BYTES = env.int('LOKOLE_INBOUND_SPOOL_BYTES', 1024 * 1024)
+INLINE_IMAGES_MAX_WORKERS = env.int('LOKOLE_INLINE_IMAGES_MAX_WORKERS', 8)
+INLINE_IMAGE_TIMEOUT_SECONDS = env.float('LOKOLE_INLINE_IMAGE_TIMEOUT_SECONDS', 10.0)
+INLINE_IMAGES_EMAIL_TIMEOUT_SECONDS = env.float('LOKOLE_INLINE_IMAGES_EMAIL_TIMEOUT_SECONDS', 30.0)
+INLINE_IMAGE_MAX_BYTES = env.int('LOKOLE_INLINE_IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+INLINE_IMAGE_CACHE_TTL_SECONDS = env.int('LOKOLE_INLINE_IMAGE_CACHE_TTL_SECONDS', 24 * 60 * 60)
+INLINE_IMAGE_CACHE_MEMORY_BYTES = env.int('LOKOLE_INLINE_IMAGE_CACHE_MEMORY_BYTES', 64 * 1024 * 1024)
+INLINE_IMAGE_CACHE_SHARED = env.bool('LOKOLE_INLINE_IMAGE_CACHE_SHARED', True)
+INLINE_IMAGE_CACHE_SHARED_MAX_AGE_SECONDS = env.int('LOKOLE_INLINE_IMAGE_CACHE_SHARED_MAX_AGE_SECONDS',
+                                                    7 * 24 * 60 * 60)
 
 QUEUE_BROKER_SCHEME = env('LOKOLE_QUEUE_BROKER_SCHEME', '')
 QUEUE_BROKER_USERNAME = env('LOKOLE_EMAIL_SERVER_QUEUES_SAS_NAME')
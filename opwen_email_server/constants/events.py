@@ -15,6 +15,10 @@ EMAILS_RECEIVED_FROM_CLIENT = 'emails_received_from_client'  # type: Final
 EMAIL_RECEIVED_FOR_CLIENT = 'email_received_for_client'  # type: Final
 EMAIL_DELIVERED_FROM_CLIENT = 'email_delivered_from_client'  # type: Final
 EMAIL_STORED_FOR_CLIENT = 'email_stored_for_client'  # type: Final
+EMAIL_BUNDLED_FOR_CLIENT = 'email_bundled_for_client'  # type: Final
 EMAIL_STORED_FROM_CLIENT = 'email_stored_from_client'  # type: Final
 USER_STORED_FROM_CLIENT = 'user_stored_from_client'  # type: Final
 MAILBOX_EMAIL_INDEXED = 'mailbox_email_indexed'  # type: Final
+CLIENT_PACKAGE_COMPRESSED = 'client_package_compressed'  # type: Final
+INLINE_IMAGES_FETCHED = 'inline_images_fetched'  # type: Final
+EMAIL_IMAGES_TRANSCODED = 'email_images_transcoded'  # type: Final
@@ -1,4 +1,10 @@
 from typing_extensions import Final  # noqa: F401
 
 EMAILS_FILE = 'emails.jsonl'  # type: Final
+ATTACHMENTS_FILE = 'zattachments.jsonl'  # type: Final
 USERS_FILE = 'zzusers.jsonl'  # type: Final
+EMAILS_MSGPACK_FILE = 'emails.msgpack'  # type: Final
+ATTACHMENTS_MSGPACK_FILE = 'zattachments.msgpack'  # type: Final
+USERS_MSGPACK_FILE = 'zzusers.msgpack'  # type: Final
+FORMATS = ('jsonl', 'msgpack')  # type: Final
+ATTACHMENT_MODES = ('embedded', 'deduplicated')  # type: Final
@@ -1,12 +1,37 @@
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from multiprocessing import get_context
+from os import cpu_count
+from typing import IO
+from typing import Callable
+from typing import List
+from typing import Optional
+
 from opwen_email_server import config
 from opwen_email_server.services.auth import Auth
 from opwen_email_server.services.auth import AzureAuth
 from opwen_email_server.services.auth import NoAuth
+from opwen_email_server.services.storage import AzureAttachmentStorage
+from opwen_email_server.services.storage import AzureBundleStorage
+from opwen_email_server.services.storage import AzureBytesCache
+from opwen_email_server.services.storage import AzureEmailStorage
 from opwen_email_server.services.storage import AzureFileStorage
+from opwen_email_server.services.storage import AzureMailboxIndex
 from opwen_email_server.services.storage import AzureObjectsStorage
 from opwen_email_server.services.storage import AzureObjectStorage
+from opwen_email_server.services.storage import AzurePendingStorage
 from opwen_email_server.services.storage import AzureTextStorage
+from opwen_email_server.utils.cache import BytesCache
+from opwen_email_server.utils.cache import DiskBytesCache
+from opwen_email_server.utils.cache import MemoryBytesCache
+from opwen_email_server.utils.cache import TieredBytesCache
 from opwen_email_server.utils.collections import singleton
+from opwen_email_server.utils.compression import Codec
+from opwen_email_server.utils.compression import ZstdPolicy
+from opwen_email_server.utils.compression import load_codec
+from opwen_email_server.utils.drivers import DriverRegistry
+from opwen_email_server.utils.email_parser import InlineImageFetcher
 from opwen_email_server.utils.unique import NewGuid
 
 
@@ -19,6 +44,16 @@ def get_guid_source() -> NewGuid:
     return NewGuid(config.RANDOM_SEED)
 
 
+@singleton
+def get_storage_drivers() -> DriverRegistry:
+    return DriverRegistry(pool_size=config.STORAGE_POOL_SIZE)
+
+
+@singleton
+def get_storage_codec() -> Codec:
+    return load_codec(config.STORAGE_CODEC, config.STORAGE_ZSTD_DICTIONARIES)
+
+
 @singleton
 def get_auth() -> Auth:
     return AzureAuth(
@@ -29,6 +64,10 @@ def get_auth() -> Auth:
             secure=config.TABLES_SECURE,
             container=config.CONTAINER_AUTH,
             provider=config.STORAGE_PROVIDER,
+            max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+            drivers=get_storage_drivers(),
+            codec=get_storage_codec(),
+            legacy_codecs=config.STORAGE_LEGACY_CODECS,
         ),
         sudo_scope=config.REGISTRATION_SUDO_TEAM,
     )
@@ -44,8 +83,16 @@ def get_client_storage() -> AzureObjectsStorage:
             secure=config.CLIENT_STORAGE_SECURE,
             container=config.CONTAINER_CLIENT_PACKAGES,
             provider=config.STORAGE_PROVIDER,
+            drivers=get_storage_drivers(),
         ),
         resource_id_source=get_guid_source(),
+        compression_policy=ZstdPolicy(
+            max_level=config.PACKAGE_MAX_ZSTD_LEVEL,
+            threads=config.PACKAGE_ZSTD_THREADS,
+            cpu_budget_seconds=config.PACKAGE_CPU_BUDGET_SECONDS,
+            long_distance_bytes=config.PACKAGE_LONG_DISTANCE_BYTES,
+        ),
+        dictionary_max_bytes=config.PACKAGE_DICTIONARY_MAX_BYTES,
     )
 
 
@@ -58,18 +105,117 @@ def get_raw_email_storage() -> AzureTextStorage:
         secure=config.BLOBS_SECURE,
         container=config.CONTAINER_SENDGRID_MIME,
         provider=config.STORAGE_PROVIDER,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+        legacy_codecs=config.STORAGE_LEGACY_CODECS,
     )
 
 
 @singleton
-def get_email_storage() -> AzureObjectStorage:
-    return AzureObjectStorage(
+def get_email_cache() -> Optional[BytesCache]:
+    tiers: List[BytesCache] = []
+
+    if config.EMAIL_CACHE_MEMORY_BYTES > 0:
+        tiers.append(MemoryBytesCache(max_bytes=config.EMAIL_CACHE_MEMORY_BYTES))
+
+    if config.EMAIL_CACHE_DISK_BYTES > 0 and config.EMAIL_CACHE_DISK_PATH:
+        tiers.append(DiskBytesCache(root=config.EMAIL_CACHE_DISK_PATH, max_bytes=config.EMAIL_CACHE_DISK_BYTES))
+
+    if not tiers:
+        return None
+
+    return TieredBytesCache(*tiers)
+
+
+@singleton
+def get_inline_image_cache() -> Optional[BytesCache]:
+    tiers: List[BytesCache] = []
+
+    if config.INLINE_IMAGE_CACHE_MEMORY_BYTES > 0:
+        tiers.append(MemoryBytesCache(max_bytes=config.INLINE_IMAGE_CACHE_MEMORY_BYTES))
+
+    if config.INLINE_IMAGE_CACHE_SHARED:
+        tiers.append(
+            AzureBytesCache(
+                account=config.BLOBS_ACCOUNT,
+                key=config.BLOBS_KEY,
+                host=config.BLOBS_HOST,
+                secure=config.BLOBS_SECURE,
+                container=config.CONTAINER_INLINE_IMAGES,
+                provider=config.STORAGE_PROVIDER,
+                max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+                drivers=get_storage_drivers(),
+                codec=get_storage_codec(),
+                max_age=timedelta(seconds=config.INLINE_IMAGE_CACHE_SHARED_MAX_AGE_SECONDS),
+            ))
+
+    if not tiers:
+        return None
+
+    return TieredBytesCache(*tiers)
+
+
+@singleton
+def get_inline_image_fetcher() -> InlineImageFetcher:
+    return InlineImageFetcher(
+        max_workers=config.INLINE_IMAGES_MAX_WORKERS,
+        image_timeout_seconds=config.INLINE_IMAGE_TIMEOUT_SECONDS,
+        email_timeout_seconds=config.INLINE_IMAGES_EMAIL_TIMEOUT_SECONDS,
+        max_image_bytes=config.INLINE_IMAGE_MAX_BYTES,
+        cache=get_inline_image_cache(),
+        cache_ttl_seconds=config.INLINE_IMAGE_CACHE_TTL_SECONDS,
+    )
+
+
+@singleton
+def get_email_parser_processes() -> Optional[Executor]:
+    if config.EMAIL_PARSER_PROCESSES == 0:
+        return None
+
+    # the workers hold open connections and threads which must not be forked
+    return ProcessPoolExecutor(
+        max_workers=config.EMAIL_PARSER_PROCESSES if config.EMAIL_PARSER_PROCESSES > 0 else cpu_count(),
+        mp_context=get_context('spawn'),
+    )
+
+
+@singleton
+def get_attachment_storage() -> AzureAttachmentStorage:
+    return AzureAttachmentStorage(
+        account=config.BLOBS_ACCOUNT,
+        key=config.BLOBS_KEY,
+        host=config.BLOBS_HOST,
+        secure=config.BLOBS_SECURE,
+        container=config.CONTAINER_ATTACHMENTS,
+        provider=config.STORAGE_PROVIDER,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+    )
+
+
+def get_inbound_attachment_store() -> Callable[[str, IO[bytes], int], str]:
+    # large inbound attachments are always streamed to storage, the email storage keeps their references
+    return get_attachment_storage().store_attachment_file
+
+
+@singleton
+def get_email_storage() -> AzureEmailStorage:
+    return AzureEmailStorage(
         account=config.BLOBS_ACCOUNT,
         key=config.BLOBS_KEY,
         host=config.BLOBS_HOST,
         secure=config.BLOBS_SECURE,
         container=config.CONTAINER_EMAILS,
         provider=config.STORAGE_PROVIDER,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+        legacy_codecs=config.STORAGE_LEGACY_CODECS,
+        cache=get_email_cache(),
+        attachment_storage=get_attachment_storage(),
+        separate_attachments=config.EMAIL_SEPARATE_ATTACHMENTS,
     )
 
 
@@ -83,6 +229,10 @@ def get_user_storage() -> AzureObjectStorage:
         container=config.CONTAINER_USERS,
         provider=config.STORAGE_PROVIDER,
         case_sensitive=False,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+        legacy_codecs=config.STORAGE_LEGACY_CODECS,
     )
 
 
@@ -96,11 +246,35 @@ def get_mailbox_storage() -> AzureTextStorage:
         container=config.CONTAINER_MAILBOX,
         provider=config.STORAGE_PROVIDER,
         case_sensitive=False,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+        legacy_codecs=config.STORAGE_LEGACY_CODECS,
+    )
+
+
+@singleton
+def get_mailbox_index() -> AzureMailboxIndex:
+    return AzureMailboxIndex(
+        segment_storage=AzureObjectStorage(
+            account=config.BLOBS_ACCOUNT,
+            key=config.BLOBS_KEY,
+            host=config.BLOBS_HOST,
+            secure=config.BLOBS_SECURE,
+            container=config.CONTAINER_MAILBOX_INDEX,
+            provider=config.STORAGE_PROVIDER,
+            case_sensitive=False,
+            max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+            drivers=get_storage_drivers(),
+            codec=get_storage_codec(),
+        ),
+        max_segments=config.MAILBOX_INDEX_MAX_SEGMENTS,
+        max_segment_entries=config.MAILBOX_INDEX_SEGMENT_ENTRIES,
     )
 
 
 @singleton
-def get_pending_storage() -> AzureTextStorage:
+def get_legacy_pending_storage() -> AzureTextStorage:
     return AzureTextStorage(
         account=config.TABLES_ACCOUNT,
         key=config.TABLES_KEY,
@@ -108,4 +282,42 @@ def get_pending_storage() -> AzureTextStorage:
         secure=config.TABLES_SECURE,
         container=config.CONTAINER_PENDING,
         provider=config.STORAGE_PROVIDER,
+        max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+        drivers=get_storage_drivers(),
+        codec=get_storage_codec(),
+        legacy_codecs=config.STORAGE_LEGACY_CODECS,
+    )
+
+
+@singleton
+def get_pending_storage() -> AzurePendingStorage:
+    return AzurePendingStorage(
+        log_storage=AzureFileStorage(
+            account=config.TABLES_ACCOUNT,
+            key=config.TABLES_KEY,
+            host=config.TABLES_HOST,
+            secure=config.TABLES_SECURE,
+            container=config.CONTAINER_PENDING_LOG,
+            provider=config.STORAGE_PROVIDER,
+            max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+            drivers=get_storage_drivers(),
+        ),
+        legacy_storage=get_legacy_pending_storage() if config.PENDING_LEGACY_READS else None,
+    )
+
+
+@singleton
+def get_bundle_storage() -> AzureBundleStorage:
+    return AzureBundleStorage(
+        log_storage=AzureFileStorage(
+            account=config.BLOBS_ACCOUNT,
+            key=config.BLOBS_KEY,
+            host=config.BLOBS_HOST,
+            secure=config.BLOBS_SECURE,
+            container=config.CONTAINER_BUNDLES,
+            provider=config.STORAGE_PROVIDER,
+            max_concurrency=config.STORAGE_MAX_CONCURRENCY,
+            drivers=get_storage_drivers(),
+        ),
+        compression_level=config.BUNDLE_COMPRESSION_LEVEL,
     )
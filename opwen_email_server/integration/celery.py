@@ -1,6 +1,7 @@
 from celery import Celery
 
 from opwen_email_server import config
+from opwen_email_server.actions import AddEmailToClientBundles
 from opwen_email_server.actions import IndexReceivedEmailForMailbox
 from opwen_email_server.actions import IndexSentEmailForMailbox
 from opwen_email_server.actions import ProcessServiceEmail
@@ -9,10 +10,14 @@ from opwen_email_server.actions import SendOutboundEmails
 from opwen_email_server.actions import StoreInboundEmails
 from opwen_email_server.actions import StoreWrittenClientEmails
 from opwen_email_server.integration.azure import get_auth
+from opwen_email_server.integration.azure import get_bundle_storage
 from opwen_email_server.integration.azure import get_client_storage
+from opwen_email_server.integration.azure import get_email_parser_processes
 from opwen_email_server.integration.azure import get_email_storage
 from opwen_email_server.integration.azure import get_guid_source
-from opwen_email_server.integration.azure import get_mailbox_storage
+from opwen_email_server.integration.azure import get_inbound_attachment_store
+from opwen_email_server.integration.azure import get_inline_image_fetcher
+from opwen_email_server.integration.azure import get_mailbox_index
 from opwen_email_server.integration.azure import get_pending_storage
 from opwen_email_server.integration.azure import get_raw_email_storage
 from opwen_email_server.integration.azure import get_user_storage
@@ -20,6 +25,7 @@ from opwen_email_server.mailers import REGISTRY
 from opwen_email_server.services.dns import SetupMxRecords
 from opwen_email_server.services.sendgrid import SendSendgridEmail
 from opwen_email_server.services.sendgrid import SetupSendgridMailbox
+from opwen_email_server.utils.email_parser import MimeEmailParser
 
 celery = Celery(broker=config.QUEUE_BROKER)
 
@@ -49,7 +55,7 @@ def register_client(domain: str, owner: str) -> None:
 def index_received_email_for_mailbox(resource_id: str) -> None:
     action = IndexReceivedEmailForMailbox(
         email_storage=get_email_storage(),
-        mailbox_storage=get_mailbox_storage(),
+        mailbox_index=get_mailbox_index(),
     )
 
     action(resource_id)
@@ -59,19 +65,40 @@ def index_received_email_for_mailbox(resource_id: str) -> None:
 def index_sent_email_for_mailbox(resource_id: str) -> None:
     action = IndexSentEmailForMailbox(
         email_storage=get_email_storage(),
-        mailbox_storage=get_mailbox_storage(),
+        mailbox_index=get_mailbox_index(),
     )
 
     action(resource_id)
 
 
+@celery.task(ignore_result=True)
+def add_email_to_client_bundles(resource_id: str) -> None:
+    action = AddEmailToClientBundles(
+        email_storage=get_email_storage(),
+        bundle_storage=get_bundle_storage(),
+    )
+
+    action(resource_id)
+
+
+def index_and_bundle_email(resource_id: str) -> None:
+    index_received_email_for_mailbox.delay(resource_id)
+    if config.PREBUILT_BUNDLES:
+        add_email_to_client_bundles.delay(resource_id)
+
+
 @celery.task(ignore_result=True)
 def inbound_store(resource_id: str) -> None:
     action = StoreInboundEmails(
         raw_email_storage=get_raw_email_storage(),
         email_storage=get_email_storage(),
         pending_storage=get_pending_storage(),
-        next_task=index_received_email_for_mailbox.delay,
+        next_task=index_and_bundle_email,
+        email_parser=MimeEmailParser(
+            image_fetcher=get_inline_image_fetcher(),
+            processes=get_email_parser_processes(),
+            attachment_store=get_inbound_attachment_store(),
+        ),
     )
 
     action(resource_id)
@@ -84,7 +111,7 @@ def send_and_index_email(resource_id: str) -> None:
 
 
 @celery.task(ignore_result=True)
-def written_store(resource_id: str) -> None:
+def written_store(resource_id: str, wire_format: str = 'jsonl', attachments: str = 'embedded') -> None:
     action = StoreWrittenClientEmails(
         client_storage=get_client_storage(),
         email_storage=get_email_storage(),
@@ -92,7 +119,7 @@ def written_store(resource_id: str) -> None:
         next_task=send_and_index_email,
     )
 
-    action(resource_id)
+    action(resource_id, wire_format, attachments)
 
 
 @celery.task(ignore_result=True)
@@ -112,6 +139,10 @@ def process_service_email(resource_id: str) -> None:
         email_storage=get_email_storage(),
         registry=REGISTRY,
         next_task=send_and_index_email,
+        email_parser=MimeEmailParser(
+            image_fetcher=get_inline_image_fetcher(),
+            processes=get_email_parser_processes(),
+        ),
     )
 
     action(resource_id)
@@ -125,6 +156,7 @@ task_routes = {
     _fqn(register_client): {'queue': config.REGISTER_CLIENT_QUEUE},
     _fqn(index_received_email_for_mailbox): {'queue': config.MAILBOX_RECEIVED_QUEUE},
     _fqn(index_sent_email_for_mailbox): {'queue': config.MAILBOX_SENT_QUEUE},
+    _fqn(add_email_to_client_bundles): {'queue': config.BUNDLE_QUEUE},
     _fqn(process_service_email): {'queue': config.PROCESS_SERVICE_QUEUE},
     _fqn(inbound_store): {'queue': config.INBOUND_STORE_QUEUE},
     _fqn(written_store): {'queue': config.WRITTEN_STORE_QUEUE},
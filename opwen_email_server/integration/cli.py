@@ -1,8 +1,40 @@
+from io import BytesIO
+from itertools import groupby
+from json import JSONDecodeError
+from random import Random
+from time import process_time
+from typing import List
+
 import click
 from azure.servicebus.management import ServiceBusAdministrationClient
 from libcloud.storage.providers import get_driver
+from libcloud.storage.types import ObjectDoesNotExistError
 
 from opwen_email_server import config
+from opwen_email_server.constants import sync
+from opwen_email_server.integration.azure import get_client_storage
+from opwen_email_server.integration.azure import get_email_storage
+from opwen_email_server.integration.azure import get_legacy_pending_storage
+from opwen_email_server.integration.azure import get_mailbox_index
+from opwen_email_server.integration.azure import get_mailbox_storage
+from opwen_email_server.integration.azure import get_pending_storage
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.utils.archive import open_tar_stream
+from opwen_email_server.utils.archive import stream_tar
+from opwen_email_server.utils.compression import Codec
+from opwen_email_server.utils.compression import GzipCodec
+from opwen_email_server.utils.compression import ZstdCodec
+from opwen_email_server.utils.compression import train_zstd_dictionary
+from opwen_email_server.utils.concurrency import ordered_map
+from opwen_email_server.utils.email_parser import summarize_email
+from opwen_email_server.utils.serialization import from_base64
+from opwen_email_server.utils.serialization import from_json
+from opwen_email_server.utils.serialization import from_jsonl_bytes
+from opwen_email_server.utils.serialization import iter_msgpack_records
+from opwen_email_server.utils.serialization import to_base64
+from opwen_email_server.utils.serialization import to_jsonl_bytes
+from opwen_email_server.utils.serialization import to_msgpack_bytes
+from opwen_email_server.utils.serialization import to_msgpack_record
 
 _STORAGES = (
     (
@@ -43,6 +75,7 @@ def print_queues(separator):
             config.SEND_QUEUE,
             config.MAILBOX_RECEIVED_QUEUE,
             config.MAILBOX_SENT_QUEUE,
+            config.BUNDLE_QUEUE,
         )))
 
 
@@ -86,5 +119,220 @@ def delete_containers(suffix):
                     raise ValueError(f'Unable to delete container {container.name}')
 
 
+@cli.command()
+@click.option('-o', '--output', required=True)
+@click.option('-n', '--num-samples', type=int, default=1000)
+@click.option('-s', '--size', type=int, default=16 * 1024)
+def train_storage_dictionary(output, num_samples, size):
+    storage = get_email_storage()
+
+    samples = []
+    for resource_id in storage.iter():
+        samples.append(storage.fetch_bytes(resource_id))
+        if len(samples) >= num_samples:
+            break
+
+    with open(output, 'wb') as fobj:
+        fobj.write(train_zstd_dictionary(samples, size))
+
+    click.echo(f'Trained dictionary from {len(samples)} emails at {output}')
+
+
+@cli.command()
+@click.option('-n', '--num-samples', type=int, default=1000)
+@click.option('-s', '--size', type=int, default=16 * 1024)
+def train_package_dictionary(num_samples, size):
+    email_storage = get_email_storage()
+    client_storage = get_client_storage()
+    mailbox_index = get_mailbox_index()
+
+    # packages hold what was received lately, so the dictionary is trained on the newest emails;
+    # attachments are base64 noise to a dictionary, so only the email fields are sampled
+    samples = []
+    sampled_email_ids = set()
+    for email_id in mailbox_index.iter_recent_email_ids():
+        if email_id in sampled_email_ids:
+            continue
+        sampled_email_ids.add(email_id)
+
+        try:
+            email = email_storage.fetch_object(email_id, with_attachments=False)
+        except ObjectDoesNotExistError:
+            continue
+        email.pop('attachments', None)
+        samples.append(to_jsonl_bytes(email))
+        if len(samples) >= num_samples:
+            break
+
+    dictionary_id = client_storage.store_dictionary(train_zstd_dictionary(samples, size))
+
+    click.echo(f'Published package dictionary {dictionary_id} trained from {len(samples)} emails')
+
+
+@cli.command()
+@click.option('-p', '--prefix', default=None)
+def migrate_mailbox_index(prefix):
+    mailbox_storage = get_mailbox_storage()
+    mailbox_index = get_mailbox_index()
+    email_storage = get_email_storage()
+
+    def to_entry(index: str) -> MailboxEntry:
+        desc_prefix, email_id = index.split('/')[-2:]
+
+        try:
+            summary = from_json(mailbox_storage.fetch_text(index))
+        except JSONDecodeError:
+            summary = summarize_email(email_storage.fetch_object(email_id, with_attachments=False))
+
+        return MailboxEntry(f'{desc_prefix}/{email_id}', email_id, summary)
+
+    def mailbox_of(index: str) -> str:
+        return index.rsplit('/', 2)[0]
+
+    indexes = (f'{prefix or ""}{resource_id}' for resource_id in mailbox_storage.iter(prefix))
+
+    num_mailboxes = num_entries = 0
+    for mailbox_id, mailbox_indexes in groupby(indexes, mailbox_of):
+        entries = list(ordered_map(to_entry, mailbox_indexes, config.STORAGE_MAX_CONCURRENCY))
+        mailbox_index.add(mailbox_id, entries)
+        num_mailboxes += 1
+        num_entries += len(entries)
+
+    click.echo(f'Migrated {num_entries} entries of {num_mailboxes} mailboxes to the mailbox index')
+
+
+@cli.command()
+def migrate_pending_emails():
+    pending_storage = get_pending_storage()
+
+    def on_progress(num_migrated: int) -> None:
+        click.echo(f'Migrated {num_migrated} pending emails')
+
+    num_migrated = pending_storage.migrate(get_legacy_pending_storage(), on_progress)
+
+    click.echo(f'Moved {num_migrated} pending emails to the pending log')
+
+
+def _generate_emails(num_emails: int, seed: int = 42, attachment_ratio: float = 0.0) -> List[dict]:
+    # the emails are non-cryptographic test data that must be reproducible across runs
+    rng = Random(seed)  # nosec
+    words = ['hello', 'lokole', 'email', 'meeting', 'report', 'newsletter', 'update', 'thanks', 'regards']
+
+    emails = []
+    for _ in range(num_emails):
+        sender = f'user{rng.randint(0, 50)}@sender{rng.randint(0, 10)}.lokole.ca'
+        recipient = f'user{rng.randint(0, 50)}@recipient.lokole.ca'
+        subject = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 8)))
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(10, 500)))
+        sent_at = f'2020-0{rng.randint(1, 9)}-1{rng.randint(0, 9)} 1{rng.randint(0, 9)}:00'
+
+        # photos and documents arrive already compressed, so their bytes are close to random
+        attachments = []
+        if rng.random() < attachment_ratio:
+            attachments.append({
+                'filename': f'photo{rng.randint(0, 100)}.jpg',
+                'content': rng.getrandbits(8 * 50000).to_bytes(50000, 'little'),
+            })
+
+        emails.append({
+            '_uid': f'{rng.getrandbits(256):064x}',
+            'from': sender,
+            'to': [recipient],
+            'cc': [],
+            'bcc': [],
+            'subject': subject,
+            'body': f'<html><body><p>{text}</p></body></html>',
+            'sent_at': sent_at,
+            'attachments': attachments,
+        })
+    return emails
+
+
+def _generate_corpus(num_emails: int, seed: int = 42) -> List[bytes]:
+    corpus = []
+    for email in _generate_emails(num_emails, seed):
+        corpus.append(b'pending')
+        corpus.append(b'indexed')
+        corpus.append(to_msgpack_bytes(email))
+    return corpus
+
+
+def _benchmark_codec(codec: Codec, corpus: List[bytes]) -> str:
+    start = process_time()
+    compressed = [codec.compress(content) for content in corpus]
+    compress_time = process_time() - start
+
+    start = process_time()
+    for content in compressed:
+        codec.decompress(content)
+    decompress_time = process_time() - start
+
+    num_bytes = sum(len(content) for content in compressed)
+    return f'{num_bytes:>12} bytes {compress_time:>8.3f}s compress {decompress_time:>8.3f}s decompress'
+
+
+@cli.command()
+@click.option('-n', '--num-emails', type=int, default=2000)
+def benchmark_storage_codecs(num_emails):
+    train, test = _generate_corpus(num_emails, seed=1), _generate_corpus(num_emails, seed=2)
+    dictionary = train_zstd_dictionary(train)
+
+    codecs = (
+        ('gzip', GzipCodec()),
+        ('zstd', ZstdCodec()),
+        ('zstd+dictionary', ZstdCodec(dictionaries=[dictionary])),
+    )
+
+    click.echo(f'{"uncompressed":<16}{sum(len(content) for content in test):>12} bytes')
+    for name, codec in codecs:
+        click.echo(f'{name:<16}{_benchmark_codec(codec, test)}')
+
+
+def _with_base64_attachments(email: dict) -> dict:
+    attachments = [dict(attachment, content=to_base64(attachment['content'])) for attachment in email['attachments']]
+    return dict(email, attachments=attachments)
+
+
+def _benchmark_format(emails: List[dict], wire_format: str, compression: str) -> str:
+    start = process_time()
+    if wire_format == 'msgpack':
+        encoded = b''.join(to_msgpack_record(email) for email in emails)
+    else:
+        encoded = b''.join(to_jsonl_bytes(_with_base64_attachments(email)) for email in emails)
+    compressed = b''.join(stream_tar('emails', BytesIO(encoded), len(encoded), compression))
+    encode_time = process_time() - start
+
+    start = process_time()
+    with open_tar_stream(iter([compressed]), compression) as archive:
+        member = archive.next()
+        fobj = archive.extractfile(member) if member is not None else None
+        if fobj is None:
+            raise click.ClickException(f'Unable to read the {wire_format} archive back')
+        if wire_format == 'msgpack':
+            decoded = list(iter_msgpack_records(fobj))
+        else:
+            decoded = [email for email in map(from_jsonl_bytes, fobj) if email is not None]
+            for email in decoded:
+                for attachment in email['attachments']:
+                    attachment['content'] = from_base64(attachment['content'])
+    decode_time = process_time() - start
+
+    if len(decoded) != len(emails):
+        raise click.ClickException(f'Decoded {len(decoded)} of {len(emails)} {wire_format} emails')
+    return f'{len(compressed):>12} bytes {encode_time:>8.3f}s encode {decode_time:>8.3f}s decode'
+
+
+@cli.command()
+@click.option('-n', '--num-emails', type=int, default=500)
+@click.option('-a', '--attachment-ratio', type=float, default=0.2)
+def benchmark_sync_formats(num_emails, attachment_ratio):
+    emails = _generate_emails(num_emails, attachment_ratio=attachment_ratio)
+
+    for compression in ('gz', 'zstd'):
+        for wire_format in sync.FORMATS:
+            name = f'{wire_format}+{compression}'
+            click.echo(f'{name:<16}{_benchmark_format(emails, wire_format, compression)}')
+
+
 if __name__ == '__main__':
     cli()
@@ -10,9 +10,10 @@ from opwen_email_server.actions import Ping
 from opwen_email_server.actions import ReceiveInboundEmail
 from opwen_email_server.actions import UploadClientEmails
 from opwen_email_server.integration.azure import get_auth
+from opwen_email_server.integration.azure import get_bundle_storage
 from opwen_email_server.integration.azure import get_client_storage
 from opwen_email_server.integration.azure import get_email_storage
-from opwen_email_server.integration.azure import get_mailbox_storage
+from opwen_email_server.integration.azure import get_mailbox_index
 from opwen_email_server.integration.azure import get_no_auth
 from opwen_email_server.integration.azure import get_pending_storage
 from opwen_email_server.integration.azure import get_raw_email_storage
@@ -48,6 +49,8 @@ client_read = DownloadClientEmails(
     client_storage=get_client_storage(),
     email_storage=get_email_storage(),
     pending_storage=get_pending_storage(),
+    bundle_storage=get_bundle_storage() if config.PREBUILT_BUNDLES else None,
+    max_part_bytes=config.DOWNLOAD_MAX_PART_BYTES,
 )
 
 client_create = CreateClient(
@@ -70,8 +73,9 @@ client_delete = DeleteClient(
         secret=config.DNS_SECRET,
         provider=config.DNS_PROVIDER,
     ),
-    mailbox_storage=get_mailbox_storage(),
+    mailbox_index=get_mailbox_index(),
     pending_storage=get_pending_storage(),
+    bundle_storage=get_bundle_storage(),
     user_storage=get_user_storage(),
 )
 
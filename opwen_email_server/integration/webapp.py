@@ -7,7 +7,9 @@ from typing import Union
 from cached_property import cached_property
 from flask_security import LoginForm
 from libcloud.storage.types import ObjectDoesNotExistError
+from markupsafe import escape
 
+from opwen_email_client.domain.email.store import EmailPage
 from opwen_email_client.domain.email.store import EmailStore
 from opwen_email_client.domain.email.sync import Sync
 from opwen_email_client.domain.email.user_store import User
@@ -17,17 +19,19 @@ from opwen_email_client.domain.email.user_store import UserWriteStore
 from opwen_email_client.webapp.config import AppConfig
 from opwen_email_server.constants import mailbox
 from opwen_email_server.integration.azure import get_email_storage
-from opwen_email_server.integration.azure import get_mailbox_storage
+from opwen_email_server.integration.azure import get_mailbox_index
 from opwen_email_server.integration.azure import get_pending_storage
 from opwen_email_server.integration.azure import get_user_storage
 from opwen_email_server.integration.celery import send_and_index_email
+from opwen_email_server.services.storage import AzureEmailStorage
+from opwen_email_server.services.storage import AzureMailboxIndex
 from opwen_email_server.services.storage import AzureObjectStorage
-from opwen_email_server.services.storage import AzureTextStorage
-from opwen_email_server.utils.collections import chunks
-from opwen_email_server.utils.email_parser import descending_timestamp
+from opwen_email_server.services.storage import AzurePendingStorage
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.utils.email_parser import delivery_priority
 from opwen_email_server.utils.email_parser import ensure_has_sent_at
+from opwen_email_server.utils.email_parser import estimate_delivery_size
 from opwen_email_server.utils.email_parser import get_domain
-from opwen_email_server.utils.email_parser import get_recipients
 from opwen_email_server.utils.log import LogMixin
 
 
@@ -131,11 +135,11 @@ class AzureUserStore(UserStore, UserReadStore, UserWriteStore):
 
 class AzureEmailStore(EmailStore, LogMixin):
 
-    def __init__(self, email_storage: AzureObjectStorage, mailbox_storage: AzureTextStorage,
-                 pending_storage: AzureTextStorage, send_email: Callable[[str], None]):
+    def __init__(self, email_storage: AzureEmailStorage, mailbox_index: AzureMailboxIndex,
+                 pending_storage: AzurePendingStorage, send_email: Callable[[str], None]):
         super().__init__(restricted=None)
         self._email_storage = email_storage
-        self._mailbox_storage = mailbox_storage
+        self._mailbox_index = mailbox_index
         self._pending_storage = pending_storage
         self._send_email = send_email
 
@@ -151,13 +155,15 @@ class AzureEmailStore(EmailStore, LogMixin):
             ensure_has_sent_at(email)
             email.pop('csrf_token', None)
             email_id = email['_uid']
+            size = estimate_delivery_size(email)
+            priority = delivery_priority(email)
             self._email_storage.store_object(email_id, email)
-            self._pending_storage.store_text(f'{domain}/{email_id}', 'pending')
+            self._pending_storage.enqueue(domain, email_id, size, priority)
             self._send_email(email_id)
 
     def get(self, uid: str) -> Optional[dict]:
         try:
-            email = self._email_storage.fetch_object(uid)
+            email = self._email_storage.fetch_object(uid, with_attachments=False)
         except ObjectDoesNotExistError:
             self.log_warning('Email at %s does not exist', uid)
             return None
@@ -176,30 +182,55 @@ class AzureEmailStore(EmailStore, LogMixin):
         attachments = email.get('attachments', [])
         for attachment in attachments:
             if attachment.get('_uid') == attachment_id:
-                return attachment
+                return self._load_attachment(attachment)
 
         try:
-            return attachments[int(attachment_id)]
+            attachment = attachments[int(attachment_id)]
         except (IndexError, ValueError):
             return None
+        else:
+            return self._load_attachment(attachment)
+
+    def _load_attachment(self, attachment: dict) -> dict:
+        return dict(attachment, content=self._email_storage.fetch_attachment(attachment))
 
-    def inbox(self, email_address: str, page: int) -> Iterable[dict]:
-        return self._iter_mailbox(email_address, page, mailbox.RECEIVED_FOLDER)
+    def inbox(self, email_address: str, page: int, cursor: Optional[str] = None) -> Iterable[dict]:
+        return self._iter_mailbox(email_address, page, cursor, mailbox.RECEIVED_FOLDER)
 
-    def sent(self, email_address: str, page: int) -> Iterable[dict]:
-        return self._iter_mailbox(email_address, page, mailbox.SENT_FOLDER)
+    def sent(self, email_address: str, page: int, cursor: Optional[str] = None) -> Iterable[dict]:
+        return self._iter_mailbox(email_address, page, cursor, mailbox.SENT_FOLDER)
 
-    def _iter_mailbox(self, email_address: str, page: int, folder: str) -> Iterable[dict]:
+    def _iter_mailbox(self, email_address: str, page: int, cursor: Optional[str], folder: str) -> Iterable[dict]:
         domain = get_domain(email_address)
-        emails = self._mailbox_storage.iter(f'{domain}/{email_address}/{folder}')
-        for i, resource_ids in enumerate(chunks(emails, AppConfig.EMAILS_PER_PAGE), start=1):
-            if i != page:
-                continue
-            for resource_id in resource_ids:
-                email_id = resource_id.split('/')[-1]
-                email = self.get(email_id)
-                if email:
-                    yield email
+        mailbox_id = f'{domain}/{email_address}/{folder}'
+
+        if cursor is None:
+            cursor = self._find_page_cursor(mailbox_id, page)
+            if page > 1 and cursor is None:
+                return EmailPage()
+
+        entries, next_cursor = self._mailbox_index.list_page(mailbox_id, AppConfig.EMAILS_PER_PAGE, cursor)
+
+        return EmailPage((self._to_email(entry) for entry in entries), next_cursor)
+
+    @classmethod
+    def _to_email(cls, entry: MailboxEntry) -> dict:
+        email = dict(entry.summary)
+        email['_uid'] = entry.email_id
+        email['read'] = True
+        # the snippet is plain text with decoded entities but bodies are rendered as html
+        email['body'] = str(escape(email.pop('snippet', '')))
+        email['is_summary'] = True
+        return email
+
+    def _find_page_cursor(self, mailbox_id: str, page: int) -> Optional[str]:
+        # pages that were not reached via the cursor of their previous page walk forward from the first one
+        cursor = None
+        for known_page in range(1, page):
+            if known_page > 1 and cursor is None:
+                return None
+            _, cursor = self._mailbox_index.list_page(mailbox_id, AppConfig.EMAILS_PER_PAGE, cursor)
+        return cursor
 
     def search(self, email_address: str, page: int, query: Optional[str]) -> Iterable[dict]:
         return []
@@ -218,22 +249,11 @@ class AzureEmailStore(EmailStore, LogMixin):
 
     def _delete(self, email_address: str, uids: Iterable[str]):
         domain = get_domain(email_address)
+        uids = list(uids)
 
-        for uid in uids:
-            email = self.get(uid)
-            if not email:
-                continue
-
-            if email_address == email.get('from'):
-                folder = mailbox.SENT_FOLDER
-            elif email_address in get_recipients(email):
-                folder = mailbox.RECEIVED_FOLDER
-            else:
-                continue
-
-            desc_prefix = descending_timestamp(email['sent_at'])
-
-            self._mailbox_storage.delete(f"{domain}/{email_address}/{folder}/{desc_prefix}/{uid}")
+        # tombstones for emails that are not in a folder are harmless and get dropped on merge
+        for folder in (mailbox.RECEIVED_FOLDER, mailbox.SENT_FOLDER):
+            self._mailbox_index.delete(f'{domain}/{email_address}/{folder}', uids)
 
     def _mark_sent(self, uids: Iterable[str]):
         pass
@@ -257,7 +277,7 @@ class AzureIoc:
     def email_store(self):
         return AzureEmailStore(
             email_storage=get_email_storage(),
-            mailbox_storage=get_mailbox_storage(),
+            mailbox_index=get_mailbox_index(),
             pending_storage=get_pending_storage(),
             send_email=send_and_index_email,
         )
@@ -1,38 +1,115 @@
 from collections import namedtuple
+from contextlib import ExitStack
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from hashlib import sha256
 from io import BytesIO
+from os import makedirs
+from os.path import dirname
+from os.path import join
+from struct import pack
+from struct import unpack_from
 from tarfile import TarFile
 from tempfile import NamedTemporaryFile
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from time import monotonic
+from time import perf_counter
+from time import sleep
+from time import time_ns
 from typing import IO
+from typing import Any
 from typing import Callable
+from typing import Dict
 from typing import Iterable
 from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
+from typing import TypeVar
+from typing import Union
+from uuid import uuid4
 
 from cached_property import cached_property
+from libcloud.common.exceptions import BaseHTTPError
+from libcloud.common.types import LibcloudError
 from libcloud.storage.base import Container
 from libcloud.storage.base import Object
 from libcloud.storage.base import StorageDriver
-from libcloud.storage.providers import get_driver
+from libcloud.storage.drivers.azure_blobs import AzureBlobsStorageDriver
+from libcloud.storage.drivers.local import LocalStorageDriver
 from libcloud.storage.types import ContainerAlreadyExistsError
 from libcloud.storage.types import ContainerDoesNotExistError
 from libcloud.storage.types import ObjectDoesNotExistError
 from libcloud.storage.types import Provider
+from libcloud.utils.py3 import httplib
+from libcloud.utils.xml import fixxpath
 from xtarfile import open as tarfile_open
 from xtarfile.xtarfile import SUPPORTED_FORMATS
-
+from zstandard import ZstdCompressionDict
+
+from opwen_email_server.constants import events
+from opwen_email_server.utils.archive import FramesMember
+from opwen_email_server.utils.archive import can_stream
+from opwen_email_server.utils.archive import open_chunks
+from opwen_email_server.utils.archive import open_tar_stream
+from opwen_email_server.utils.archive import stream_tar_frames
+from opwen_email_server.utils.archive import stream_tar_members
+from opwen_email_server.utils.cache import BytesCache
+from opwen_email_server.utils.collections import chunks
+from opwen_email_server.utils.compression import Codec
+from opwen_email_server.utils.compression import GzipCodec
+from opwen_email_server.utils.compression import ZstdCodec
+from opwen_email_server.utils.compression import ZstdPolicy
+from opwen_email_server.utils.compression import sniff_codec
+from opwen_email_server.utils.concurrency import ordered_map
+from opwen_email_server.utils.drivers import DriverRegistry
 from opwen_email_server.utils.log import LogMixin
+from opwen_email_server.utils.serialization import from_json
 from opwen_email_server.utils.serialization import from_msgpack_bytes
-from opwen_email_server.utils.serialization import gunzip_bytes
-from opwen_email_server.utils.serialization import gzip_bytes
+from opwen_email_server.utils.serialization import iter_msgpack_records
+from opwen_email_server.utils.serialization import to_json
 from opwen_email_server.utils.serialization import to_msgpack_bytes
 from opwen_email_server.utils.temporary import create_tempfilename
 from opwen_email_server.utils.temporary import removing
 
 AccessInfo = namedtuple('AccessInfo', ['account', 'key', 'container'])
 
-Upload = Tuple[str, Iterable[dict], Callable[[dict], bytes]]
-Download = Tuple[str, Callable[[bytes], dict]]
+ListPage = namedtuple('ListPage', ['resource_ids', 'cursor'])
+
+MailboxEntry = namedtuple('MailboxEntry', ['sort_key', 'email_id', 'summary'])
+
+MailboxPage = namedtuple('MailboxPage', ['entries', 'cursor'])
+
+MailboxSegment = namedtuple('MailboxSegment', ['segment_id', 'first_key', 'last_key'])
+
+PendingEmails = namedtuple('PendingEmails',
+                           ['domain', 'email_ids', 'watermark', 'drained', 'legacy_email_ids', 'estimates'],
+                           defaults=[None])
+
+BundledEmail = namedtuple('BundledEmail', ['email_id', 'priority', 'size', 'frame', 'attachment_ids'])
+
+BundledAttachment = namedtuple('BundledAttachment', ['attachment_id', 'size', 'frame'])
+
+PrebuiltBundle = namedtuple('PrebuiltBundle', ['domain', 'emails', 'attachments'])
+
+Delivery = namedtuple('Delivery', ['resource_id', 'pending', 'email_ids'])
+
+Upload = Tuple[str, Iterable[Any], Callable[[Any], bytes]]
+Download = Tuple[str, Callable[[bytes], Optional[dict]]]
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# azure rejects append blocks over 4 MiB at the api version that libcloud uses
+_APPEND_BLOCK_BYTES = 4 * 1024 * 1024
+_APPEND_LEASE_SECONDS = 60
+_APPEND_RETRIES = 20
+_APPEND_RETRY_SECONDS = 0.5
+
+_SKIPPABLE_FRAME_MAGIC = 0x184D2A50
 
 
 class _Container:
@@ -46,9 +123,139 @@ class _Container:
     def iterate_objects(self, prefix: Optional[str] = None) -> Iterable[Object]:
         return self._wrapped.iterate_objects(prefix)
 
+    def list_objects(self,
+                     prefix: Optional[str],
+                     page_size: int,
+                     marker: Optional[str] = None) -> Tuple[List[Object], Optional[str]]:
+        driver = self._wrapped.driver
+        if isinstance(driver, AzureBlobsStorageDriver):
+            return self._list_azure_blobs(driver, prefix, page_size, marker)
+
+        # other providers list in name order, so the last name is a valid marker
+        objects: List[Object] = []
+        for obj in self._wrapped.iterate_objects(prefix):
+            if marker is not None and obj.name <= marker:
+                continue
+            if len(objects) == page_size:
+                return objects, objects[-1].name
+            objects.append(obj)
+        return objects, None
+
+    def _list_azure_blobs(self, driver: AzureBlobsStorageDriver, prefix: Optional[str], page_size: int,
+                          marker: Optional[str]) -> Tuple[List[Object], Optional[str]]:
+        params = {
+            'restype': 'container',
+            'comp': 'list',
+            'maxresults': page_size,
+        }
+        if prefix:
+            params['prefix'] = prefix
+        if marker:
+            params['marker'] = marker
+
+        # noinspection PyProtectedMember
+        response = driver.connection.request(driver._get_container_path(self._wrapped), params=params)
+        if response.status == httplib.NOT_FOUND:
+            raise ContainerDoesNotExistError(value=None, driver=driver, container_name=self._wrapped.name)
+        if response.status != httplib.OK:
+            raise LibcloudError(f'Unexpected status code: {response.status}', driver=driver)
+
+        body = response.parse_body()
+        blobs = body.find(fixxpath(xpath='Blobs')).findall(fixxpath(xpath='Blob'))
+        # noinspection PyProtectedMember
+        objects = [driver._xml_to_object(self._wrapped, blob) for blob in blobs]
+        return objects, body.findtext('NextMarker') or None
+
     def upload_object(self, file_path: str, object_name: str) -> Object:
         return self._wrapped.upload_object(file_path, object_name)
 
+    def append_object(self, object_name: str, data: bytes) -> None:
+        driver = self._wrapped.driver
+        if isinstance(driver, AzureBlobsStorageDriver):
+            self._append_azure_blob(driver, object_name, data)
+            return
+
+        if isinstance(driver, LocalStorageDriver):
+            self._append_local_file(driver, object_name, data)
+            return
+
+        # rewriting the whole object on other providers would lose the records that
+        # other workers append between the read and the write
+        raise LibcloudError(f'Appending objects is not supported by {driver.name}', driver=driver)
+
+    def _append_local_file(self, driver: LocalStorageDriver, object_name: str, data: bytes) -> None:
+        path = join(driver.get_container_cdn_url(self._wrapped, check=True), object_name)
+        makedirs(dirname(path), exist_ok=True)
+
+        # the driver's lock is shared with other processes and the file is opened for
+        # appending, so concurrent appends never overwrite each other
+        # noinspection PyProtectedMember
+        with driver._lock_cls(path), open(path, 'ab') as fobj:
+            fobj.write(data)
+
+    def _append_azure_blob(self, driver: AzureBlobsStorageDriver, object_name: str, data: bytes) -> None:
+        # noinspection PyProtectedMember
+        path = driver._get_object_path(self._wrapped, object_name)
+
+        def request(params: Dict[str, str], headers: Dict[str, str], body: bytes = b'') -> Any:
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+            return driver.connection.request(path, params=params, data=body, headers=headers, method='PUT')
+
+        def create() -> None:
+            response = request({}, {'x-ms-blob-type': 'AppendBlob', 'If-None-Match': '*'})
+            if response.status not in (httplib.CREATED, httplib.CONFLICT, httplib.PRECONDITION_FAILED):
+                raise LibcloudError(f'Unexpected status code: {response.status}', driver=driver)
+
+        def retry(params: Dict[str, str], headers: Dict[str, str], body: bytes, expected: int) -> Any:
+            for attempt in range(_APPEND_RETRIES):
+                try:
+                    response = request(params, headers, body)
+                except BaseHTTPError as ex:
+                    # another writer holds the lease of the blob for a multi-block append
+                    if ex.code != httplib.PRECONDITION_FAILED or attempt == _APPEND_RETRIES - 1:
+                        raise
+                else:
+                    if response.status == httplib.NOT_FOUND:
+                        create()
+                        continue
+                    if response.status == expected:
+                        return response
+                    if response.status != httplib.CONFLICT or attempt == _APPEND_RETRIES - 1:
+                        raise LibcloudError(f'Unexpected status code: {response.status}', driver=driver)
+                sleep(_APPEND_RETRY_SECONDS)
+            raise LibcloudError(f'Unable to append to {object_name}', driver=driver)
+
+        blocks = [data[i:i + _APPEND_BLOCK_BYTES] for i in range(0, len(data), _APPEND_BLOCK_BYTES)]
+        if len(blocks) <= 1:
+            retry({'comp': 'appendblock'}, {}, data, httplib.CREATED)
+            return
+
+        # blocks are only atomic one at a time, so a lease keeps concurrent appends from interleaving
+        lease = {'x-ms-lease-action': 'acquire', 'x-ms-lease-duration': str(_APPEND_LEASE_SECONDS)}
+        lease_id = retry({'comp': 'lease'}, lease, b'', httplib.CREATED).headers['x-ms-lease-id']
+        try:
+            for block in blocks:
+                retry({'comp': 'appendblock'}, {'x-ms-lease-id': lease_id}, block, httplib.CREATED)
+        finally:
+            request({'comp': 'lease'}, {'x-ms-lease-action': 'release', 'x-ms-lease-id': lease_id})
+
+    def read_object_from(self, object_name: str, offset: int) -> bytes:
+        driver = self._wrapped.driver
+        obj = Object(object_name, size=0, hash='', extra={}, meta_data={}, container=self._wrapped, driver=driver)
+        return b''.join(driver.download_object_range_as_stream(obj, start_bytes=offset))
+
+    def delete_object(self, object_name: str) -> bool:
+        # deleting by name skips the metadata request that get_object would make
+        driver = self._wrapped.driver
+        obj = Object(object_name, size=0, hash='', extra={}, meta_data={}, container=self._wrapped, driver=driver)
+        try:
+            return driver.delete_object(obj)
+        except ObjectDoesNotExistError:
+            return False
+        except FileNotFoundError:
+            # the local driver removes emptied folders, which races with a concurrent delete in the same folder
+            return True
+
     def upload_object_via_stream(self, iterator: Iterator[bytes], object_name: str) -> Object:
         return self._wrapped.upload_object_via_stream(iterator, object_name)
 
@@ -63,16 +270,36 @@ class _CaseInsensitiveContainer(_Container):
         prefix = prefix.lower() if prefix is not None else None
         return super().iterate_objects(prefix)
 
+    def list_objects(self,
+                     prefix: Optional[str],
+                     page_size: int,
+                     marker: Optional[str] = None) -> Tuple[List[Object], Optional[str]]:
+        prefix = prefix.lower() if prefix is not None else None
+        return super().list_objects(prefix, page_size, marker)
+
     def upload_object(self, file_path: str, object_name: str) -> Object:
         object_name = object_name.lower()
         return super().upload_object(file_path, object_name)
 
+    def delete_object(self, object_name: str) -> bool:
+        object_name = object_name.lower()
+        return super().delete_object(object_name)
+
+    def append_object(self, object_name: str, data: bytes) -> None:
+        object_name = object_name.lower()
+        super().append_object(object_name, data)
+
+    def read_object_from(self, object_name: str, offset: int) -> bytes:
+        object_name = object_name.lower()
+        return super().read_object_from(object_name, offset)
+
     def upload_object_via_stream(self, iterator: Iterator[bytes], object_name: str) -> Object:
         object_name = object_name.lower()
         return super().upload_object_via_stream(iterator, object_name)
 
 
 class _BaseAzureStorage(LogMixin):
+    _delete_batch_size = 256
 
     def __init__(self,
                  account: str,
@@ -81,7 +308,9 @@ class _BaseAzureStorage(LogMixin):
                  provider: str,
                  host: Optional[str] = None,
                  secure: bool = True,
-                 case_sensitive: bool = True) -> None:
+                 case_sensitive: bool = True,
+                 max_concurrency: int = 8,
+                 drivers: Optional[DriverRegistry] = None) -> None:
         self._account = account
         self._key = key
         self._container = container
@@ -89,14 +318,15 @@ class _BaseAzureStorage(LogMixin):
         self._host = host or None
         self._secure = secure
         self._case_sensitive = case_sensitive
+        self._max_concurrency = max_concurrency
+        self._drivers = drivers or DriverRegistry()
 
-    @cached_property
+    @property
     def _driver(self) -> StorageDriver:
-        driver = get_driver(self._provider)
-        return driver(self._account, self._key, host=self._host, secure=self._secure)
+        return self._drivers.get(self._provider, self._account, self._key, self._host, self._secure)
 
     @cached_property
-    def _client(self) -> _Container:
+    def _remote_container(self) -> Container:
         try:
             container = self._driver.get_container(self._container)
         except ContainerDoesNotExistError:
@@ -104,11 +334,17 @@ class _BaseAzureStorage(LogMixin):
                 container = self._driver.create_container(self._container)
             except ContainerAlreadyExistsError:
                 container = self._driver.get_container(self._container)
+        return container
+
+    @property
+    def _client(self) -> _Container:
+        remote_container = self._remote_container
+        container = Container(remote_container.name, remote_container.extra, self._driver)
         return _Container(container) if self._case_sensitive else _CaseInsensitiveContainer(container)
 
     @property
-    def _generated_suffix(self) -> str:
-        return ''
+    def _generated_suffixes(self) -> Tuple[str, ...]:
+        return ()
 
     def access_info(self) -> AccessInfo:
         return AccessInfo(
@@ -121,27 +357,76 @@ class _BaseAzureStorage(LogMixin):
         # noinspection PyStatementEffect
         self._client
 
-    def delete(self, resource_id: str):
-        try:
-            resource = self._client.get_object(resource_id)
-        except ObjectDoesNotExistError:
+    def _map_concurrently(self, func: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        self.ensure_exists()
+        return ordered_map(func, items, self._max_concurrency)
+
+    def delete(self, resource_id: str) -> None:
+        self._delete(resource_id)
+
+    def _delete(self, resource_id: str) -> bool:
+        # a resource rewritten under the current codec may still have a copy under an older one
+        # that fetches would fall back to, so every name is deleted
+        deleted = False
+        for filename in self._to_filenames(resource_id):
+            if self._client.delete_object(filename):
+                self.log_debug('deleted %s', filename)
+                deleted = True
+
+        if not deleted:
             self.log_warning('deleted missing %s', resource_id)
-        else:
-            resource.delete()
-            self.log_debug('deleted %s', resource_id)
+        return deleted
+
+    def delete_many(self, resource_ids: Iterable[str], on_progress: Optional[Callable[[int], None]] = None) -> int:
+        num_deleted = 0
+        for batch in chunks(resource_ids, self._delete_batch_size):
+            num_deleted += sum(self._map_concurrently(self._delete, batch))
+            self._report_deleted(num_deleted, on_progress)
+        return num_deleted
+
+    def delete_prefix(self, prefix: str, on_progress: Optional[Callable[[int], None]] = None) -> int:
+        filenames = (resource.name for resource in self._client.iterate_objects(prefix=prefix))
+
+        num_deleted = 0
+        for batch in chunks(filenames, self._delete_batch_size):
+            num_deleted += sum(self._map_concurrently(lambda filename: self._client.delete_object(filename), batch))
+            self._report_deleted(num_deleted, on_progress)
+        return num_deleted
+
+    def _report_deleted(self, num_deleted: int, on_progress: Optional[Callable[[int], None]]) -> None:
+        self.log_debug('deleted %d resources so far', num_deleted)
+        if on_progress is not None:
+            on_progress(num_deleted)
+
+    def _to_filenames(self, resource_id: str) -> List[str]:
+        return [resource_id]
 
     def iter(self, prefix: Optional[str] = None) -> Iterator[str]:
         resources = self._client.iterate_objects(prefix=prefix)
+        yield from self._to_resource_ids(resources, prefix)
 
+    def list_page(self, prefix: Optional[str] = None, page_size: int = 100, cursor: Optional[str] = None) -> ListPage:
+        resources, next_cursor = self._client.list_objects(prefix, page_size, cursor)
+        resource_ids = list(self._to_resource_ids(resources, prefix))
+        return ListPage(resource_ids=resource_ids, cursor=next_cursor)
+
+    def _to_resource_ids(self, resources: Iterable[Object], prefix: Optional[str]) -> Iterator[str]:
+        previous_resource_id = None
         for resource in resources:
             resource_id = resource.name
 
             if prefix is not None:
                 resource_id = resource_id[len(prefix):]
 
-            if resource_id.endswith(self._generated_suffix):
-                resource_id = resource_id[:-len(self._generated_suffix)]
+            for suffix in self._generated_suffixes:
+                if resource_id.endswith(suffix):
+                    resource_id = resource_id[:-len(suffix)]
+                    break
+
+            if resource_id == previous_resource_id:
+                continue
 
+            previous_resource_id = resource_id
             yield resource_id
             self.log_debug('listed %s', resource_id)
 
@@ -152,6 +437,28 @@ class AzureFileStorage(_BaseAzureStorage):
         self.log_debug('storing file %s at %s', path, resource_id)
         self._client.upload_object(path, resource_id)
 
+    def store_stream(self, resource_id: str, chunks: Iterator[bytes]):
+        self.log_debug('storing stream at %s', resource_id)
+        self._client.upload_object_via_stream(chunks, resource_id)
+
+    def fetch_stream(self, resource_id: str) -> Iterator[bytes]:
+        resource = self._client.get_object(resource_id)
+        self.log_debug('fetching stream from %s', resource_id)
+        return resource.as_stream()
+
+    def append_bytes(self, resource_id: str, content: bytes):
+        self.log_debug('appending %d bytes to %s', len(content), resource_id)
+        self._client.append_object(resource_id, content)
+
+    def fetch_bytes_from(self, resource_id: str, offset: int) -> bytes:
+        content = self._client.read_object_from(resource_id, offset)
+        self.log_debug('fetched %d bytes from %s at offset %d', len(content), resource_id, offset)
+        return content
+
+    def iter_sizes(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        for resource in self._client.iterate_objects(prefix=prefix):
+            yield resource.name[len(prefix):], resource.size
+
     def fetch_file(self, resource_id: str) -> str:
         resource = self._client.get_object(resource_id)
         path = create_tempfilename(resource_id)
@@ -161,39 +468,79 @@ class AzureFileStorage(_BaseAzureStorage):
 
 
 class _AzureBytesStorage(_BaseAzureStorage):
-    _compression = 'gz'
+
+    def __init__(self, *args, codec: Optional[Codec] = None, legacy_codecs: bool = False, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._codec = codec or ZstdCodec()
+        self._codecs = [self._codec]
+        self._codecs.extend(codec for codec in (ZstdCodec(), GzipCodec()) if codec.extension != self._codec.extension)
+        self._legacy_codecs = legacy_codecs
 
     def store_bytes(self, resource_id: str, content: bytes):
         filename = self._to_filename(resource_id)
         self.log_debug('storing %d bytes at %s', len(content), filename)
         upload = BytesIO()
-        upload.write(gzip_bytes(content))
+        upload.write(self._codec.compress(content))
         upload.seek(0)
         self._client.upload_object_via_stream(upload, filename)
 
-    def fetch_bytes(self, resource_id: str) -> bytes:
+    def store_file_object(self, resource_id: str, fobj: IO[bytes], size: int = -1):
         filename = self._to_filename(resource_id)
+        self.log_debug('streaming %d bytes to %s', size, filename)
+        self._client.upload_object_via_stream(self._codec.compress_stream(fobj, size), filename)
+
+    def fetch_bytes(self, resource_id: str) -> bytes:
         download = BytesIO()
-        resource = self._client.get_object(filename)
+        resource = self._get_object(resource_id)
         for chunk in resource.as_stream():
             download.write(chunk)
-        download.seek(0)
-        content = gunzip_bytes(download.read())
-        self.log_debug('fetched %d bytes from %s', len(content), filename)
+        compressed = download.getvalue()
+        content = sniff_codec(compressed, self._codecs).decompress(compressed)
+        self.log_debug('fetched %d bytes from %s', len(content), resource.name)
         return content
 
-    def delete(self, resource_id: str):
-        filename = self._to_filename(resource_id)
-        super().delete(filename)
+    @contextmanager
+    def open_bytes(self, resource_id: str) -> Iterator[IO[bytes]]:
+        resource = self._get_object(resource_id)
+        compressed = open_chunks(resource.as_stream())
+        codec = sniff_codec(compressed.peek(max(len(candidate.magic) for candidate in self._codecs)), self._codecs)
+        self.log_debug('streaming bytes from %s', resource.name)
+        with codec.decompress_stream(compressed) as content:
+            yield content
+
+    def fetch_many(self, resource_ids: Iterable[str]) -> Iterator[bytes]:
+        return self._map_concurrently(self.fetch_bytes, resource_ids)
+
+    def store_many(self, resources: Iterable[Tuple[str, bytes]]) -> None:
+        for _ in self._map_concurrently(lambda resource: self.store_bytes(*resource), resources):
+            pass
+
+    def _get_object(self, resource_id: str) -> Object:
+        *filenames, last_filename = self._to_filenames(resource_id)
+        for filename in filenames:
+            try:
+                return self._client.get_object(filename)
+            except ObjectDoesNotExistError:
+                continue
+        return self._client.get_object(last_filename)
 
     def _to_filename(self, resource_id: str) -> str:
-        if resource_id.endswith(self._generated_suffix):
-            return resource_id
-        return f'{resource_id}{self._generated_suffix}'
+        return self._to_filenames(resource_id)[0]
+
+    def _to_filenames(self, resource_id: str) -> List[str]:
+        suffixes = self._generated_suffixes
+        if resource_id.endswith(suffixes):
+            return [resource_id]
+
+        # names of older codecs cost an extra request for every read of a legacy or missing
+        # resource, so they are only tried while the container is being migrated
+        if not self._legacy_codecs:
+            suffixes = suffixes[:1]
+        return [f'{resource_id}{suffix}' for suffix in suffixes]
 
     @property
-    def _generated_suffix(self) -> str:
-        return f'.{self._extension}.{self._compression}'
+    def _generated_suffixes(self) -> Tuple[str, ...]:
+        return tuple(f'.{self._extension}.{codec.extension}' for codec in self._codecs)
 
     @property
     def _extension(self) -> str:
@@ -212,16 +559,100 @@ class AzureTextStorage(_AzureBytesStorage):
         content = self.fetch_bytes(resource_id)
         return content.decode(self._encoding)
 
+    def store_many_texts(self, resources: Iterable[Tuple[str, str]]) -> None:
+        self.store_many((resource_id, text.encode(self._encoding)) for resource_id, text in resources)
+
+    def fetch_many_texts(self, resource_ids: Iterable[str]) -> Iterator[str]:
+        for content in self.fetch_many(resource_ids):
+            yield content.decode(self._encoding)
+
+
+class AzureBytesCache(_AzureBytesStorage, BytesCache):
+    name = 'blob'
+    _extension = 'bin'
+    _epoch = datetime(1970, 1, 1)
+
+    def __init__(self,
+                 *args,
+                 max_age: timedelta = timedelta(days=7),
+                 clock: Callable[[], datetime] = datetime.utcnow,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._max_age = max_age
+        self._clock = clock
+        self._cleaned_generation: Optional[int] = None
+        self._cleanup_lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.fetch_bytes(self._resource_id_for(key))
+        except ObjectDoesNotExistError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        self._delete_expired_once()
+        self.store_bytes(self._resource_id_for(key), value)
+
+    def delete(self, key: str) -> None:
+        super().delete(self._resource_id_for(key))
+
+    def delete_expired(self) -> int:
+        generation = self._generation()
+        expired = (resource.name for resource in self._client.iterate_objects()
+                   if self._generation_of(resource.name) < generation)
+        return self.delete_many(expired)
+
+    def _delete_expired_once(self):
+        # the first write of a generation in each process clears out the older generations
+        generation = self._generation()
+        with self._cleanup_lock:
+            if self._cleaned_generation == generation:
+                return
+            self._cleaned_generation = generation
+
+        num_deleted = self.delete_expired()
+        self.log_debug('deleted %d expired cache entries', num_deleted)
+
+    def _generation(self) -> int:
+        return (self._clock() - self._epoch) // self._max_age
+
+    @classmethod
+    def _generation_of(cls, name: str) -> int:
+        generation, _, _ = name.partition('/')
+        return int(generation) if generation.isdigit() else -1
+
+    def _resource_id_for(self, key: str) -> str:
+        # entries live under the generation they were written in, so a lookup is a single
+        # request and the whole generation expires at once after at most max_age
+        return f'{self._generation():010d}/{sha256(key.encode("utf-8")).hexdigest()}'
+
 
 class AzureObjectsStorage(LogMixin):
     _compression = 'zstd'
+    # prebuilt frames are compressed once by the bundle worker, off the request path, and
+    # then reused for every delivery, so they keep a fixed high level instead of following
+    # the cpu budget of the compression policy; store_frames only adds small tar headers
     _compression_level = 20
+    _spool_max_bytes = 16 * 1024 * 1024
+    _dictionary_prefix = 'dictionaries/'
+    _current_dictionary_file = 'current'
+    _dictionary_refresh_seconds = 300
+
+    def __init__(self,
+                 file_storage: AzureFileStorage,
+                 resource_id_source: Callable[[], str],
+                 compression_policy: Optional[ZstdPolicy] = None,
+                 dictionary_max_bytes: int = 0):
 
-    def __init__(self, file_storage: AzureFileStorage, resource_id_source: Callable[[], str]):
         self._file_storage = file_storage
         self._resource_id_source = resource_id_source
+        self._compression_policy = compression_policy or ZstdPolicy()
+        self._dictionary_max_bytes = dictionary_max_bytes
+        self._dictionary: Optional[ZstdCompressionDict] = None
+        self._dictionary_loaded_at: Optional[float] = None
+        self._dictionary_lock = Lock()
 
-    def _open_archive_file(self, archive: TarFile, name: str) -> IO[bytes]:
+    def _open_archive_file(self, archive: TarFile, name: str, resource_id: str) -> IO[bytes]:
         while True:
             member = archive.next()
             if member is None:
@@ -233,15 +664,18 @@ class AzureObjectsStorage(LogMixin):
                 return fobj
 
         # noinspection PyProtectedMember
-        raise ObjectDoesNotExistError(f'File {name} is missing in archive', self._file_storage._driver, archive.name)
+        raise ObjectDoesNotExistError(f'File {name} is missing in archive', self._file_storage._driver, resource_id)
 
     @classmethod
-    def _open_archive(cls, path: str, mode: str) -> TarFile:
+    def _get_compression(cls, path: str) -> str:
         extension_index = path.rfind('.')
         if extension_index > -1:
-            compression = path[extension_index + 1:]
-        else:
-            compression = cls._compression
+            return path[extension_index + 1:]
+        return cls._compression
+
+    @classmethod
+    def _open_archive(cls, path: str, mode: str) -> TarFile:
+        compression = cls._get_compression(path)
 
         kwargs = {}
         if compression == 'zstd' and mode == 'w':
@@ -250,6 +684,19 @@ class AzureObjectsStorage(LogMixin):
         mode = f'{mode}|{compression}'
         return tarfile_open(path, mode, **kwargs)
 
+    @contextmanager
+    def _open_remote_archive(self, resource_id: str) -> Iterator[TarFile]:
+        compression = self._get_compression(resource_id)
+
+        if can_stream(compression):
+            chunks = self._file_storage.fetch_stream(resource_id)
+            with open_tar_stream(chunks, compression) as archive:
+                yield archive
+        else:
+            with removing(self._file_storage.fetch_file(resource_id)) as path:
+                with self._open_archive(path, 'r') as archive:
+                    yield archive
+
     def access_info(self) -> AccessInfo:
         return self._file_storage.access_info()
 
@@ -260,51 +707,200 @@ class AzureObjectsStorage(LogMixin):
     def compression_formats(cls) -> Iterable[str]:
         return SUPPORTED_FORMATS
 
-    def store_objects(self, upload: Upload, compression: Optional[str] = None) -> Optional[str]:
+    def store_objects(self,
+                      upload: Upload,
+                      compression: Optional[str] = None,
+                      dictionary: bool = False) -> Optional[str]:
+
+        return self.store_archive([upload], compression, dictionary)
+
+    def store_archive(self,
+                      uploads: Iterable[Upload],
+                      compression: Optional[str] = None,
+                      dictionary: bool = False) -> Optional[str]:
 
         compression = compression or self._compression
 
         resource_id = f'{self._resource_id_source()}.tar.{compression}'
 
-        name, objs, encoder = upload
+        if can_stream(compression):
+            num_stored = self._stream_objects(resource_id, uploads, compression, dictionary)
+        else:
+            num_stored = self._store_objects_via_file(resource_id, uploads)
+
+        self.log_debug('stored %d objects at %s', num_stored, resource_id)
+        return resource_id if num_stored > 0 else None
+
+    def store_frames(self, members: Iterable[FramesMember]) -> Optional[str]:
+        members = [(name, frames, num_bytes) for name, frames, num_bytes in members if num_bytes > 0]
+        if not members:
+            return None
+
+        resource_id = f'{self._resource_id_source()}.tar.{self._compression}'
+
+        chunks = stream_tar_frames(members, self._compression_level)
+        self._file_storage.store_stream(resource_id, chunks)
+
+        self.log_debug('stored %d prebuilt bytes at %s', sum(member[2] for member in members), resource_id)
+        return resource_id
+
+    def store_dictionary(self, content: bytes) -> int:
+        dictionary_id = ZstdCompressionDict(content).dict_id()
+
+        # dictionaries are immutable and kept around so that clients can still
+        # read packages that were compressed with an older version
+        self._file_storage.store_stream(f'{self._dictionary_prefix}{dictionary_id}', iter([content]))
+        self._file_storage.store_stream(f'{self._dictionary_prefix}{self._current_dictionary_file}',
+                                        iter([str(dictionary_id).encode('ascii')]))
+
+        self.log_debug('published zstd dictionary %d', dictionary_id)
+        return dictionary_id
+
+    def fetch_dictionary(self, dictionary_id: int) -> bytes:
+        return b''.join(self._file_storage.fetch_stream(f'{self._dictionary_prefix}{dictionary_id}'))
+
+    def _current_dictionary(self) -> Optional[ZstdCompressionDict]:
+        with self._dictionary_lock:
+            now = monotonic()
+            loaded_at = self._dictionary_loaded_at
+            if loaded_at is None or now - loaded_at > self._dictionary_refresh_seconds:
+                self._dictionary = self._load_current_dictionary()
+                self._dictionary_loaded_at = now
+            return self._dictionary
+
+    def _load_current_dictionary(self) -> Optional[ZstdCompressionDict]:
+        current = f'{self._dictionary_prefix}{self._current_dictionary_file}'
+        try:
+            dictionary_id = int(b''.join(self._file_storage.fetch_stream(current)))
+        except ObjectDoesNotExistError:
+            return None
+
+        # the pointer is a few bytes, so the dictionary itself is only downloaded when it was replaced
+        if self._dictionary is not None and self._dictionary.dict_id() == dictionary_id:
+            return self._dictionary
+
+        try:
+            content = self.fetch_dictionary(dictionary_id)
+        except ObjectDoesNotExistError:
+            return None
+
+        return ZstdCompressionDict(content)
 
+    def _stream_objects(self, resource_id: str, uploads: Iterable[Upload], compression: str, dictionary: bool) -> int:
+        num_stored = 0
+        with ExitStack() as stack:
+            # tar headers need the size of each file up front, so files are spooled one after the other
+            members = []
+            for name, objs, encoder in uploads:
+                fobj = stack.enter_context(SpooledTemporaryFile(max_size=self._spool_max_bytes))
+                num_bytes = 0
+                for obj in objs:
+                    encoded = encoder(obj)
+                    fobj.write(encoded)
+                    num_bytes += len(encoded)
+                    num_stored += 1
+
+                if num_bytes > 0:
+                    fobj.seek(0)
+                    members.append((name, fobj, num_bytes))
+
+            if members:
+                num_bytes = sum(member[2] for member in members)
+                if compression in ('zstd', 'zst'):
+                    # small packages compress badly on their own, so clients that can fetch
+                    # the shared dictionary get them compressed against it
+                    zstd_dictionary = None
+                    if dictionary and num_bytes <= self._dictionary_max_bytes:
+                        zstd_dictionary = self._current_dictionary()
+
+                    settings = self._compression_policy.settings(num_bytes)
+                    properties = settings._asdict()
+                    properties['dictionary_id'] = zstd_dictionary.dict_id() if zstd_dictionary is not None else 0
+                    zstd_compressor = self._compression_policy.compressor(num_bytes, zstd_dictionary, settings)
+                    chunks = stream_tar_members(members, compression, zstd_compressor=zstd_compressor)
+                    self._store_measured(resource_id, chunks, num_bytes, properties)
+                else:
+                    chunks = stream_tar_members(members, compression)
+                    self._file_storage.store_stream(resource_id, chunks)
+
+        return num_stored
+
+    def _store_measured(self, resource_id: str, chunks: Iterable[bytes], num_bytes: int, properties: dict):
+        compressed_bytes = 0
+        seconds = 0.0
+
+        # the compressor runs lazily while the upload pulls chunks, so only the time
+        # spent producing each chunk is counted
+        def measure() -> Iterator[bytes]:
+            nonlocal compressed_bytes, seconds
+            iterator = iter(chunks)
+            while True:
+                start = perf_counter()
+                chunk = next(iterator, None)
+                seconds += perf_counter() - start
+                if chunk is None:
+                    break
+                compressed_bytes += len(chunk)
+                yield chunk
+
+        self._file_storage.store_stream(resource_id, measure())
+
+        self.log_event(
+            events.CLIENT_PACKAGE_COMPRESSED,
+            dict(
+                properties,
+                num_bytes=num_bytes,
+                compressed_bytes=compressed_bytes,
+                ratio=round(num_bytes / max(compressed_bytes, 1), 2),
+                seconds=round(seconds, 3),
+            ))
+
+    def _store_objects_via_file(self, resource_id: str, uploads: Iterable[Upload]) -> int:
         num_stored = 0
         with removing(create_tempfilename(resource_id)) as path:
             with self._open_archive(path, 'w') as archive:
-                with NamedTemporaryFile() as fobj:
-                    num_bytes = 0
-                    for obj in objs:
-                        encoded = encoder(obj)
-                        fobj.write(encoded)
-                        num_bytes += len(encoded)
-                        num_stored += 1
-
-                    if num_bytes > 0:
-                        fobj.seek(0)
-                        archive.add(fobj.name, name)
+                for name, objs, encoder in uploads:
+                    with NamedTemporaryFile() as fobj:
+                        num_bytes = 0
+                        for obj in objs:
+                            encoded = encoder(obj)
+                            fobj.write(encoded)
+                            num_bytes += len(encoded)
+                            num_stored += 1
+
+                        if num_bytes > 0:
+                            fobj.seek(0)
+                            archive.add(fobj.name, name)
 
             if num_stored > 0:
                 self._file_storage.store_file(resource_id, path)
 
-        self.log_debug('stored %d objects at %s', num_stored, resource_id)
-        return resource_id if num_stored > 0 else None
+        return num_stored
 
     def fetch_objects(self, resource_id: str, download: Download) -> Iterable[dict]:
 
         name, decoder = download
 
         num_fetched = 0
-        with removing(self._file_storage.fetch_file(resource_id)) as path:
-            with self._open_archive(path, 'r') as archive:
-                fobj = self._open_archive_file(archive, name)
-                for encoded in fobj:
-                    obj = decoder(encoded)
-                    if obj is None:
-                        continue
-                    num_fetched += 1
-                    yield obj
+        with self._open_remote_archive(resource_id) as archive:
+            fobj = self._open_archive_file(archive, name, resource_id)
+            for encoded in fobj:
+                obj = decoder(encoded)
+                if obj is None:
+                    continue
+                num_fetched += 1
+                yield obj
         self.log_debug('fetched %d objects from %s', num_fetched, resource_id)
 
+    def fetch_records(self, resource_id: str, name: str) -> Iterable[dict]:
+        num_fetched = 0
+        with self._open_remote_archive(resource_id) as archive:
+            fobj = self._open_archive_file(archive, name, resource_id)
+            for obj in iter_msgpack_records(fobj):
+                num_fetched += 1
+                yield obj
+        self.log_debug('fetched %d records from %s', num_fetched, resource_id)
+
     def delete(self, resource_id: str):
         self._file_storage.delete(resource_id)
 
@@ -312,10 +908,624 @@ class AzureObjectsStorage(LogMixin):
 class AzureObjectStorage(_AzureBytesStorage):
     _extension = 'msgpack'
 
+    def __init__(self, *args, cache: Optional[BytesCache] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._cache = cache
+
     def fetch_object(self, resource_id: str) -> dict:
-        serialized = self.fetch_bytes(resource_id)
+        serialized = self._fetch_serialized(resource_id)
         return from_msgpack_bytes(serialized)
 
     def store_object(self, resource_id: str, obj: dict) -> None:
         serialized = to_msgpack_bytes(obj)
         self.store_bytes(resource_id, serialized)
+
+        if self._cache is not None:
+            self._cache.put(self._to_filename(resource_id), serialized)
+
+    def fetch_many_objects(self, resource_ids: Iterable[str]) -> Iterator[dict]:
+        for serialized in self._map_concurrently(self._fetch_serialized, resource_ids):
+            yield from_msgpack_bytes(serialized)
+
+    def store_many_objects(self, resources: Iterable[Tuple[str, dict]]) -> None:
+        for _ in self._map_concurrently(lambda resource: self.store_object(*resource), resources):
+            pass
+
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        return getattr(self._cache, 'stats', {})
+
+    def _delete(self, resource_id: str) -> bool:
+        if self._cache is not None:
+            self._cache.delete(self._to_filename(resource_id))
+
+        return super()._delete(resource_id)
+
+    def _fetch_serialized(self, resource_id: str) -> bytes:
+        if self._cache is None:
+            return self.fetch_bytes(resource_id)
+
+        filename = self._to_filename(resource_id)
+        serialized = self._cache.get(filename)
+        if serialized is None:
+            serialized = self.fetch_bytes(resource_id)
+            self._cache.put(filename, serialized)
+        return serialized
+
+
+class AzureAttachmentStorage(_AzureBytesStorage):
+    _extension = 'bin'
+
+    def store_attachment(self, content: bytes) -> str:
+        content_id = sha256(content).hexdigest()
+
+        try:
+            self._get_object(content_id)
+        except ObjectDoesNotExistError:
+            self.store_bytes(content_id, content)
+        else:
+            self.log_debug('skipped storing duplicate attachment %s', content_id)
+
+        return content_id
+
+    def store_attachment_file(self, content_id: str, fobj: IO[bytes], size: int = -1) -> str:
+        try:
+            self._get_object(content_id)
+        except ObjectDoesNotExistError:
+            self.store_file_object(content_id, fobj, size)
+        else:
+            self.log_debug('skipped storing duplicate attachment %s', content_id)
+
+        return content_id
+
+    def fetch_attachment(self, content_id: str) -> bytes:
+        return self.fetch_bytes(content_id)
+
+
+class AzureEmailStorage(AzureObjectStorage):
+
+    def __init__(self,
+                 *args,
+                 attachment_storage: Optional[AzureAttachmentStorage] = None,
+                 separate_attachments: bool = False,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._attachment_storage = attachment_storage
+        self._separate_attachments = separate_attachments and attachment_storage is not None
+
+    def fetch_object(self, resource_id: str, with_attachments: bool = True) -> dict:
+        email = super().fetch_object(resource_id)
+        if with_attachments:
+            email = self._resolve_attachments(email)
+        return email
+
+    def store_object(self, resource_id: str, obj: dict) -> None:
+        # attachments that are already stored separately keep their references either way
+        if self._separate_attachments:
+            obj = self._separate(obj)
+
+        super().store_object(resource_id, obj)
+
+    def fetch_many_objects(self, resource_ids: Iterable[str], with_attachments: bool = True) -> Iterator[dict]:
+        return self._map_concurrently(lambda resource_id: self.fetch_object(resource_id, with_attachments),
+                                      resource_ids)
+
+    def fetch_attachment(self, attachment: dict) -> bytes:
+        content = attachment.get('content')
+        if content is not None:
+            return content
+
+        if self._attachment_storage is None:
+            raise ValueError(f'No storage configured for attachment {attachment.get("content_id")}')
+
+        return self._attachment_storage.fetch_attachment(attachment['content_id'])
+
+    def _separate(self, email: dict) -> dict:
+        attachments = email.get('attachments')
+        attachment_storage = self._attachment_storage
+        if not attachments or attachment_storage is None:
+            return email
+
+        separated = []
+        for attachment in attachments:
+            content = attachment.get('content')
+            if content is not None:
+                attachment = {key: value for key, value in attachment.items() if key != 'content'}
+                attachment['content_id'] = attachment_storage.store_attachment(content)
+                attachment['size'] = len(content)
+            separated.append(attachment)
+
+        return dict(email, attachments=separated)
+
+    def _resolve_attachments(self, email: dict) -> dict:
+        attachments = email.get('attachments')
+        if not attachments or all(attachment.get('content_id') is None for attachment in attachments):
+            return email
+
+        resolved = []
+        for attachment in attachments:
+            if attachment.get('content_id') is not None:
+                content = self.fetch_attachment(attachment)
+                attachment = {key: value for key, value in attachment.items() if key not in ('content_id', 'size')}
+                attachment['content'] = content
+            resolved.append(attachment)
+
+        return dict(email, attachments=resolved)
+
+
+class AzurePendingStorage(LogMixin):
+    _segment_format = '%Y%m%d%H'
+    _compaction_age = timedelta(hours=2)
+
+    def __init__(self,
+                 log_storage: AzureFileStorage,
+                 legacy_storage: Optional[AzureTextStorage] = None,
+                 clock: Callable[[], datetime] = datetime.utcnow):
+        self._log_storage = log_storage
+        self._legacy_storage = legacy_storage
+        self._clock = clock
+
+    def access_info(self) -> AccessInfo:
+        return self._log_storage.access_info()
+
+    def ensure_exists(self):
+        return self._log_storage.ensure_exists()
+
+    def enqueue(self, domain: str, email_id: str, size: Optional[int] = None, priority: int = 0):
+        self._append(domain, [email_id], {} if size is None else {email_id: [size, priority]})
+
+    def fetch(self, domain: str) -> PendingEmails:
+        previous_watermark = self._fetch_watermark(domain)
+        cutoff = (self._clock() - self._compaction_age).strftime(self._segment_format)
+
+        email_ids = []
+        estimates = {}
+        watermark = {}
+        drained = []
+        for segment, size in self._log_storage.iter_sizes(f'{domain}/segments/'):
+            offset = previous_watermark.get(segment, 0)
+
+            if size > offset:
+                content = self._log_storage.fetch_bytes_from(f'{domain}/segments/{segment}', offset)
+                end = content.rfind(b'\n') + 1
+                for line in content[:end].decode('utf-8').splitlines():
+                    fields = line.split()
+                    if not fields:
+                        continue
+                    email_ids.append(fields[0])
+                    if len(fields) == 3:
+                        estimates[fields[0]] = [int(fields[1]), int(fields[2])]
+                offset += end
+
+            watermark[segment] = offset
+            if segment < cutoff and offset >= size:
+                drained.append(segment)
+
+        legacy_email_ids = []
+        if self._legacy_storage is not None:
+            legacy_email_ids = list(self._legacy_storage.iter(f'{domain}/'))
+            email_ids.extend(legacy_email_ids)
+
+        return PendingEmails(
+            domain=domain,
+            email_ids=list(dict.fromkeys(email_ids)),
+            watermark=watermark,
+            drained=drained,
+            legacy_email_ids=legacy_email_ids,
+            estimates=estimates,
+        )
+
+    def acknowledge(self, pending: PendingEmails, delivered_email_ids: Optional[Iterable[str]] = None):
+        domain = pending.domain
+        delivered = set(pending.email_ids if delivered_email_ids is None else delivered_email_ids)
+
+        legacy_email_ids = [email_id for email_id in pending.legacy_email_ids if email_id in delivered]
+        if legacy_email_ids and self._legacy_storage is not None:
+            self._legacy_storage.delete_many(f'{domain}/{email_id}' for email_id in legacy_email_ids)
+
+        if not pending.email_ids and not pending.drained:
+            return
+
+        # emails that were not delivered are enqueued again before the watermark moves past them
+        settled = delivered.union(pending.legacy_email_ids)
+        undelivered = [email_id for email_id in pending.email_ids if email_id not in settled]
+        if undelivered:
+            self._append(domain, undelivered, pending.estimates or {})
+
+        # drained segments are deleted before the watermark forgets them so that
+        # a failure in between can only leave stale watermark entries behind
+        self._log_storage.delete_many(f'{domain}/segments/{segment}' for segment in pending.drained)
+
+        watermark = {segment: offset for segment, offset in pending.watermark.items() if segment not in pending.drained}
+        self._log_storage.store_stream(f'{domain}/watermark', iter([to_json(watermark).encode('utf-8')]))
+        self.log_debug('acknowledged %d pending emails for %s', len(pending.email_ids) - len(undelivered), domain)
+
+    def count(self, domain: str) -> int:
+        return len(self.fetch(domain).email_ids)
+
+    def fetch_delivery(self, domain: str) -> Optional[Delivery]:
+        try:
+            content = b''.join(self._log_storage.fetch_stream(f'{domain}/delivery'))
+        except ObjectDoesNotExistError:
+            return None
+
+        delivery = from_json(content.decode('utf-8'))
+        return Delivery(
+            resource_id=delivery['resource_id'],
+            pending=PendingEmails(**delivery['pending']),
+            email_ids=delivery['email_ids'],
+        )
+
+    def store_delivery(self, delivery: Delivery):
+        content = to_json(dict(delivery._asdict(), pending=delivery.pending._asdict())).encode('utf-8')
+        self._log_storage.store_stream(f'{delivery.pending.domain}/delivery', iter([content]))
+
+    def delete_delivery(self, domain: str):
+        self._log_storage.delete(f'{domain}/delivery')
+
+    def delete_prefix(self, prefix: str, on_progress: Optional[Callable[[int], None]] = None) -> int:
+        num_deleted = self._log_storage.delete_prefix(prefix, on_progress)
+        if self._legacy_storage is not None:
+            num_deleted += self._legacy_storage.delete_prefix(prefix, on_progress)
+        return num_deleted
+
+    def migrate(self, legacy_storage: AzureTextStorage, on_progress: Optional[Callable[[int], None]] = None) -> int:
+        resource_ids = []
+        for resource_id in legacy_storage.iter():
+            domain, email_id = resource_id.split('/', 1)
+            self.enqueue(domain, email_id)
+            resource_ids.append(resource_id)
+
+        return legacy_storage.delete_many(resource_ids, on_progress)
+
+    def _append(self, domain: str, email_ids: List[str], estimates: Dict[str, List[int]]):
+        segment = self._clock().strftime(self._segment_format)
+
+        # the estimated size and priority of an email let a part be chosen without fetching the email
+        lines = []
+        for email_id in email_ids:
+            estimate = estimates.get(email_id)
+            lines.append(f'{email_id} {estimate[0]} {estimate[1]}\n' if estimate else f'{email_id}\n')
+        content = ''.join(lines).encode('utf-8')
+        self._log_storage.append_bytes(f'{domain}/segments/{segment}', content)
+
+    def _fetch_watermark(self, domain: str) -> Dict[str, int]:
+        try:
+            return from_json(b''.join(self._log_storage.fetch_stream(f'{domain}/watermark')).decode('utf-8'))
+        except ObjectDoesNotExistError:
+            return {}
+
+
+class AzureBundleStorage(LogMixin):
+    _segment_format = '%Y%m%d%H'
+    _compaction_age = timedelta(hours=2)
+
+    def __init__(self,
+                 log_storage: AzureFileStorage,
+                 compression_level: int = AzureObjectsStorage._compression_level,
+                 clock: Callable[[], datetime] = datetime.utcnow):
+        self._log_storage = log_storage
+        self._codec = ZstdCodec(level=compression_level)
+        self._clock = clock
+
+    def access_info(self) -> AccessInfo:
+        return self._log_storage.access_info()
+
+    def ensure_exists(self):
+        return self._log_storage.ensure_exists()
+
+    def compress(self, content: bytes) -> bytes:
+        return self._codec.compress(content)
+
+    def add(self,
+            domains: Iterable[str],
+            email_id: str,
+            content: bytes,
+            priority: int = 0,
+            attachments: Iterable[Tuple[str, bytes]] = ()):
+
+        records = []
+        attachment_ids = []
+        for attachment_id, attachment_content in attachments:
+            records.append(self._record({'type': 'attachment', 'id': attachment_id}, attachment_content))
+            attachment_ids.append(attachment_id)
+
+        records.append(self._record({'id': email_id, 'priority': priority, 'attachments': attachment_ids}, content))
+        record = b''.join(records)
+
+        segment = self._clock().strftime(self._segment_format)
+        for domain in domains:
+            self._log_storage.append_bytes(f'{domain}/segments/{segment}', record)
+
+    def _record(self, meta: dict, content: bytes) -> bytes:
+        frame = self.compress(content)
+
+        # each compressed email or attachment is preceded by a zstd skippable frame describing it
+        meta = dict(meta, size=len(content), length=len(frame))
+        meta_bytes = to_json(meta).encode('utf-8')
+        return pack('<II', _SKIPPABLE_FRAME_MAGIC, len(meta_bytes)) + meta_bytes + frame
+
+    def fetch(self, domain: str, email_ids: Iterable[str]) -> PrebuiltBundle:
+        wanted = set(email_ids)
+        watermark = self._fetch_watermark(domain)
+
+        emails = []
+        attachments: Dict[str, BundledAttachment] = {}
+        for segment, size in self._log_storage.iter_sizes(f'{domain}/segments/'):
+            offset = watermark.get(segment, 0)
+            if size <= offset:
+                continue
+
+            content = self._log_storage.fetch_bytes_from(f'{domain}/segments/{segment}', offset)
+            for record, _ in self._parse_records(content):
+                if isinstance(record, BundledAttachment):
+                    attachments.setdefault(record.attachment_id, record)
+                elif record.email_id in wanted:
+                    wanted.discard(record.email_id)
+                    emails.append(record)
+
+        referenced = {attachment_id for email in emails for attachment_id in email.attachment_ids}
+        attachments = {
+            attachment_id: attachment
+            for attachment_id, attachment in attachments.items() if attachment_id in referenced
+        }
+
+        return PrebuiltBundle(domain=domain, emails=emails, attachments=attachments)
+
+    def acknowledge(self, domain: str, pending_email_ids: Iterable[str]):
+        pending = set(pending_email_ids)
+        previous_watermark = self._fetch_watermark(domain)
+        cutoff = (self._clock() - self._compaction_age).strftime(self._segment_format)
+
+        watermark = {}
+        drained = []
+        for segment, size in self._log_storage.iter_sizes(f'{domain}/segments/'):
+            offset = previous_watermark.get(segment, 0)
+
+            # the watermark moves past emails that are no longer pending and the attachments stored before them,
+            # emails that are bundled while this runs may be skipped too and are then compressed on demand
+            if size > offset:
+                content = self._log_storage.fetch_bytes_from(f'{domain}/segments/{segment}', offset)
+                settled = 0
+                for record, end in self._parse_records(content):
+                    if isinstance(record, BundledEmail):
+                        if record.email_id in pending:
+                            break
+                        settled = end
+                offset += settled
+
+            watermark[segment] = offset
+            if segment < cutoff and offset >= size:
+                drained.append(segment)
+
+        if watermark == previous_watermark and not drained:
+            return
+
+        # drained segments are deleted before the watermark forgets them, like for pending emails
+        num_deleted = self._log_storage.delete_many(f'{domain}/segments/{segment}' for segment in drained)
+
+        watermark = {segment: offset for segment, offset in watermark.items() if segment not in drained}
+        self._log_storage.store_stream(f'{domain}/watermark', iter([to_json(watermark).encode('utf-8')]))
+        self.log_debug('deleted %d delivered bundle segments for %s', num_deleted, domain)
+
+    def delete_prefix(self, prefix: str, on_progress: Optional[Callable[[int], None]] = None) -> int:
+        return self._log_storage.delete_prefix(prefix, on_progress)
+
+    @classmethod
+    def _parse_records(cls, content: bytes) -> Iterator[Tuple[Union[BundledEmail, BundledAttachment], int]]:
+        offset = 0
+        while offset + 8 <= len(content):
+            magic, meta_length = unpack_from('<II', content, offset)
+            if magic != _SKIPPABLE_FRAME_MAGIC:
+                raise ValueError(f'Corrupt bundle record at offset {offset}')
+
+            start = offset + 8 + meta_length
+            if start > len(content):
+                break
+
+            meta = from_json(content[offset + 8:start].decode('utf-8'))
+            end = start + meta['length']
+            if end > len(content):
+                break
+
+            frame = content[start:end]
+            if meta.get('type') == 'attachment':
+                yield BundledAttachment(meta['id'], meta['size'], frame), end
+            else:
+                attachment_ids = meta.get('attachments', [])
+                yield BundledEmail(meta['id'], meta.get('priority', 0), meta['size'], frame, attachment_ids), end
+            offset = end
+
+    def _fetch_watermark(self, domain: str) -> Dict[str, int]:
+        try:
+            return from_json(b''.join(self._log_storage.fetch_stream(f'{domain}/watermark')).decode('utf-8'))
+        except ObjectDoesNotExistError:
+            return {}
+
+
+def new_segment_id() -> str:
+    return f'{time_ns():020d}{uuid4().hex[:8]}'
+
+
+class AzureMailboxIndex(LogMixin):
+
+    def __init__(self,
+                 segment_storage: AzureObjectStorage,
+                 max_segments: int = 8,
+                 max_segment_entries: int = 1000,
+                 segment_id_source: Callable[[], str] = new_segment_id):
+        self._segment_storage = segment_storage
+        self._max_segments = max_segments
+        self._max_segment_entries = max_segment_entries
+        self._segment_id_source = segment_id_source
+
+    def access_info(self) -> AccessInfo:
+        return self._segment_storage.access_info()
+
+    def ensure_exists(self):
+        return self._segment_storage.ensure_exists()
+
+    def add(self, mailbox: str, entries: Iterable[MailboxEntry]):
+        entries = sorted(entries, key=lambda entry: entry.sort_key)
+        if not entries:
+            return
+
+        for start in range(0, len(entries), self._max_segment_entries):
+            self._write_segment(mailbox, entries[start:start + self._max_segment_entries], [])
+        self.merge(mailbox, self._max_segments)
+
+    def delete(self, mailbox: str, email_ids: Iterable[str]):
+        tombstones = sorted(email_ids)
+        if not tombstones:
+            return
+
+        self._write_segment(mailbox, [], tombstones)
+        self.merge(mailbox, self._max_segments)
+
+    def list_page(self, mailbox: str, page_size: int, cursor: Optional[str] = None) -> MailboxPage:
+        segments = self._list_segments(mailbox)
+
+        # tombstones are keyed by email id so they are read for every page, segments with entries
+        # are only read once the page reaches the first sort key that they hold
+        selected = [segment for segment in segments if segment.first_key is None]
+        candidates = [segment for segment in segments if segment.last_key is not None]
+        if cursor is not None:
+            candidates = [segment for segment in candidates if segment.last_key > cursor]
+        candidates.sort(key=lambda segment: segment.first_key)
+
+        fetched: Dict[str, dict] = {}
+        while True:
+            # sort keys are derived from the email, so no unread segment holds an entry
+            # that sorts before the first key of the next candidate
+            bound = candidates[0].first_key if candidates else None
+            entries = self._read(mailbox, sorted(selected, key=lambda segment: segment.segment_id, reverse=True),
+                                 fetched)
+            if cursor is not None:
+                entries = [entry for entry in entries if entry.sort_key > cursor]
+            if bound is None or sum(1 for entry in entries if entry.sort_key < bound) > page_size:
+                break
+            selected.append(candidates.pop(0))
+
+        page = entries[:page_size]
+        next_cursor = page[-1].sort_key if len(entries) > page_size else None
+        return MailboxPage(entries=page, cursor=next_cursor)
+
+    def merge(self, mailbox: str, max_segments: int = 1):
+        # segments are compacted in tiers: once a level holds more than max_segments runs, they are
+        # merged into one run of the next level, so an entry is only rewritten once per level
+        segments = self._list_segments(mailbox)
+        level = 0
+        while len({self._run_of(segment) for segment in segments if self._level_of(segment) == level}) > max_segments:
+            segments = self._merge_level(mailbox, segments, level)
+            level += 1
+
+    def _merge_level(self, mailbox: str, segments: List[MailboxSegment], level: int) -> List[MailboxSegment]:
+        inputs = [segment for segment in segments if self._level_of(segment) == level]
+        others = [segment for segment in segments if self._level_of(segment) != level]
+
+        # runs of higher levels only hold older entries, so tombstones have to be kept until
+        # they are merged into the oldest level; the merged run sorts right after its newest
+        # input so that segments written concurrently still take precedence over it, and each
+        # of its segments holds a bounded range of sort keys so that a page only reads a few
+        tombstones: Set[str] = set()
+        entries = self._read(mailbox, inputs, {}, tombstones)
+        if not any(self._level_of(segment) > level for segment in others):
+            tombstones.clear()
+        tombstones.difference_update(entry.email_id for entry in entries)
+
+        run = f'{inputs[0].segment_id.partition("-")[0]}-m{level + 1:02d}'
+        num_chunks = 0
+        for start in range(0, len(entries), self._max_segment_entries):
+            chunk = entries[start:start + self._max_segment_entries]
+            others.append(self._write_segment(mailbox, chunk, [], f'{run}-{num_chunks:04d}'))
+            num_chunks += 1
+        if tombstones:
+            others.append(self._write_segment(mailbox, [], sorted(tombstones), f'{run}-{num_chunks:04d}'))
+
+        self._segment_storage.delete_many(f'{mailbox}/{self._segment_name(segment)}' for segment in inputs)
+        self.log_debug('merged %d segments of %s into level %d', len(inputs), mailbox, level + 1)
+        return sorted(others, key=lambda segment: segment.segment_id, reverse=True)
+
+    def delete_prefix(self, prefix: str, on_progress: Optional[Callable[[int], None]] = None) -> int:
+        return self._segment_storage.delete_prefix(prefix, on_progress)
+
+    def iter_recent_email_ids(self, prefix: Optional[str] = None) -> Iterator[str]:
+        # segment ids start with the time they were written, so reading the segments of all
+        # mailboxes newest first yields the most recently indexed emails first
+        names = [name for name in self._segment_storage.iter(prefix) if '~' in name]
+        names.sort(key=lambda name: name.rsplit('/', 1)[-1], reverse=True)
+
+        for name in names:
+            segment = self._segment_storage.fetch_object(f'{prefix or ""}{name}')
+            for _, email_id, _ in sorted(segment['entries']):
+                yield email_id
+
+    def _list_segments(self, mailbox: str) -> List[MailboxSegment]:
+        segments = []
+        for name in self._segment_storage.iter(f'{mailbox}/'):
+            segment_id, _, key_range = name.partition('~')
+            first_key, _, last_key = key_range.partition('~')
+            segments.append(
+                MailboxSegment(
+                    segment_id=segment_id,
+                    first_key=bytes.fromhex(first_key).decode('utf-8') if key_range else None,
+                    last_key=bytes.fromhex(last_key).decode('utf-8') if key_range else None,
+                ))
+        return sorted(segments, key=lambda segment: segment.segment_id, reverse=True)
+
+    def _read(self,
+              mailbox: str,
+              segments: List[MailboxSegment],
+              fetched: Dict[str, dict],
+              tombstones: Optional[Set[str]] = None) -> List[MailboxEntry]:
+        names = [self._segment_name(segment) for segment in segments]
+        missing = [name for name in names if name not in fetched]
+        fetched.update(zip(missing, self._segment_storage.fetch_many_objects(f'{mailbox}/{name}' for name in missing)))
+
+        seen: Set[str] = set()
+        entries = []
+        for name in names:
+            segment = fetched[name]
+            for sort_key, email_id, summary in segment['entries']:
+                if email_id not in seen:
+                    entries.append(MailboxEntry(sort_key, email_id, summary))
+            seen.update(email_id for _, email_id, _ in segment['entries'])
+            seen.update(segment['tombstones'])
+            if tombstones is not None:
+                tombstones.update(segment['tombstones'])
+
+        entries.sort(key=lambda entry: entry.sort_key)
+        return entries
+
+    def _write_segment(self,
+                       mailbox: str,
+                       entries: List[MailboxEntry],
+                       tombstones: List[str],
+                       segment_id: Optional[str] = None) -> MailboxSegment:
+        segment_id = segment_id or self._segment_id_source()
+        first_key = entries[0].sort_key if entries else None
+        last_key = entries[-1].sort_key if entries else None
+        segment = MailboxSegment(segment_id, first_key, last_key)
+        content = {'entries': [list(entry) for entry in entries], 'tombstones': tombstones}
+        self._segment_storage.store_object(f'{mailbox}/{self._segment_name(segment)}', content)
+        return segment
+
+    @classmethod
+    def _level_of(cls, segment: MailboxSegment) -> int:
+        # merged segments are named <newest input>-m<level>-<index>, written segments have no level
+        _, _, level = segment.segment_id.partition('-m')
+        return int(level.split('-')[0]) if level else 0
+
+    @classmethod
+    def _run_of(cls, segment: MailboxSegment) -> str:
+        return segment.segment_id.rsplit('-', 1)[0] if cls._level_of(segment) else segment.segment_id
+
+    @classmethod
+    def _segment_name(cls, segment: MailboxSegment) -> str:
+        if segment.first_key is None:
+            return segment.segment_id
+
+        # the key range is hex encoded since the names of some containers are lowercased
+        first_key = segment.first_key.encode('utf-8').hex()
+        last_key = segment.last_key.encode('utf-8').hex()
+        return f'{segment.segment_id}~{first_key}~{last_key}'
@@ -0,0 +1,183 @@
+from bz2 import BZ2Compressor
+from contextlib import contextmanager
+from io import BufferedReader
+from io import RawIOBase
+from lzma import LZMACompressor
+from tarfile import BLOCKSIZE
+from tarfile import DEFAULT_FORMAT
+from tarfile import NUL
+from tarfile import RECORDSIZE
+from tarfile import TarFile
+from tarfile import TarInfo
+from tarfile import open as tarfile_open
+from time import time
+from typing import IO
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+from zlib import DEFLATED
+from zlib import MAX_WBITS
+from zlib import compressobj
+
+from zstandard import ZstdCompressor
+from zstandard import ZstdDecompressor
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _Uncompressed:
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+
+_COMPRESSORS: Dict[str, Callable[[Optional[int]], Any]] = {
+    'tar': lambda level: _Uncompressed(),
+    'gz': lambda level: compressobj(level or 9, DEFLATED, 16 + MAX_WBITS),
+    'bz2': lambda level: BZ2Compressor(level or 9),
+    'xz': lambda level: LZMACompressor(),
+    'zstd': lambda level: ZstdCompressor(level=level or 3).compressobj(),
+    'zst': lambda level: ZstdCompressor(level=level or 3).compressobj(),
+}
+
+
+class _ChunksReader(RawIOBase):
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+
+        num_bytes = min(len(buffer), len(self._chunk))
+        buffer[:num_bytes] = self._chunk[:num_bytes]
+        self._chunk = self._chunk[num_bytes:]
+        return num_bytes
+
+
+def open_chunks(chunks: Iterable[bytes]) -> BufferedReader:
+    return BufferedReader(_ChunksReader(chunks), CHUNK_SIZE)
+
+
+def can_stream(compression: str) -> bool:
+    return compression in _COMPRESSORS
+
+
+def _tar_header(name: str, size: int) -> bytes:
+    tarinfo = TarInfo(name)
+    tarinfo.size = size
+    tarinfo.mtime = int(time())
+    return tarinfo.tobuf(DEFAULT_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def _tar_padding(size: int) -> bytes:
+    _, padding = divmod(size, BLOCKSIZE)
+    if padding > 0:
+        return NUL * (BLOCKSIZE - padding)
+    return b''
+
+
+def _tar_end(num_bytes: int) -> bytes:
+    end = NUL * (2 * BLOCKSIZE)
+
+    _, padding = divmod(num_bytes + len(end), RECORDSIZE)
+    if padding > 0:
+        end += NUL * (RECORDSIZE - padding)
+
+    return end
+
+
+def stream_tar(name: str, fobj: IO[bytes], size: int, compression: str, level: Optional[int] = None) -> Iterator[bytes]:
+    return stream_tar_members([(name, fobj, size)], compression, level)
+
+
+def stream_tar_members(members: Iterable[Tuple[str, IO[bytes], int]],
+                       compression: str,
+                       level: Optional[int] = None,
+                       zstd_compressor: Optional[ZstdCompressor] = None) -> Iterator[bytes]:
+
+    if zstd_compressor is not None and compression in ('zstd', 'zst'):
+        compressor = zstd_compressor.compressobj()
+    else:
+        compressor = _COMPRESSORS[compression](level)
+
+    def write(data: bytes) -> Iterator[bytes]:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+
+    num_bytes = 0
+    for name, fobj, size in members:
+        header = _tar_header(name, size)
+        yield from write(header)
+
+        remaining = size
+        while remaining > 0:
+            chunk = fobj.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError(f'Expected {size} bytes for {name} but got {size - remaining}')
+            remaining -= len(chunk)
+            yield from write(chunk)
+
+        padding = _tar_padding(size)
+        yield from write(padding)
+        num_bytes += len(header) + size + len(padding)
+
+    yield from write(_tar_end(num_bytes))
+
+    flushed = compressor.flush()
+    if flushed:
+        yield flushed
+
+
+FramesMember = Tuple[str, Iterable[bytes], int]
+
+
+def stream_tar_frames(members: Iterable[FramesMember], level: Optional[int] = None) -> Iterator[bytes]:
+    # zstd frames decompress to the concatenation of their contents, so content that was
+    # compressed ahead of time only needs compressed tar headers and padding around it
+    compressor = ZstdCompressor(level=level or 3)
+
+    num_bytes = 0
+    for name, frames, size in members:
+        header = _tar_header(name, size)
+        yield compressor.compress(header)
+        yield from frames
+
+        padding = _tar_padding(size)
+        if padding:
+            yield compressor.compress(padding)
+        num_bytes += len(header) + size + len(padding)
+
+    yield compressor.compress(_tar_end(num_bytes))
+
+
+@contextmanager
+def open_tar_stream(chunks: Iterable[bytes], compression: str) -> Iterator[TarFile]:
+    fobj: Any = open_chunks(chunks)
+
+    if compression in ('zstd', 'zst'):
+        fobj = ZstdDecompressor().stream_reader(fobj)
+        mode = 'r|'
+    elif compression == 'tar':
+        mode = 'r|'
+    else:
+        mode = f'r|{compression}'
+
+    with tarfile_open(fileobj=fobj, mode=mode) as archive:
+        yield archive
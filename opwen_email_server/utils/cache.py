@@ -0,0 +1,178 @@
+from collections import Counter
+from collections import OrderedDict
+from contextlib import suppress
+from hashlib import sha256
+from os import listdir
+from os import makedirs
+from os import replace
+from os import stat
+from os.path import join
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from opwen_email_server.utils.temporary import remove_if_exists
+
+
+class BytesCache:
+    name = ''
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError  # pragma: no cover
+
+    def put(self, key: str, value: bytes) -> None:
+        raise NotImplementedError  # pragma: no cover
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError  # pragma: no cover
+
+
+class MemoryBytesCache(BytesCache):
+    name = 'memory'
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self._max_bytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = value
+            self._num_bytes += len(value)
+
+            while self._num_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= len(evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str) -> None:
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._num_bytes -= len(value)
+
+
+class DiskBytesCache(BytesCache):
+    name = 'disk'
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+
+        # files are only stat'ed on startup, after that the order of use is tracked in memory
+        makedirs(self._root, exist_ok=True)
+        self._sizes: 'OrderedDict[str, int]' = OrderedDict()
+        for name, size, _ in sorted(self._scan(), key=lambda entry: entry[2]):
+            self._sizes[name] = size
+        self._num_bytes = sum(self._sizes.values())
+
+    def get(self, key: str) -> Optional[bytes]:
+        name = self._name_for(key)
+        try:
+            with open(join(self._root, name), 'rb') as fobj:
+                value = fobj.read()
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            if name in self._sizes:
+                self._sizes.move_to_end(name)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self._max_bytes:
+            return
+
+        name = self._name_for(key)
+        with NamedTemporaryFile(dir=self._root, prefix='.', delete=False) as fobj:
+            fobj.write(value)
+        replace(fobj.name, join(self._root, name))
+
+        evicted = []
+        with self._lock:
+            self._num_bytes += len(value) - self._sizes.pop(name, 0)
+            self._sizes[name] = len(value)
+            while self._num_bytes > self._max_bytes:
+                evicted_name, evicted_size = self._sizes.popitem(last=False)
+                self._num_bytes -= evicted_size
+                evicted.append(evicted_name)
+
+        for evicted_name in evicted:
+            remove_if_exists(join(self._root, evicted_name))
+
+    def delete(self, key: str) -> None:
+        name = self._name_for(key)
+        with self._lock:
+            self._num_bytes -= self._sizes.pop(name, 0)
+        remove_if_exists(join(self._root, name))
+
+    def _scan(self) -> Iterable[Tuple[str, int, float]]:
+        for name in listdir(self._root):
+            if name[0] == '.':
+                continue
+            with suppress(FileNotFoundError):
+                stats = stat(join(self._root, name))
+                yield name, stats.st_size, stats.st_mtime
+
+    @classmethod
+    def _name_for(cls, key: str) -> str:
+        return sha256(key.encode('utf-8')).hexdigest()
+
+
+class TieredBytesCache(BytesCache):
+    name = 'tiered'
+
+    def __init__(self, *tiers: BytesCache) -> None:
+        self._tiers = tiers
+        self._stats: Counter = Counter()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        for i, tier in enumerate(self._tiers):
+            value = tier.get(key)
+            if value is not None:
+                self._count(f'hits_{tier.name}')
+                for faster_tier in self._tiers[:i]:
+                    faster_tier.put(key, value)
+                return value
+
+        self._count('misses')
+        return None
+
+    def put(self, key: str, value: bytes) -> None:
+        for tier in self._tiers:
+            tier.put(key, value)
+
+    def delete(self, key: str) -> None:
+        for tier in self._tiers:
+            tier.delete(key)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hits'] = sum(count for name, count in stats.items() if name.startswith('hits_'))
+        stats.setdefault('misses', 0)
+        return stats
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
@@ -0,0 +1,228 @@
+from collections import namedtuple
+from gzip import GzipFile
+from io import BufferedReader
+from threading import local
+from typing import IO
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from zlib import DEFLATED
+from zlib import MAX_WBITS
+from zlib import compressobj
+
+from zstandard import CONTENTSIZE_UNKNOWN
+from zstandard import ZstdCompressionDict
+from zstandard import ZstdCompressionParameters
+from zstandard import ZstdCompressor
+from zstandard import ZstdDecompressor
+from zstandard import get_frame_parameters
+from zstandard import train_dictionary
+
+from opwen_email_server.utils.archive import CHUNK_SIZE
+from opwen_email_server.utils.concurrency import available_cpus
+from opwen_email_server.utils.serialization import gunzip_bytes
+from opwen_email_server.utils.serialization import gzip_bytes
+
+
+class Codec:
+    extension = ''
+    magic = b''
+
+    def compress(self, content: bytes) -> bytes:
+        raise NotImplementedError  # pragma: no cover
+
+    def decompress(self, compressed: bytes) -> bytes:
+        raise NotImplementedError  # pragma: no cover
+
+    def compress_stream(self, fobj: IO[bytes], size: int = -1) -> Iterator[bytes]:
+        raise NotImplementedError  # pragma: no cover
+
+    def decompress_stream(self, fobj: BufferedReader) -> IO[bytes]:
+        raise NotImplementedError  # pragma: no cover
+
+    def matches(self, compressed: bytes) -> bool:
+        return compressed.startswith(self.magic)
+
+
+class GzipCodec(Codec):
+    extension = 'gz'
+    magic = b'\x1f\x8b'
+
+    def compress(self, content: bytes) -> bytes:
+        return gzip_bytes(content)
+
+    def decompress(self, compressed: bytes) -> bytes:
+        return gunzip_bytes(compressed)
+
+    def compress_stream(self, fobj: IO[bytes], size: int = -1) -> Iterator[bytes]:
+        compressor = compressobj(9, DEFLATED, 16 + MAX_WBITS)
+        for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def decompress_stream(self, fobj: BufferedReader) -> IO[bytes]:
+        return GzipFile(fileobj=fobj, mode='rb')  # type: ignore
+
+
+class ZstdCodec(Codec):
+    extension = 'zst'
+    magic = b'\x28\xb5\x2f\xfd'
+
+    def __init__(self, level: int = 3, dictionaries: Sequence[bytes] = ()) -> None:
+        self._level = level
+        self._dictionaries: Dict[int, ZstdCompressionDict] = {}
+        self._dictionary: Optional[ZstdCompressionDict] = None
+        self._local = local()
+
+        for i, dictionary_bytes in enumerate(dictionaries):
+            dictionary = ZstdCompressionDict(dictionary_bytes)
+            self._dictionaries[dictionary.dict_id()] = dictionary
+            if i == 0:
+                self._dictionary = dictionary
+
+    def compress(self, content: bytes) -> bytes:
+        return self._compressor().compress(content)
+
+    def decompress(self, compressed: bytes) -> bytes:
+        parameters = get_frame_parameters(compressed)
+        decompressor = self._decompressor(parameters.dict_id)
+        # streamed frames of unknown size don't record their content size
+        if parameters.content_size == CONTENTSIZE_UNKNOWN:
+            return decompressor.decompressobj().decompress(compressed)
+        return decompressor.decompress(compressed)
+
+    def compress_stream(self, fobj: IO[bytes], size: int = -1) -> Iterator[bytes]:
+        return self._compressor().read_to_iter(fobj, size=size, read_size=CHUNK_SIZE)
+
+    def decompress_stream(self, fobj: BufferedReader) -> IO[bytes]:
+        # the frame header holds the dictionary id and is at most 18 bytes long
+        dictionary_id = get_frame_parameters(fobj.peek(18)).dict_id
+        return BufferedReader(self._decompressor(dictionary_id).stream_reader(fobj), CHUNK_SIZE)  # type: ignore
+
+    # zstandard (de)compressors must not be shared between threads
+    def _compressor(self) -> ZstdCompressor:
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = ZstdCompressor(level=self._level, dict_data=self._dictionary)
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, dictionary_id: int) -> ZstdDecompressor:
+        decompressors = getattr(self._local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = {}
+            self._local.decompressors = decompressors
+
+        decompressor = decompressors.get(dictionary_id)
+        if decompressor is None:
+            if dictionary_id and dictionary_id not in self._dictionaries:
+                raise ValueError(f'Missing zstd dictionary {dictionary_id}')
+            decompressor = ZstdDecompressor(dict_data=self._dictionaries.get(dictionary_id))
+            decompressors[dictionary_id] = decompressor
+        return decompressor
+
+
+ZstdSettings = namedtuple('ZstdSettings', ['level', 'threads', 'long_distance'])
+
+
+class ZstdPolicy:
+    # rough single-threaded zstd throughput in bytes per second at each level; the levels
+    # above 15 cost many times more CPU for a few percent of smaller output
+    _throughputs = {
+        1: 500e6,
+        2: 400e6,
+        3: 350e6,
+        4: 300e6,
+        5: 130e6,
+        6: 110e6,
+        7: 100e6,
+        8: 85e6,
+        9: 70e6,
+        10: 55e6,
+        11: 45e6,
+        12: 40e6,
+        13: 30e6,
+        14: 27e6,
+        15: 25e6,
+        16: 12e6,
+        17: 10e6,
+        18: 7e6,
+        19: 5e6,
+        20: 4e6,
+        21: 3e6,
+        22: 2e6,
+    }
+
+    def __init__(self,
+                 max_level: int = 15,
+                 threads: int = -1,
+                 cpu_budget_seconds: float = 2.0,
+                 long_distance_bytes: int = 64 * 1024 * 1024) -> None:
+
+        self._max_level = max_level
+        self._threads = threads
+        self._cpu_budget_seconds = cpu_budget_seconds
+        self._long_distance_bytes = long_distance_bytes
+
+    def settings(self, num_bytes: int) -> ZstdSettings:
+        threads = available_cpus() if self._threads < 0 else self._threads
+
+        # worker threads only shorten the wall-clock time, the compressor burns the same
+        # amount of CPU for a level however many threads share the work
+        level = 1
+        for candidate in range(2, self._max_level + 1):
+            if num_bytes > self._throughputs[candidate] * self._cpu_budget_seconds:
+                break
+            level = candidate
+
+        long_distance = 0 < self._long_distance_bytes <= num_bytes
+
+        return ZstdSettings(level=level, threads=threads, long_distance=long_distance)
+
+    def compressor(self,
+                   num_bytes: int,
+                   dictionary: Optional[ZstdCompressionDict] = None,
+                   settings: Optional[ZstdSettings] = None) -> ZstdCompressor:
+
+        settings = settings or self.settings(num_bytes)
+
+        params = ZstdCompressionParameters.from_level(
+            settings.level,
+            source_size=num_bytes,
+            dict_size=len(dictionary) if dictionary is not None else 0,
+            threads=settings.threads,
+            enable_ldm=settings.long_distance,
+            write_dict_id=True,
+        )
+
+        return ZstdCompressor(compression_params=params, dict_data=dictionary)
+
+
+def sniff_codec(compressed: bytes, codecs: Iterable[Codec]) -> Codec:
+    for codec in codecs:
+        if codec.matches(compressed):
+            return codec
+    raise ValueError('Unable to detect compression format')
+
+
+def train_zstd_dictionary(samples: List[bytes], size: int = 16 * 1024) -> bytes:
+    return train_dictionary(size, list(samples)).as_bytes()
+
+
+def load_codec(name: str, dictionary_paths: Iterable[str] = ()) -> Codec:
+    if name == GzipCodec.extension:
+        return GzipCodec()
+
+    if name in (ZstdCodec.extension, 'zstd'):
+        dictionaries = []
+        for path in dictionary_paths:
+            with open(path, 'rb') as fobj:
+                dictionaries.append(fobj.read())
+        return ZstdCodec(dictionaries=dictionaries)
+
+    raise ValueError(f'Unknown codec {name}')
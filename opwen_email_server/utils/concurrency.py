@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+from os.path import join
+from typing import Callable
+from typing import Deque
+from typing import Iterable
+from typing import Iterator
+from typing import TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def ordered_map(func: Callable[[T], R], iterable: Iterable[T], max_workers: int) -> Iterator[R]:
+    if max_workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    max_in_flight = 2 * max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: Deque[Future] = deque()
+        try:
+            for item in iterable:
+                in_flight.append(executor.submit(func, item))
+                if len(in_flight) >= max_in_flight:
+                    yield in_flight.popleft().result()
+
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def available_cpus(cgroup_root: str = '/sys/fs/cgroup') -> int:
+    # a container sees all the cpus of its host, so its cpu limit is read from the cgroup
+    # quota, first in the cgroup v2 layout and then in the v1 layout
+    quotas = (
+        (join(cgroup_root, 'cpu.max'), None),
+        (join(cgroup_root, 'cpu', 'cpu.cfs_quota_us'), join(cgroup_root, 'cpu', 'cpu.cfs_period_us')),
+    )
+
+    host_cpus = cpu_count() or 1
+    for quota_path, period_path in quotas:
+        try:
+            with open(quota_path) as fobj:
+                fields = fobj.read().split()
+            if period_path is not None:
+                with open(period_path) as fobj:
+                    fields.append(fobj.read().strip())
+        except OSError:
+            continue
+
+        quota, period = fields[0], fields[1]
+        if quota in ('max', '-1'):
+            return host_cpus
+        return max(1, min(host_cpus, int(quota) // int(period)))
+
+    return host_cpus
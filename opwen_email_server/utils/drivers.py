@@ -0,0 +1,96 @@
+from collections import namedtuple
+from threading import Lock
+from threading import local
+from typing import Dict
+from typing import Optional
+
+from libcloud.storage.base import StorageDriver
+from libcloud.storage.providers import get_driver
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+DriverKey = namedtuple('DriverKey', ['provider', 'account', 'host', 'secure'])
+
+
+class DriverPool:
+
+    def __init__(self, key: DriverKey, secret: str, pool_size: int) -> None:
+        self._key = key
+        self._secret = secret
+        self._pool_size = pool_size
+        self._session: Optional[Session] = None
+        self._adapter: Optional[HTTPAdapter] = None
+        self._num_drivers = 0
+        self._local = local()
+        self._lock = Lock()
+
+    @property
+    def driver(self) -> StorageDriver:
+        # libcloud drivers keep per-request state, so each thread gets its
+        # own driver while all of them share one keep-alive connection pool
+        driver = getattr(self._local, 'driver', None)
+        if driver is None:
+            driver = self._create_driver()
+            self._local.driver = driver
+        return driver
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {'drivers': self._num_drivers, 'connections': 0, 'requests': 0}
+            if self._adapter is not None:
+                pools = self._adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is not None:
+                        stats['connections'] += pool.num_connections
+                        stats['requests'] += pool.num_requests
+        return stats
+
+    def _create_driver(self) -> StorageDriver:
+        driver_class = get_driver(self._key.provider)
+        driver = driver_class(self._key.account, self._secret, host=self._key.host, secure=self._key.secure)
+
+        connection = getattr(driver.connection, 'connection', None)
+        if connection is not None:
+            connection.session = self._share_session(connection.session)
+
+        with self._lock:
+            self._num_drivers += 1
+
+        return driver
+
+    def _share_session(self, session: Session) -> Session:
+        with self._lock:
+            if self._session is None:
+                self._adapter = HTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+                session.mount('https://', self._adapter)
+                session.mount('http://', self._adapter)
+                self._session = session
+            return self._session
+
+
+class DriverRegistry:
+
+    def __init__(self, pool_size: int = 10) -> None:
+        self._pool_size = pool_size
+        self._pools: Dict[DriverKey, DriverPool] = {}
+        self._lock = Lock()
+
+    def get(self, provider: str, account: str, secret: str, host: Optional[str], secure: bool) -> StorageDriver:
+        key = DriverKey(provider=provider, account=account, host=host, secure=secure)
+
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = DriverPool(key, secret, self._pool_size)
+                self._pools[key] = pool
+
+        return pool.driver
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            pools = dict(self._pools)
+
+        return {f'{key.provider}://{key.account}@{key.host or ""}': pool.stats for key, pool in pools.items()}
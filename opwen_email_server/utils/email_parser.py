@@ -1,37 +1,86 @@
+from collections import Counter
+from collections import namedtuple
+from concurrent.futures import Executor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
 from datetime import timezone
+from email.message import Message
 from email.utils import mktime_tz
 from email.utils import parsedate_tz
-from io import BytesIO
 from itertools import chain
+from itertools import repeat
 from mimetypes import guess_type
+from os.path import splitext
+from re import Match
+from re import sub as re_sub
+from shutil import copyfileobj
+from time import monotonic
+from time import perf_counter
+from time import time
+from typing import IO
+from typing import Any
 from typing import Callable
+from typing import Dict
 from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import TypeVar
+from typing import Union
+from uuid import uuid4
 
 from bs4 import BeautifulSoup
-from PIL import Image
 from pyzmail import PyzMessage
 from pyzmail.parse import MailPart
 from requests import Response
-from requests import get as http_get
-
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from opwen_email_server.config import EMAIL_IMAGES_MAX_BYTES
+from opwen_email_server.config import IMAGE_FORMATS
+from opwen_email_server.config import IMAGE_MAX_BYTES
+from opwen_email_server.config import IMAGE_QUALITIES
+from opwen_email_server.config import INBOUND_SPOOL_BYTES
+from opwen_email_server.config import INLINE_IMAGE_CACHE_TTL_SECONDS
+from opwen_email_server.config import INLINE_IMAGE_MAX_BYTES
+from opwen_email_server.config import INLINE_IMAGE_TIMEOUT_SECONDS
+from opwen_email_server.config import INLINE_IMAGES_EMAIL_TIMEOUT_SECONDS
+from opwen_email_server.config import INLINE_IMAGES_MAX_WORKERS
 from opwen_email_server.config import MAX_HEIGHT_IMAGES
 from opwen_email_server.config import MAX_WIDTH_IMAGES
+from opwen_email_server.constants import events
 from opwen_email_server.constants import mailbox
+from opwen_email_server.utils.cache import BytesCache
+from opwen_email_server.utils.collections import singleton
+from opwen_email_server.utils.images import ImageTranscoder
+from opwen_email_server.utils.images import TranscodedImage
 from opwen_email_server.utils.log import LogMixin
+from opwen_email_server.utils.mime import MimeLeaf
+from opwen_email_server.utils.mime import read_mime_stream
+from opwen_email_server.utils.serialization import from_msgpack_bytes
 from opwen_email_server.utils.serialization import to_base64
+from opwen_email_server.utils.serialization import to_msgpack_bytes
+from opwen_email_server.utils.temporary import create_tempfilename
+from opwen_email_server.utils.temporary import remove_if_exists
+from opwen_email_server.utils.temporary import removing
+
+T = TypeVar('T')
 
+_MISSING_IMAGE = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
 
-def _parse_body(message: PyzMessage, default_charset: str = 'ascii') -> str:
+
+def _parse_body(message: PyzMessage,
+                default_charset: str = 'ascii',
+                get_payload: Callable[[MailPart], Optional[bytes]] = MailPart.get_payload) -> str:
     body_parts = (message.html_part, message.text_part)
     for part in body_parts:
         if part is None:
             continue
-        payload = part.get_payload()
+        payload = get_payload(part)
         if payload is None:
             continue
         charset = part.charset or default_charset
@@ -52,6 +101,24 @@ def _parse_attachments(mailparts: Iterable[MailPart]) -> Iterable[dict]:
             yield attachment
 
 
+def _parse_streamed_attachments(mailparts: Iterable[MailPart], leaves: Dict[Message, MimeLeaf], spool_bytes: int,
+                                on_large_attachment: Optional[Callable[[dict, MimeLeaf], dict]]) -> Iterable[dict]:
+    attachment_parts = (part for part in mailparts if not part.is_body)
+    for part in attachment_parts:
+        filename = part.sanitized_filename
+        leaf = leaves.get(part.part)
+        attachment_id = part.content_id
+        if filename and leaf is not None and leaf.size:
+            attachment = {'filename': filename}
+            if attachment_id:
+                attachment['cid'] = attachment_id
+            if on_large_attachment is not None and leaf.size > spool_bytes:
+                yield on_large_attachment(attachment, leaf)
+            else:
+                attachment['content'] = leaf.content.read()
+                yield attachment
+
+
 def _parse_addresses(message: PyzMessage, address_type: str) -> List[str]:
     return sorted(email for _, email in message.get_addresses(address_type) if email)
 
@@ -88,22 +155,120 @@ def parse_mime_email(mime_email: str) -> dict:
     }
 
 
-def format_attachments(email: dict) -> dict:
+def parse_mime_stream(mime_stream: IO[bytes],
+                      spool_bytes: int = INBOUND_SPOOL_BYTES,
+                      on_large_attachment: Optional[Callable[[dict, MimeLeaf], dict]] = None) -> dict:
+    with read_mime_stream(mime_stream, spool_bytes) as (headers, leaves):
+        message = PyzMessage(headers)
+
+        def get_payload(part: MailPart) -> Optional[bytes]:
+            leaf = leaves.get(part.part)
+            return leaf.content.read() if leaf is not None else None
+
+        return {
+            'sent_at': _parse_sent_at(message),
+            'to': _parse_addresses(message, 'to'),
+            'cc': _parse_addresses(message, 'cc'),
+            'bcc': _parse_addresses(message, 'bcc'),
+            'from': _parse_address(message, 'from'),
+            'subject': message.get_subject(),
+            'body': _parse_body(message, get_payload=get_payload),
+            'attachments': list(_parse_streamed_attachments(message.mailparts, leaves, spool_bytes,
+                                                            on_large_attachment)),
+        }
+
+
+def parse_mime_file(path: str,
+                    spool_bytes: int = INBOUND_SPOOL_BYTES,
+                    transcoder: Optional[ImageTranscoder] = None) -> dict:
+    # runs in the process pool: attachments that stay too large are handed back as files that the caller
+    # stores and removes, since the attachment store can't be sent to the pool
+    large_attachments = _LargeAttachments(transcoder or _default_image_transcoder(), spool_bytes)
+    try:
+        with open(path, 'rb') as fobj:
+            return parse_mime_stream(fobj, spool_bytes, large_attachments.spool)
+    except Exception:
+        large_attachments.remove_spooled()
+        raise
+
+
+class _LargeAttachments(LogMixin):
+
+    def __init__(self, transcoder: ImageTranscoder, spool_bytes: int) -> None:
+        self._transcoder = transcoder
+        self._spool_bytes = spool_bytes
+        self._spooled_paths: List[str] = []
+
+    def transcode(self, attachment: dict, leaf: MimeLeaf) -> Optional[dict]:
+        filename = attachment['filename']
+
+        # large images usually shrink enough to be kept with the email
+        if not _is_image_filename(filename):
+            return None
+
+        try:
+            transcoded = self._transcoder.transcode(leaf.content)
+        except Exception as ex:
+            self.log_warning('Unable to transcode attachment %s: %s', filename, ex)
+            transcoded = None
+
+        leaf.content.seek(0)
+        if transcoded is None or len(transcoded.content) > self._spool_bytes:
+            return None
+
+        return dict(attachment, filename=_with_extension(filename, transcoded), content=transcoded.content)
+
+    def spool(self, attachment: dict, leaf: MimeLeaf) -> dict:
+        transcoded = self.transcode(attachment, leaf)
+        if transcoded is not None:
+            return transcoded
+
+        path = create_tempfilename()
+        self._spooled_paths.append(path)
+        with open(path, 'wb') as fobj:
+            copyfileobj(leaf.content, fobj)
+        return dict(attachment, spooled_path=path, size=leaf.size, digest=leaf.digest)
+
+    def remove_spooled(self) -> None:
+        for path in self._spooled_paths:
+            remove_if_exists(path)
+
+
+def format_attachments(email: dict,
+                       transcoder: Optional[ImageTranscoder] = None,
+                       budget_bytes: Optional[int] = None,
+                       stats: Optional[Counter] = None,
+                       processes: Optional[Executor] = None) -> dict:
     attachments = email.get('attachments', [])
 
     if not attachments:
         return email
 
+    image_indices = [i for i, attachment in enumerate(attachments) if _is_image_attachment(attachment)]
+    if not image_indices:
+        return email
+
+    transcoder = transcoder or _default_image_transcoder()
+    if budget_bytes is None:
+        budget_bytes = transcoder.budget_for(len(image_indices))
+
+    images = (attachments[i]['content'] for i in image_indices)
+    if processes is not None:
+        transcoded_images = processes.map(transcoder.transcode, images, repeat(budget_bytes))
+    else:
+        transcoded_images = map(transcoder.transcode, images, repeat(budget_bytes))
+
     formatted_attachments = deepcopy(attachments)
     is_any_attachment_changed = False
 
-    for i, attachment in enumerate(attachments):
-        filename = attachment.get('filename', '')
-        content = attachment.get('content', b'')
-        formatted_content = _format_attachment(filename, content)
+    for i, transcoded in zip(image_indices, transcoded_images):
+        filename = attachments[i].get('filename', '')
+        content = attachments[i]['content']
+        _count_transcoded(stats, len(content), len(transcoded.content))
 
-        if content != formatted_content:
-            formatted_attachments[i]['content'] = formatted_content
+        if content != transcoded.content:
+            formatted_attachments[i]['content'] = transcoded.content
+            formatted_attachments[i]['filename'] = _with_extension(filename, transcoded)
             is_any_attachment_changed = True
 
     if not is_any_attachment_changed:
@@ -114,16 +279,33 @@ def format_attachments(email: dict) -> dict:
     return new_email
 
 
-def _format_attachment(filename: str, content: bytes) -> bytes:
+def _is_image_attachment(attachment: dict) -> bool:
+    return _is_image_filename(attachment.get('filename', '')) and bool(attachment.get('content'))
+
+
+def _is_image_filename(filename: str) -> bool:
     attachment_type = guess_type(filename)[0]
+    return attachment_type is not None and 'image' in attachment_type.lower()
+
+
+def _with_extension(filename: str, transcoded: TranscodedImage) -> str:
+    if not transcoded.extension or guess_type(filename)[0] == transcoded.mimetype:
+        return filename
+    return f'{splitext(filename)[0]}.{transcoded.extension}'
 
-    if not attachment_type:
-        return content
 
-    if 'image' in attachment_type.lower():
-        content = _change_image_size(content)
+def _count_images(email: dict) -> int:
+    # counting tags in the raw markup avoids parsing the body one more time
+    num_inline_images = (email.get('body') or '').lower().count('<img')
+    num_attached_images = sum(1 for attachment in email.get('attachments') or [] if _is_image_attachment(attachment))
+    return num_inline_images + num_attached_images
 
-    return content
+
+def _count_transcoded(stats: Optional[Counter], original_bytes: int, transcoded_bytes: int) -> None:
+    if stats is not None:
+        stats['images'] += 1
+        stats['original_bytes'] += original_bytes
+        stats['transcoded_bytes'] += transcoded_bytes
 
 
 def get_recipients(email: dict) -> Iterable[str]:
@@ -138,6 +320,32 @@ def get_domain(address: str) -> str:
     return address.split('@')[-1]
 
 
+def summarize_email(email: dict, snippet_length: int = 200) -> dict:
+    body = email.get('body') or ''
+    text = ' '.join(BeautifulSoup(body, 'html.parser').get_text(' ').split())
+
+    attachments = []
+    for i, attachment in enumerate(email.get('attachments') or []):
+        attachments.append({
+            '_uid': attachment.get('_uid', i),
+            'filename': attachment.get('filename'),
+            'cid': attachment.get('cid'),
+            'size': attachment.get('size', len(attachment.get('content') or b'')),
+        })
+
+    return {
+        '_uid': email.get('_uid'),
+        'sent_at': email.get('sent_at'),
+        'to': email.get('to') or [],
+        'cc': email.get('cc') or [],
+        'bcc': email.get('bcc') or [],
+        'from': email.get('from'),
+        'subject': email.get('subject'),
+        'snippet': text[:snippet_length],
+        'attachments': attachments,
+    }
+
+
 def ensure_has_sent_at(email: dict):
     if not email.get('sent_at'):
         email['sent_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M')
@@ -150,43 +358,239 @@ def _get_image_type(response: Response, url: str) -> Optional[str]:
     return content_type
 
 
-def _is_already_small(size: Tuple[int, int]) -> bool:
-    width, height = size
-    return width <= MAX_WIDTH_IMAGES and height <= MAX_HEIGHT_IMAGES
+@singleton
+def _default_image_transcoder() -> ImageTranscoder:
+    return ImageTranscoder(
+        max_width=MAX_WIDTH_IMAGES,
+        max_height=MAX_HEIGHT_IMAGES,
+        max_image_bytes=IMAGE_MAX_BYTES,
+        max_email_bytes=EMAIL_IMAGES_MAX_BYTES,
+        formats=IMAGE_FORMATS,
+        qualities=IMAGE_QUALITIES,
+    )
 
 
-def _change_image_size(image_content_bytes: bytes) -> bytes:
-    image_bytes = BytesIO(image_content_bytes)
-    image_bytes.seek(0)
-    image = Image.open(image_bytes)
+_CachedImage = namedtuple('_CachedImage',
+                          ['image_type', 'content', 'original_size', 'expires_at', 'etag', 'last_modified'])
 
-    if _is_already_small(image.size):
-        return image_content_bytes
+_FetchedImage = namedtuple('_FetchedImage', ['encoded', 'outcome', 'original_size', 'size'])
 
-    new_size = (MAX_WIDTH_IMAGES, MAX_HEIGHT_IMAGES)
-    image.thumbnail(new_size, Image.ANTIALIAS)
-    new_image = BytesIO()
-    image.save(new_image, image.format)
-    new_image.seek(0)
-    new_image_bytes = new_image.read()
-    return new_image_bytes
 
+class InlineImageFetcher(LogMixin):
+    _chunk_size = 64 * 1024
 
-def _fetch_image_to_base64(image_url: str) -> Optional[str]:
-    response = http_get(image_url)
-    if not response.ok:
-        return None
+    def __init__(self,
+                 max_workers: int = INLINE_IMAGES_MAX_WORKERS,
+                 image_timeout_seconds: float = INLINE_IMAGE_TIMEOUT_SECONDS,
+                 email_timeout_seconds: float = INLINE_IMAGES_EMAIL_TIMEOUT_SECONDS,
+                 max_image_bytes: int = INLINE_IMAGE_MAX_BYTES,
+                 cache: Optional[BytesCache] = None,
+                 cache_ttl_seconds: int = INLINE_IMAGE_CACHE_TTL_SECONDS,
+                 transcoder: Optional[ImageTranscoder] = None) -> None:
 
-    image_type = _get_image_type(response, image_url)
-    if not image_type:
-        return None
+        self._max_workers = max_workers
+        self._image_timeout_seconds = image_timeout_seconds
+        self._email_timeout_seconds = email_timeout_seconds
+        self._max_image_bytes = max_image_bytes
+        self._cache = cache
+        self._cache_ttl_seconds = cache_ttl_seconds
+        self._transcoder = transcoder or _default_image_transcoder()
 
-    if not response.content:
-        return None
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session = Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def fetch_all(self,
+                  image_urls: Iterable[str],
+                  on_error: Callable,
+                  budget_bytes: Optional[int] = None,
+                  stats: Optional[Counter] = None,
+                  processes: Optional[Executor] = None) -> Dict[str, str]:
+
+        unique_urls = list(dict.fromkeys(image_urls))
+        if not unique_urls:
+            return {}
+
+        if budget_bytes is None:
+            budget_bytes = self._transcoder.budget_for(len(unique_urls))
+
+        deadline = monotonic() + self._email_timeout_seconds
+
+        executor = ThreadPoolExecutor(max_workers=min(self._max_workers, len(unique_urls)))
+        try:
+            futures = {executor.submit(self._fetch, url, deadline, budget_bytes, processes): url for url in unique_urls}
+            done, not_done = wait(futures, timeout=self._email_timeout_seconds)
+        finally:
+            # downloads still running notice the passed deadline on their next
+            # chunk and stop on their own so there's no need to wait for them
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        encoded_images = {}
+        outcomes: Counter = Counter()
+        for future in done:
+            image_url = futures[future]
+            try:
+                fetched = future.result()
+            except Exception as ex:
+                on_error('Unable to inline image %s: %s', image_url, ex)
+                outcomes['failed'] += 1
+            else:
+                outcomes[fetched.outcome] += 1
+                if fetched.encoded:
+                    encoded_images[image_url] = fetched.encoded
+                    _count_transcoded(stats, fetched.original_size, fetched.size)
+
+        for future in not_done:
+            on_error('Unable to inline image %s: %s', futures[future], 'email time budget exceeded')
+            outcomes['failed'] += 1
+
+        if self._cache is not None:
+            self.log_event(events.INLINE_IMAGES_FETCHED, {'images': len(unique_urls), **outcomes, **self.cache_stats})
+
+        return encoded_images
+
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        return getattr(self._cache, 'stats', {})
+
+    def _fetch(self, image_url: str, deadline: float, budget_bytes: int,
+               processes: Optional[Executor]) -> _FetchedImage:
+        cache_key = self._cache_key(image_url, budget_bytes)
+        cached = self._cache_get(cache_key)
+        if cached is not None and cached.expires_at > time():
+            return self._encode(cached, 'fresh')
+
+        timeout = min(self._image_timeout_seconds, deadline - monotonic())
+        if timeout <= 0:
+            raise TimeoutError('email time budget exceeded')
+
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+        with self._session.get(image_url, stream=True, timeout=timeout, headers=headers) as response:
+            if response.status_code == 304 and cached is not None:
+                expires_at = self._expires_at(response)
+                if expires_at is not None:
+                    etag = response.headers.get('ETag') or cached.etag
+                    self._cache_put(cache_key, cached._replace(expires_at=expires_at, etag=etag))
+                return self._encode(cached, 'revalidated')
+
+            if not response.ok:
+                return _FetchedImage(None, 'missing', 0, 0)
+
+            image_type = _get_image_type(response, image_url)
+            if not image_type:
+                return _FetchedImage(None, 'missing', 0, 0)
+
+            content = self._download(response, monotonic() + timeout)
+            if not content:
+                return _FetchedImage(None, 'missing', 0, 0)
+
+            transcoded = _run(processes, self._transcoder.transcode, content, budget_bytes)
+            fetched = _CachedImage(
+                image_type=transcoded.mimetype or image_type,
+                content=transcoded.content,
+                original_size=len(content),
+                expires_at=self._expires_at(response),
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+
+        if fetched.expires_at is not None:
+            self._cache_put(cache_key, fetched)
+
+        return self._encode(fetched, 'fetched')
+
+    def _download(self, response: Response, deadline: float) -> bytes:
+        content_length = response.headers.get('Content-Length')
+        if content_length and int(content_length) > self._max_image_bytes:
+            raise ValueError(f'image of {content_length} bytes exceeds {self._max_image_bytes} bytes')
+
+        content = bytearray()
+        for chunk in response.iter_content(self._chunk_size):
+            content.extend(chunk)
+            if len(content) > self._max_image_bytes:
+                raise ValueError(f'image exceeds {self._max_image_bytes} bytes')
+            if monotonic() > deadline:
+                raise TimeoutError('image time budget exceeded')
+
+        return bytes(content)
+
+    def _expires_at(self, response: Response) -> Optional[float]:
+        if self._cache is None:
+            return None
+
+        directives = {}
+        for directive in response.headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.partition('=')
+            directives[name.strip().lower()] = value.strip().strip('"')
+
+        # the cache is shared between all the inbound workers so responses
+        # meant for a single user's cache must not be stored in it
+        if 'no-store' in directives or 'private' in directives:
+            return None
+
+        now = time()
+
+        if 'no-cache' in directives:
+            return now
+
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    max_age = int(directives[name])
+                    age = int(response.headers.get('Age') or 0)
+                except ValueError:
+                    return now
+                return now + max_age - age
+
+        expires = response.headers.get('Expires')
+        if expires:
+            expires_tz = parsedate_tz(expires)
+            return mktime_tz(expires_tz) if expires_tz else now
+
+        return now + self._cache_ttl_seconds
+
+    def _cache_get(self, key: str) -> Optional[_CachedImage]:
+        if self._cache is None:
+            return None
+
+        try:
+            serialized = self._cache.get(key)
+        except Exception as ex:
+            self.log_warning('Unable to read cached image %s: %s', key, ex)
+            return None
+
+        if serialized is None:
+            return None
 
-    small_image_bytes = _change_image_size(response.content)
-    small_image_base64 = to_base64(small_image_bytes)
-    return f'data:{image_type};base64,{small_image_base64}'
+        return _CachedImage(**from_msgpack_bytes(serialized))
+
+    def _cache_put(self, key: str, cached: _CachedImage) -> None:
+        if self._cache is None:
+            return
+
+        try:
+            self._cache.put(key, to_msgpack_bytes(cached._asdict()))
+        except Exception as ex:
+            self.log_warning('Unable to cache image %s: %s', key, ex)
+
+    def _cache_key(self, image_url: str, budget_bytes: int) -> str:
+        return f'{self._transcoder.cache_key}/{budget_bytes}/{image_url}'
+
+    @classmethod
+    def _encode(cls, image: _CachedImage, outcome: str) -> _FetchedImage:
+        encoded = f'data:{image.image_type};base64,{to_base64(image.content)}'
+        return _FetchedImage(encoded, outcome, image.original_size, len(image.content))
+
+
+@singleton
+def _default_inline_image_fetcher() -> InlineImageFetcher:
+    return InlineImageFetcher()
 
 
 def _is_valid_url(url: Optional[str]) -> bool:
@@ -197,43 +601,180 @@ def _is_valid_url(url: Optional[str]) -> bool:
     return has_http_prefix or has_https_prefix
 
 
-def format_inline_images(email: dict, on_error: Callable) -> dict:
+def format_inline_images(email: dict,
+                         on_error: Callable,
+                         fetcher: Optional[InlineImageFetcher] = None,
+                         budget_bytes: Optional[int] = None,
+                         stats: Optional[Counter] = None,
+                         processes: Optional[Executor] = None,
+                         timings: Optional[Dict[str, float]] = None) -> dict:
     email_body = email.get('body', '')
     if not email_body:
         return email
 
-    soup = BeautifulSoup(email_body, 'html.parser')
-    image_tags = soup.find_all('img')
-    if not image_tags:
+    with _timed(timings, 'inline_html'):
+        template, placeholder, image_urls = _run(processes, _template_inline_images, email_body)
+    if not image_urls:
         return email
 
-    for image_tag in image_tags:
+    with _timed(timings, 'inline_fetch'):
+        fetcher = fetcher or _default_inline_image_fetcher()
+        encoded_images = fetcher.fetch_all(image_urls, on_error, budget_bytes, stats, processes)
+
+    with _timed(timings, 'inline_rewrite'):
+        new_email = dict(email)
+        new_email['body'] = _fill_inline_images(template, placeholder, image_urls, encoded_images)
+    return new_email
+
+
+def _template_inline_images(email_body: str) -> Tuple[str, str, List[str]]:
+    # the html is only parsed once, the image sources are swapped for
+    # placeholders that are filled in after the images were fetched
+    soup = BeautifulSoup(email_body, 'html.parser')
+    placeholder = f'lokole-inline-image-{uuid4().hex}-'
+
+    image_urls: List[str] = []
+    for image_tag in soup.find_all('img'):
         image_url = image_tag.get('src')
+        if _is_valid_url(image_url):
+            image_tag['src'] = f'{placeholder}{len(image_urls)}'
+            image_urls.append(image_url)
 
-        if not _is_valid_url(image_url):
-            continue
+    return str(soup), placeholder, image_urls
 
-        try:
-            encoded_image = _fetch_image_to_base64(image_url)
-        except Exception as ex:
-            on_error('Unable to inline image %s: %s', image_url, ex)
-        else:
-            if encoded_image:
-                image_tag['src'] = encoded_image
 
-    new_email = dict(email)
-    new_email['body'] = str(soup)
-    return new_email
+def _fill_inline_images(template: str, placeholder: str, image_urls: List[str], encoded_images: Dict[str, str]) -> str:
+
+    def fill(match: Match) -> str:
+        image_url = image_urls[int(match.group(1))]
+        # images that could not be fetched in time must not make the client go online to load them
+        return f'"{encoded_images.get(image_url) or _MISSING_IMAGE}"'
+
+    return re_sub(f'"{placeholder}(\\d+)"', fill, template)
+
+
+def _run(processes: Optional[Executor], func: Callable[..., T], *args: Any) -> T:
+    if processes is None:
+        return func(*args)
+    return processes.submit(func, *args).result()
+
+
+@contextmanager
+def _timed(timings: Optional[Dict[str, float]], stage: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + perf_counter() - start
 
 
 def descending_timestamp(email_sent_at: str) -> str:
     return str(mailbox.FUTURE_TIMESTAMP - int(datetime.fromisoformat(email_sent_at).timestamp()))
 
 
+def delivery_priority(email: dict) -> int:
+    return 1 if email.get('attachments') else 0
+
+
+def estimate_delivery_size(email: dict) -> int:
+    # attachments are base64 encoded in json lines, which makes them a third larger than in msgpack;
+    # attachments stored separately are only referenced by the email but are delivered in full
+    num_bytes = len(to_msgpack_bytes(email))
+    for attachment in email.get('attachments') or []:
+        content = attachment.get('content')
+        if content is not None:
+            num_bytes += len(content) // 3
+        else:
+            num_bytes += (attachment.get('size') or 0) * 4 // 3
+    return num_bytes
+
+
 class MimeEmailParser(LogMixin):
 
-    def __call__(self, mime_email: str) -> dict:
-        email = parse_mime_email(mime_email)
-        email = format_attachments(email)
-        email = format_inline_images(email, self.log_warning)
+    def __init__(self,
+                 image_fetcher: Optional[InlineImageFetcher] = None,
+                 image_transcoder: Optional[ImageTranscoder] = None,
+                 processes: Optional[Executor] = None,
+                 attachment_store: Optional[Callable[[str, IO[bytes], int], str]] = None,
+                 spool_bytes: int = INBOUND_SPOOL_BYTES) -> None:
+
+        self._image_fetcher = image_fetcher
+        self._image_transcoder = image_transcoder
+        self._processes = processes
+        self._attachment_store = attachment_store
+        self._spool_bytes = spool_bytes
+
+    def __call__(self, mime_email: Union[str, IO[bytes]]) -> dict:
+        timings: Dict[str, float] = {}
+
+        with _timed(timings, 'parse'):
+            if isinstance(mime_email, str):
+                email = _run(self._processes, parse_mime_email, mime_email)
+            elif self._processes is None:
+                email = parse_mime_stream(mime_email, self._spool_bytes, self._store_large_attachment)
+            else:
+                email = self._parse_in_processes(mime_email)
+
+        transcoder = self._image_transcoder or _default_image_transcoder()
+        budget_bytes = transcoder.budget_for(_count_images(email))
+        stats: Counter = Counter()
+
+        with _timed(timings, 'attachments'):
+            email = format_attachments(email, transcoder, budget_bytes, stats, self._processes)
+
+        email = format_inline_images(email, self.log_warning, self._image_fetcher, budget_bytes, stats, self._processes,
+                                     timings)
+
+        self.log_info('Parsed email in %s (%s)',
+                      ', '.join(f'{stage}={seconds * 1000:.1f}ms' for stage, seconds in timings.items()),
+                      'process pool' if self._processes is not None else 'inline')
+
+        if stats:
+            saved_bytes = stats['original_bytes'] - stats['transcoded_bytes']
+            self.log_event(events.EMAIL_IMAGES_TRANSCODED, {**stats, 'saved_bytes': saved_bytes})
+
         return email
+
+    def _parse_in_processes(self, mime_stream: IO[bytes]) -> dict:
+        transcoder = self._image_transcoder or _default_image_transcoder()
+
+        # open streams can't be sent to the process pool, so the email is spooled to a file first
+        with removing(create_tempfilename('eml')) as path:
+            with open(path, 'wb') as fobj:
+                copyfileobj(mime_stream, fobj)
+            email = _run(self._processes, parse_mime_file, path, self._spool_bytes, transcoder)
+
+        attachments = email.get('attachments') or []
+        if not any('spooled_path' in attachment for attachment in attachments):
+            return email
+
+        attachments = [self._store_spooled_attachment(attachment) for attachment in attachments]
+        return dict(email, attachments=attachments)
+
+    def _store_spooled_attachment(self, attachment: dict) -> dict:
+        if 'spooled_path' not in attachment:
+            return attachment
+
+        attachment = dict(attachment)
+        path = attachment.pop('spooled_path')
+        digest = attachment.pop('digest')
+        size = attachment.pop('size')
+        with removing(path), open(path, 'rb') as fobj:
+            return self._store_attachment(attachment, MimeLeaf(fobj, size, digest))
+
+    def _store_large_attachment(self, attachment: dict, leaf: MimeLeaf) -> dict:
+        transcoder = self._image_transcoder or _default_image_transcoder()
+        transcoded = _LargeAttachments(transcoder, self._spool_bytes).transcode(attachment, leaf)
+        if transcoded is not None:
+            return transcoded
+
+        return self._store_attachment(attachment, leaf)
+
+    def _store_attachment(self, attachment: dict, leaf: MimeLeaf) -> dict:
+        if self._attachment_store is None:
+            return dict(attachment, content=leaf.content.read())
+
+        content_id = self._attachment_store(leaf.digest, leaf.content, leaf.size)
+        self.log_debug('Stored attachment %s of %d bytes as %s', attachment['filename'], leaf.size, content_id)
+        return dict(attachment, content_id=content_id, size=leaf.size)
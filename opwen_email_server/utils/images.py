@@ -0,0 +1,130 @@
+from collections import namedtuple
+from io import SEEK_END
+from io import BytesIO
+from typing import IO
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+from PIL import Image
+from PIL import ImageOps
+
+TranscodedImage = namedtuple('TranscodedImage', ['content', 'mimetype', 'extension'])
+
+DEFAULT_FORMATS = ('WEBP', 'JPEG')
+DEFAULT_QUALITIES = (85, 70, 55, 40, 25)
+
+
+class ImageTranscoder:
+    _extensions = {
+        'GIF': 'gif',
+        'JPEG': 'jpg',
+        'PNG': 'png',
+        'WEBP': 'webp',
+    }
+
+    def __init__(self,
+                 max_width: int = 200,
+                 max_height: int = 200,
+                 max_image_bytes: int = 50 * 1024,
+                 max_email_bytes: int = 200 * 1024,
+                 formats: Sequence[str] = DEFAULT_FORMATS,
+                 qualities: Sequence[int] = DEFAULT_QUALITIES) -> None:
+
+        Image.init()
+
+        self._max_width = max_width
+        self._max_height = max_height
+        self._max_image_bytes = max_image_bytes
+        self._max_email_bytes = max_email_bytes
+        self._formats = [image_format.upper() for image_format in formats if image_format.upper() in Image.SAVE]
+        self._qualities = qualities
+
+    @property
+    def cache_key(self) -> str:
+        formats = ','.join(self._formats)
+        qualities = ','.join(map(str, self._qualities))
+        return f'{self._max_width}x{self._max_height}/{formats}/{qualities}'
+
+    def budget_for(self, num_images: int) -> int:
+        if num_images <= 1:
+            return self._max_image_bytes
+        return min(self._max_image_bytes, self._max_email_bytes // num_images)
+
+    def transcode(self, content: Union[bytes, IO[bytes]], max_bytes: Optional[int] = None) -> TranscodedImage:
+        max_bytes = self._max_image_bytes if max_bytes is None else max_bytes
+
+        fobj = BytesIO(content) if isinstance(content, bytes) else content
+        num_bytes = fobj.seek(0, SEEK_END)
+        fobj.seek(0)
+
+        image = Image.open(fobj)
+        original_format = image.format
+
+        # re-encoding would only keep the first frame of animations
+        if getattr(image, 'is_animated', False):
+            return self._original(content, original_format)
+
+        is_small = image.width <= self._max_width and image.height <= self._max_height
+        if is_small and num_bytes <= max_bytes:
+            return self._original(content, original_format)
+
+        # shrinking first lets large jpegs be decoded at a reduced scale
+        if not is_small:
+            image.thumbnail((self._max_width, self._max_height), Image.ANTIALIAS)
+
+        # orientation is stored in the metadata which isn't kept when re-encoding
+        image = ImageOps.exif_transpose(image)
+
+        best = self._original(content, original_format) if is_small else None
+
+        # graphics like logos and icons tend to be smallest as lossless png
+        if original_format == 'PNG':
+            best = self._smallest(best, self._encode(image, 'PNG', self._qualities[0]))
+
+        for quality in self._qualities:
+            for image_format in self._formats:
+                best = self._smallest(best, self._encode(image, image_format, quality))
+
+            if best is not None and len(best.content) <= max_bytes:
+                break
+
+        return best or self._encode(image, 'PNG', self._qualities[-1])
+
+    def _encode(self, image: Image.Image, image_format: str, quality: int) -> TranscodedImage:
+        if image_format == 'JPEG':
+            image = self._flatten(image)
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if self._has_alpha(image) else 'RGB')
+
+        # only the pixels are written out, so exif, icc profiles and comments are stripped
+        buffer = BytesIO()
+        image.save(buffer, image_format, quality=quality, optimize=True, progressive=True)
+        return TranscodedImage(buffer.getvalue(), Image.MIME.get(image_format), self._extensions.get(image_format))
+
+    @classmethod
+    def _original(cls, content: Union[bytes, IO[bytes]], image_format: str) -> TranscodedImage:
+        if not isinstance(content, bytes):
+            content.seek(0)
+            content = content.read()
+        return TranscodedImage(content, Image.MIME.get(image_format), cls._extensions.get(image_format))
+
+    @classmethod
+    def _smallest(cls, best: Optional[TranscodedImage], candidate: TranscodedImage) -> TranscodedImage:
+        if best is None or len(candidate.content) < len(best.content):
+            return candidate
+        return best
+
+    @classmethod
+    def _flatten(cls, image: Image.Image) -> Image.Image:
+        if not cls._has_alpha(image):
+            return image if image.mode == 'RGB' else image.convert('RGB')
+
+        rgba = image.convert('RGBA')
+        flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel('A'))
+        return flattened
+
+    @classmethod
+    def _has_alpha(cls, image: Image.Image) -> bool:
+        return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
@@ -0,0 +1,201 @@
+from binascii import a2b_base64
+from binascii import a2b_qp
+from collections import namedtuple
+from contextlib import ExitStack
+from contextlib import contextmanager
+from email.message import Message
+from email.parser import HeaderParser
+from hashlib import sha256
+from re import compile as re_compile
+from tempfile import SpooledTemporaryFile
+from typing import IO
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
+MimeLeaf = namedtuple('MimeLeaf', ['content', 'size', 'digest'])
+
+SPOOL_BYTES = 1024 * 1024
+MAX_LINE_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 256 * 1024
+
+_NON_BASE64 = re_compile(rb'[^A-Za-z0-9+/]')
+
+
+class _Decoder:
+
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+
+class _Base64Decoder(_Decoder):
+
+    def __init__(self) -> None:
+        self._remainder = b''
+
+    def decode(self, data: bytes) -> bytes:
+        data = self._remainder + _NON_BASE64.sub(b'', data)
+        num_complete = len(data) - len(data) % 4
+        self._remainder = data[num_complete:]
+        return a2b_base64(data[:num_complete])
+
+    def flush(self) -> bytes:
+        remainder, self._remainder = self._remainder, b''
+        if len(remainder) < 2:
+            return b''
+        return a2b_base64(remainder + b'=' * (-len(remainder) % 4))
+
+
+class _QuotedPrintableDecoder(_Decoder):
+
+    def __init__(self) -> None:
+        self._remainder = b''
+
+    def decode(self, data: bytes) -> bytes:
+        # soft line breaks can only be resolved once the whole line is available
+        data = self._remainder + data
+        num_complete = data.rfind(b'\n') + 1
+        self._remainder = data[num_complete:]
+        return a2b_qp(data[:num_complete])
+
+    def flush(self) -> bytes:
+        remainder, self._remainder = self._remainder, b''
+        return a2b_qp(remainder)
+
+
+_DECODERS: Dict[str, Type[_Decoder]] = {
+    'base64': _Base64Decoder,
+    'quoted-printable': _QuotedPrintableDecoder,
+}
+
+
+class _MimeReader:
+
+    def __init__(self, fobj: IO[bytes], spool_bytes: int, max_line_bytes: int, exit_stack: ExitStack) -> None:
+        self._fobj = fobj
+        self._spool_bytes = spool_bytes
+        self._max_line_bytes = max_line_bytes
+        self._exit_stack = exit_stack
+        self._is_line_start = True
+        self.leaves: Dict[Message, MimeLeaf] = {}
+
+    def read_message(self) -> Message:
+        message = self._read_headers()
+        self._read_part(message, frozenset())
+        return message
+
+    def _readline(self) -> Tuple[bytes, bool]:
+        # long lines are returned in pieces and only the first piece can be a boundary
+        line = self._fobj.readline(self._max_line_bytes)
+        is_line_start = self._is_line_start
+        self._is_line_start = line.endswith(b'\n')
+        return line, is_line_start
+
+    def _read_terminator(self, line: bytes, is_line_start: bool, terminators: FrozenSet[bytes]) -> Optional[bytes]:
+        if not is_line_start or not line.startswith(b'--'):
+            return None
+        terminator = line.rstrip(b' \t\r\n')
+        return terminator if terminator in terminators else None
+
+    def _read_headers(self) -> Message:
+        headers = []
+        num_bytes = 0
+
+        while True:
+            line, is_line_start = self._readline()
+            if not line or (is_line_start and line in (b'\n', b'\r\n')):
+                break
+            if num_bytes < MAX_HEADER_BYTES:
+                headers.append(line)
+                num_bytes += len(line)
+
+        # inbound emails are stored utf-8 encoded so this matches parsing the decoded text
+        return HeaderParser().parsestr(b''.join(headers).decode('utf-8', errors='replace'))
+
+    def _read_part(self, message: Message, terminators: FrozenSet[bytes]) -> bytes:
+        boundary = message.get_boundary() if message.get_content_maintype() == 'multipart' else None
+        if not boundary:
+            return self._read_leaf(message, terminators)
+
+        delimiter = f'--{boundary}'.encode('utf-8')
+        close_delimiter = delimiter + b'--'
+        part_terminators = terminators | {delimiter, close_delimiter}
+
+        message.set_payload([])
+
+        terminator = self._skip(part_terminators)
+        while terminator == delimiter:
+            part = self._read_headers()
+            message.attach(part)
+            terminator = self._read_part(part, part_terminators)
+
+        if terminator == close_delimiter:
+            terminator = self._skip(terminators)
+
+        return terminator
+
+    def _skip(self, terminators: FrozenSet[bytes]) -> bytes:
+        while True:
+            line, is_line_start = self._readline()
+            if not line:
+                return b''
+
+            terminator = self._read_terminator(line, is_line_start, terminators)
+            if terminator is not None:
+                return terminator
+
+    def _read_leaf(self, message: Message, terminators: FrozenSet[bytes]) -> bytes:
+        encoding = (message.get('Content-Transfer-Encoding') or '').strip().lower()
+        decoder = _DECODERS.get(encoding, _Decoder)()
+        content = self._exit_stack.enter_context(SpooledTemporaryFile(max_size=self._spool_bytes))
+        digest = sha256()
+        terminator = b''
+
+        def write(data: bytes) -> None:
+            if data:
+                content.write(data)
+                digest.update(data)
+
+        # the line break before a boundary belongs to the boundary, so it is held back until the next line;
+        # parts of a multipart email that is cut off are also missing their last line break
+        pending_eol = b''
+        while True:
+            line, is_line_start = self._readline()
+            if not line:
+                break
+
+            found_terminator = self._read_terminator(line, is_line_start, terminators)
+            if found_terminator is not None:
+                terminator = found_terminator
+                break
+
+            eol = b'\r\n' if line.endswith(b'\r\n') else b'\n' if line.endswith(b'\n') else b''
+            write(decoder.decode(pending_eol + line[:len(line) - len(eol)]))
+            pending_eol = eol
+
+        if not terminators:
+            write(decoder.decode(pending_eol))
+        write(decoder.flush())
+
+        message.set_payload('')
+        self.leaves[message] = MimeLeaf(content, content.tell(), digest.hexdigest())
+        content.seek(0)
+        return terminator
+
+
+# the returned message only holds the headers of the email and its parts, the decoded content of
+# each leaf part is spooled to a temporary file once it grows beyond spool_bytes
+@contextmanager
+def read_mime_stream(fobj: IO[bytes],
+                     spool_bytes: int = SPOOL_BYTES,
+                     max_line_bytes: int = MAX_LINE_BYTES) -> Iterator[Tuple[Message, Dict[Message, MimeLeaf]]]:
+    with ExitStack() as exit_stack:
+        reader = _MimeReader(fobj, spool_bytes, max_line_bytes, exit_stack)
+        message = reader.read_message()
+        yield message, reader.leaves
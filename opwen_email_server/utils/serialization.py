@@ -5,8 +5,11 @@ from io import BytesIO
 from json import JSONDecodeError
 from json import dumps
 from json import loads
+from typing import IO
+from typing import Iterable
 from typing import Optional
 
+from msgpack import Unpacker
 from msgpack import packb as msgpack_dump
 from msgpack import unpackb as msgpack_load
 
@@ -45,6 +48,19 @@ def from_msgpack_bytes(serialized: bytes) -> dict:
     return msgpack_load(encoded, raw=False)
 
 
+def to_msgpack_record(obj) -> bytes:
+    # msgpack objects delimit themselves, so raw bytes never need escaping
+    return msgpack_dump(obj, use_bin_type=True)
+
+
+def from_msgpack_record(serialized: bytes) -> dict:
+    return msgpack_load(serialized, raw=False)
+
+
+def iter_msgpack_records(fobj: IO[bytes]) -> Iterable[dict]:
+    yield from Unpacker(fobj, raw=False)
+
+
 def to_base64(content: bytes) -> str:
     return b64encode(content).decode('ascii')
 
@@ -404,6 +404,22 @@ class Base(object):
 
             self.assertIsNone(actual2.get('attachments'))
 
+        def test_get_with_separate_attachments_synced_before(self):
+            attachment = {'_type': 'attachment', '_uid': 'a1', 'filename': 'foo.txt', 'content': b'foo.txt'}
+            self.given_emails(
+                {'_type': 'email', '_uid': 'e1', 'to': ['foo@bar.com'], 'subject': 'foo'},
+                dict(attachment, emails=['e1']),
+            )
+
+            self.given_emails(
+                {'_type': 'email', '_uid': 'e2', 'to': ['foo@bar.com'], 'subject': 'bar'},
+                dict(attachment, emails=['e2']),
+            )
+
+            expected = [{'_uid': 'a1', 'filename': 'foo.txt', 'content': b'foo.txt', 'cid': None}]
+            self.assertEqual(self.email_store.get('e1').get('attachments'), expected)
+            self.assertEqual(self.email_store.get('e2').get('attachments'), expected)
+
         def test_get_without_match(self):
             self.given_emails(
                 {'to': ['foo@bar.com'], 'subject': 'foo'},
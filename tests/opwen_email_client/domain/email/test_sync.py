@@ -1,18 +1,29 @@
 from glob import glob
 from io import BytesIO
+from os import listdir
 from os import mkdir
+from os import remove
 from os.path import join
 from shutil import rmtree
+from tarfile import TarFile
 from tarfile import TarInfo
 from tempfile import mkdtemp
 from typing import Dict
 from unittest import TestCase
 from unittest.mock import Mock
+from unittest.mock import call
+from unittest.mock import patch
 from uuid import uuid4
 
+from libcloud.storage.drivers.local import LocalStorageDriver
+from msgpack import packb
+from zstandard import ZstdCompressor
+from zstandard import train_dictionary
+
 from opwen_email_client.domain.email.sync import AzureSync
 from opwen_email_client.domain.email.sync import Download
 from opwen_email_client.util.serialization import JsonSerializer
+from opwen_email_client.util.serialization import MsgpackSerializer
 
 
 class AzureSyncTests(TestCase):
@@ -90,6 +101,21 @@ class AzureSyncTests(TestCase):
         self.assertUploadIs({self.sync._emails_file: b'{"attachments":[{"filename":"foo.txt"}]'
                              b',"foo":0}\n'})
 
+    def test_upload_deduplicates_attachments(self):
+        self.sync._deduplicate_attachments = True
+        attachment = {'_uid': 'local', 'filename': 'a.txt', 'content': b'a'}
+        items = [{'_uid': '1', 'attachments': [dict(attachment)]}, {'_uid': '2', 'attachments': [dict(attachment)]}]
+
+        self.sync.upload(items=items, users=[])
+
+        attachment_id = self.sync._attachment_id(attachment)
+        self.assertUploadIs({
+            self.sync._emails_file:
+            b'{"_uid":"1"}\n{"_uid":"2"}\n',
+            self.sync._attachments_file:
+            ('{"_uid":"%s","content":"YQ==","emails":["1","2"],"filename":"a.txt"}\n' % attachment_id).encode('ascii'),
+        })
+
     def test_upload_with_no_content_does_not_hit_network(self):
         self.sync.upload(items=[], users=[])
 
@@ -126,6 +152,158 @@ class AzureSyncTests(TestCase):
                 self.assertIn({'x': 'y', '_type': 'attachment'}, downloaded)
                 self.assertIn({'z': 1, '_type': 'attachment'}, downloaded)
 
+    def test_download_msgpack(self):
+        self.sync._serializer = MsgpackSerializer()
+        email = {'_uid': '1', 'attachments': [{'filename': 'a.bin', 'content': b'\n\x00\xff'}]}
+        self.given_download({'emails.msgpack': packb(email) + packb({'baz': 1})}, 'zstd')
+
+        downloaded = list(self.sync.download())
+
+        self.assertEqual(downloaded, [dict(email, _type='email'), {'baz': 1, '_type': 'email'}])
+
+    def test_upload_msgpack(self):
+        self.sync._serializer = MsgpackSerializer()
+        item = {'_uid': '1', 'attachments': [{'filename': 'a.bin', 'content': b'\n\x00\xff'}]}
+
+        self.sync.upload(items=[item], users=[])
+
+        self.assertUploadIs({'emails.msgpack': packb(item)})
+
+    def test_download_multiple_parts(self):
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        first_part = self.email_server_client_mock.download.return_value
+        self.given_download({self.sync._emails_file: b'{"baz":1}\n'}, 'gz')
+        second_part = self.email_server_client_mock.download.return_value
+        self.email_server_client_mock.download.side_effect = [first_part, second_part, None]
+
+        downloaded = list(self.sync.download())
+
+        self.assertEqual(downloaded, [{'foo': 'bar', '_type': 'email'}, {'baz': 1, '_type': 'email'}])
+        self.assertEqual(self.email_server_client_mock.download.call_args_list,
+                         [call(None), call(first_part), call(second_part)])
+
+    def test_download_acknowledges_part_only_after_it_was_stored(self):
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        first_part = self.email_server_client_mock.download.return_value
+        self.given_download({self.sync._emails_file: b'{"baz":1}\n'}, 'gz')
+        second_part = self.email_server_client_mock.download.return_value
+        self.email_server_client_mock.download.side_effect = [first_part, second_part, None]
+
+        parts = iter(self.sync.download_parts())
+        self.assertEqual(list(next(parts)), [{'foo': 'bar', '_type': 'email'}])
+        self.assertEqual(self.email_server_client_mock.download.call_args_list, [call(None)])
+
+        self.assertEqual(list(next(parts)), [{'baz': 1, '_type': 'email'}])
+        self.assertEqual(self.email_server_client_mock.download.call_args_list, [call(None), call(first_part)])
+
+    def test_download_does_not_acknowledge_part_that_failed_to_store(self):
+        self.sync._download_dir = join(self._root_folder, 'downloads')
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        resource_id = self.email_server_client_mock.download.return_value
+        self.email_server_client_mock.download.side_effect = [resource_id, None]
+
+        def store(parts):
+            for part in parts:
+                list(part)
+                raise OSError('disk full')
+
+        with self.assertRaises(OSError):
+            store(self.sync.download_parts())
+        list(self.sync.download())
+
+        self.assertEqual(self.email_server_client_mock.download.call_args_list, [call(None), call(None)])
+
+    def test_download_acknowledges_imported_part_on_next_sync(self):
+        self.sync._download_dir = join(self._root_folder, 'downloads')
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        resource_id = self.email_server_client_mock.download.return_value
+        self.email_server_client_mock.download.side_effect = [resource_id, ConnectionError('offline'), None]
+
+        downloaded = []
+        with self.assertRaises(ConnectionError):
+            for obj in self.sync.download():
+                downloaded.append(obj)
+        downloaded.extend(self.sync.download())
+
+        self.assertEqual(downloaded, [{'foo': 'bar', '_type': 'email'}])
+        self.assertEqual(self.email_server_client_mock.download.call_args_list,
+                         [call(None), call(resource_id), call(resource_id)])
+        self.assertEqual(listdir(self.sync._download_dir), [])
+
+    def test_download_resumes_interrupted_part(self):
+        self.sync._download_dir = join(self._root_folder, 'downloads')
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        resource_id = self.email_server_client_mock.download.return_value
+        self.email_server_client_mock.download.side_effect = [None]
+
+        mkdir(self.sync._download_dir)
+        with open(join(self._content_root, resource_id), 'rb') as fobj:
+            content = fobj.read()
+        with open(join(self.sync._download_dir, resource_id), 'wb') as fobj:
+            fobj.write(content[:10])
+
+        with patch.object(LocalStorageDriver,
+                          'download_object_range_as_stream',
+                          autospec=True,
+                          side_effect=LocalStorageDriver.download_object_range_as_stream) as mock:
+            downloaded = list(self.sync.download())
+
+        self.assertEqual(downloaded, [{'foo': 'bar', '_type': 'email'}])
+        self.assertEqual(mock.call_args[1], {'start_bytes': 10})
+        self.assertEqual(listdir(self.sync._download_dir), [])
+        self.email_server_client_mock.download.assert_called_once_with(resource_id)
+
+    def test_download_retries_dropped_connections(self):
+        self.sync._download_dir = join(self._root_folder, 'downloads')
+        self.given_download({self.sync._emails_file: b'{"foo":"bar"}\n'}, 'gz')
+        download_range = LocalStorageDriver.download_object_range_as_stream
+        calls = []
+
+        def flaky_download(driver, obj, start_bytes):
+            calls.append(start_bytes)
+            chunks = download_range(driver, obj, start_bytes=start_bytes)
+            if len(calls) == 1:
+                yield next(iter(chunks))[:10]
+                raise ConnectionError('dropped')
+            yield from chunks
+
+        with patch.object(LocalStorageDriver, 'download_object_range_as_stream', new=flaky_download):
+            downloaded = list(self.sync.download())
+
+        self.assertEqual(downloaded, [{'foo': 'bar', '_type': 'email'}])
+        self.assertEqual(calls, [0, 10])
+
+    def test_download_with_shared_dictionary(self):
+        self.sync._dictionary_dir = join(self._root_folder, 'dictionaries')
+        samples = [('{"_uid":"%d","subject":"hello %d","to":["user%d@lokole.ca"]}\n' % (i, i, i)).encode()
+                   for i in range(500)]
+        dictionary = train_dictionary(4096, samples)
+        mkdir(join(self._content_root, 'dictionaries'))
+        with open(join(self._content_root, 'dictionaries', str(dictionary.dict_id())), 'wb') as fobj:
+            fobj.write(dictionary.as_bytes())
+
+        content = b'{"_uid":"1","subject":"hello"}\n'
+        archive = BytesIO()
+        with TarFile.open(fileobj=archive, mode='w') as tar:
+            tarinfo = TarInfo(self.sync._emails_file)
+            tarinfo.size = len(content)
+            tar.addfile(tarinfo, BytesIO(content))
+        resource_ids = ['first.tar.zstd', 'second.tar.zstd']
+        for resource_id in resource_ids:
+            with open(join(self._content_root, resource_id), 'wb') as fobj:
+                fobj.write(ZstdCompressor(dict_data=dictionary).compress(archive.getvalue()))
+
+        self.email_server_client_mock.download.side_effect = [resource_ids[0], None]
+        first = list(self.sync.download())
+        remove(join(self._content_root, 'dictionaries', str(dictionary.dict_id())))
+        self.sync._dictionaries.clear()
+        self.email_server_client_mock.download.side_effect = [resource_ids[1], None]
+        second = list(self.sync.download())
+
+        self.assertEqual(first, [{'_uid': '1', 'subject': 'hello', '_type': 'email'}])
+        self.assertEqual(second, first)
+        self.assertEqual(listdir(self.sync._dictionary_dir), [str(dictionary.dict_id())])
+
     def test_download_missing_resource(self):
         self.given_download_exception()
 
@@ -1,11 +1,13 @@
 from abc import ABCMeta
 from abc import abstractmethod
 from copy import deepcopy
+from io import BytesIO
 from unittest import TestCase
 
 from typing import Iterable
 
 from opwen_email_client.util.serialization import JsonSerializer
+from opwen_email_client.util.serialization import MsgpackSerializer
 from opwen_email_client.util.serialization import Serializer
 
 
@@ -32,8 +34,48 @@ class Base(object):
                 deserialized = self.serializer.deserialize(serialized, type_)
                 self.assertEqual(original, deserialized)
 
+        def test_stream_roundtrip(self):
+            for original, type_ in self.serializable_objects:
+                fobj = BytesIO()
+                self.serializer.dump(deepcopy(original), fobj, type_)
+                self.serializer.dump(deepcopy(original), fobj, type_)
+                fobj.seek(0)
+
+                self.assertEqual(list(self.serializer.load(fobj, type_)), [original, original])
+
 
 class JsonSerializerTests(Base.SerializerTests):
 
     def create_serializer(self):
         return JsonSerializer()
+
+    def test_writes_compact_sorted_json_lines(self):
+        email = {'to': ['a@b.c'], 'attachments': [{'filename': 'a.txt', 'content': b'content', 'cid': None}]}
+
+        serialized = self.serializer.serialize(email)
+
+        self.assertEqual(
+            serialized, b'{"attachments":[{"cid":null,"content":"Y29udGVudA==","filename":"a.txt"}],'
+            b'"to":["a@b.c"]}')
+
+    def test_does_not_modify_or_copy_attachments(self):
+        content = bytes(range(256)) * 4000
+        email = {'attachments': [{'content': content}]}
+        fobj = BytesIO()
+
+        self.serializer.dump(email, fobj)
+        fobj.seek(0)
+
+        self.assertIs(email['attachments'][0]['content'], content)
+        self.assertEqual(list(self.serializer.load(fobj)), [{'attachments': [{'content': content}]}])
+
+
+class MsgpackSerializerTests(Base.SerializerTests):
+
+    def create_serializer(self):
+        return MsgpackSerializer()
+
+    def test_keeps_raw_bytes(self):
+        serialized = self.serializer.serialize({'content': b'\n\xff' * 100})
+
+        self.assertIn(b'\n\xff' * 100, serialized)
@@ -0,0 +1,81 @@
+from base64 import encodebytes
+from os import mkdir
+from os import urandom
+from os.path import join
+from shutil import rmtree
+from tempfile import TemporaryFile
+from tempfile import mkdtemp
+from tracemalloc import get_traced_memory
+from tracemalloc import start
+from tracemalloc import stop
+from typing import IO
+from unittest import TestCase
+from unittest.mock import patch
+
+from opwen_email_server import config
+from opwen_email_server.integration.azure import get_attachment_storage
+from opwen_email_server.integration.azure import get_inbound_attachment_store
+from opwen_email_server.utils.email_parser import MimeEmailParser
+
+
+class GetInboundAttachmentStoreTests(TestCase):
+
+    def test_streams_attachments_with_default_config(self):
+        num_attachment_bytes = 16 * 1024 * 1024
+        self.assertFalse(config.EMAIL_SEPARATE_ATTACHMENTS)
+
+        with TemporaryFile() as mime_email:
+            self._given_mime_email(mime_email, num_attachment_bytes)
+            parser = MimeEmailParser(attachment_store=get_inbound_attachment_store(), spool_bytes=64 * 1024)
+
+            start()
+            try:
+                email = parser(mime_email)
+                _, peak_bytes = get_traced_memory()
+            finally:
+                stop()
+
+        attachment, = email['attachments']
+        self.assertEqual(attachment['size'], num_attachment_bytes)
+        self.assertNotIn('content', attachment)
+        self.assertEqual(len(get_attachment_storage().fetch_attachment(attachment['content_id'])), num_attachment_bytes)
+        self.assertLess(peak_bytes, num_attachment_bytes // 4)
+
+    @classmethod
+    def _given_mime_email(cls, mime_email: IO[bytes], num_attachment_bytes: int):
+        mime_email.write(b'From: sender@test.com\n'
+                         b'To: recipient@test.com\n'
+                         b'Subject: Large attachment\n'
+                         b'Content-Type: multipart/mixed; boundary="b"\n'
+                         b'\n'
+                         b'--b\n'
+                         b'Content-Type: text/plain\n'
+                         b'\n'
+                         b'See attached\n'
+                         b'--b\n'
+                         b'Content-Type: application/octet-stream\n'
+                         b'Content-Disposition: attachment; filename="data.bin"\n'
+                         b'Content-Transfer-Encoding: base64\n'
+                         b'\n')
+        for _ in range(num_attachment_bytes // (57 * 1024)):
+            mime_email.write(encodebytes(urandom(57 * 1024)))
+        mime_email.write(encodebytes(urandom(num_attachment_bytes % (57 * 1024))))
+        mime_email.write(b'--b--\n')
+        mime_email.seek(0)
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        mkdir(join(self._folder, config.CONTAINER_ATTACHMENTS))
+        self._patches = [
+            patch.object(config, 'STORAGE_PROVIDER', 'LOCAL'),
+            patch.object(config, 'BLOBS_ACCOUNT', self._folder),
+            patch.object(config, 'BLOBS_HOST', None),
+            patch.object(config, 'BLOBS_SECURE', True),
+        ]
+        for config_patch in self._patches:
+            config_patch.start()
+
+    def tearDown(self):
+        for config_patch in self._patches:
+            config_patch.stop()
+        rmtree(self._folder)
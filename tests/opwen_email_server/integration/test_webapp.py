@@ -0,0 +1,64 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import call
+
+from opwen_email_client.webapp.config import AppConfig
+from opwen_email_server.integration.webapp import AzureEmailStore
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.services.storage import MailboxPage
+
+
+class AzureEmailStoreTests(TestCase):
+
+    def test_inbox_returns_cursor_of_next_page(self):
+        self.mailbox_index.list_page.return_value = MailboxPage([MailboxEntry('k1', 'id1', {'subject': 's'})], 'k1')
+
+        emails = self.email_store.inbox('foo@bar.com', page=1)
+
+        self.assertEqual([email['_uid'] for email in emails], ['id1'])
+        self.assertEqual(emails.next_cursor, 'k1')
+        self.mailbox_index.list_page.assert_called_once_with('bar.com/foo@bar.com/received', AppConfig.EMAILS_PER_PAGE,
+                                                             None)
+
+    def test_inbox_resumes_from_cursor(self):
+        self.mailbox_index.list_page.return_value = MailboxPage([MailboxEntry('k2', 'id2', {})], None)
+
+        emails = self.email_store.inbox('foo@bar.com', page=2, cursor='k1')
+
+        self.assertEqual([email['_uid'] for email in emails], ['id2'])
+        self.assertIsNone(emails.next_cursor)
+        self.mailbox_index.list_page.assert_called_once_with('bar.com/foo@bar.com/received', AppConfig.EMAILS_PER_PAGE,
+                                                             'k1')
+
+    def test_sent_walks_to_page_without_cursor(self):
+        self.mailbox_index.list_page.side_effect = [
+            MailboxPage([MailboxEntry('k1', 'id1', {})], 'k1'),
+            MailboxPage([MailboxEntry('k2', 'id2', {})], 'k2'),
+            MailboxPage([MailboxEntry('k3', 'id3', {})], None),
+        ]
+
+        emails = self.email_store.sent('foo@bar.com', page=3)
+
+        self.assertEqual([email['_uid'] for email in emails], ['id3'])
+        self.assertEqual(self.mailbox_index.list_page.call_args_list, [
+            call('bar.com/foo@bar.com/sent', AppConfig.EMAILS_PER_PAGE, None),
+            call('bar.com/foo@bar.com/sent', AppConfig.EMAILS_PER_PAGE, 'k1'),
+            call('bar.com/foo@bar.com/sent', AppConfig.EMAILS_PER_PAGE, 'k2'),
+        ])
+
+    def test_sent_stops_walking_after_last_page(self):
+        self.mailbox_index.list_page.return_value = MailboxPage([MailboxEntry('k1', 'id1', {})], None)
+
+        emails = self.email_store.sent('foo@bar.com', page=3)
+
+        self.assertEqual(list(emails), [])
+        self.assertEqual(self.mailbox_index.list_page.call_count, 1)
+
+    def setUp(self):
+        self.mailbox_index = MagicMock()
+        self.email_store = AzureEmailStore(
+            email_storage=MagicMock(),
+            mailbox_index=self.mailbox_index,
+            pending_storage=MagicMock(),
+            send_email=MagicMock(),
+        )
@@ -1,3 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
 from io import BytesIO
 from os import listdir
 from os import mkdir
@@ -6,24 +10,46 @@ from os.path import isdir
 from os.path import join
 from pathlib import Path
 from shutil import rmtree
+from tarfile import TarFile
 from tarfile import TarInfo
 from tempfile import NamedTemporaryFile
 from tempfile import mkdtemp
+from typing import List
 from unittest import TestCase
+from unittest.mock import Mock
 from unittest.mock import PropertyMock
 from unittest.mock import patch
 
+from libcloud.common.types import LibcloudError
+from libcloud.storage.base import StorageDriver
+from libcloud.storage.drivers.azure_blobs import AzureBlobsStorageDriver
 from libcloud.storage.types import ContainerAlreadyExistsError
 from libcloud.storage.types import ContainerDoesNotExistError
 from libcloud.storage.types import ObjectDoesNotExistError
 from xtarfile import open as tarfile_open
-
+from zstandard import ZstdCompressionDict
+from zstandard import ZstdDecompressor
+from zstandard import get_frame_parameters
+
+from opwen_email_server.services.storage import AzureAttachmentStorage
+from opwen_email_server.services.storage import AzureBundleStorage
+from opwen_email_server.services.storage import AzureBytesCache
+from opwen_email_server.services.storage import AzureEmailStorage
 from opwen_email_server.services.storage import AzureFileStorage
+from opwen_email_server.services.storage import AzureMailboxIndex
 from opwen_email_server.services.storage import AzureObjectStorage
 from opwen_email_server.services.storage import AzureObjectsStorage
+from opwen_email_server.services.storage import AzurePendingStorage
 from opwen_email_server.services.storage import AzureTextStorage
+from opwen_email_server.services.storage import Delivery
+from opwen_email_server.services.storage import _Container
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.utils.cache import MemoryBytesCache
+from opwen_email_server.utils.compression import GzipCodec
+from opwen_email_server.utils.compression import train_zstd_dictionary
 from opwen_email_server.utils.serialization import from_jsonl_bytes
 from opwen_email_server.utils.serialization import to_jsonl_bytes
+from opwen_email_server.utils.serialization import to_msgpack_record
 from opwen_email_server.utils.temporary import create_tempfilename
 from opwen_email_server.utils.temporary import removing
 from opwen_email_server.utils.unique import NewGuid
@@ -44,7 +70,89 @@ class AzureTextStorageTests(TestCase):
         with self.assertRaises(ObjectDoesNotExistError):
             self._storage.fetch_text(resource_id)
 
+    def test_stores_fetches_and_deletes_many_texts(self):
+        resources = [(f'id{i}', f'content {i}') for i in range(20)]
+
+        self._storage.store_many_texts(resources)
+        actual_contents = list(self._storage.fetch_many_texts(resource_id for resource_id, _ in resources))
+
+        self.assertEqual(actual_contents, [content for _, content in resources])
+
+        self._storage.delete_many(resource_id for resource_id, _ in resources)
+        self.assertEqual(list(self._storage.iter()), [])
+
+    def test_reads_and_deletes_legacy_gzip_blobs(self):
+        self._given_legacy_codecs()
+
+        legacy_storage = AzureTextStorage(
+            account=self._folder,
+            key='key',
+            container=self._container,
+            provider='LOCAL',
+            codec=GzipCodec(),
+            legacy_codecs=True,
+        )
+        legacy_storage.store_text('id1', 'legacy content')
+        self._storage.store_text('id2', 'new content')
+
+        self.assertEqual(self._storage.fetch_text('id1'), 'legacy content')
+        self.assertEqual(self._storage.fetch_text('id2'), 'new content')
+        self.assertEqual(legacy_storage.fetch_text('id2'), 'new content')
+        self.assertEqual(sorted(listdir(join(self._folder, self._container))), ['id1.txt.gz', 'id2.txt.zst'])
+
+        self._storage.store_text('id1', 'updated content')
+
+        self.assertEqual(self._storage.fetch_text('id1'), 'updated content')
+        self.assertEqual(list(self._storage.iter()), ['id1', 'id2'])
+
+        self._storage.delete('id1')
+
+        self.assertEqual(listdir(join(self._folder, self._container)), ['id2.txt.zst'])
+        with self.assertRaises(ObjectDoesNotExistError):
+            self._storage.fetch_text('id1')
+
+        legacy_storage.store_text('id1', 'legacy content')
+
+        with patch.object(_Container, 'delete_object', autospec=True,
+                          side_effect=_Container.delete_object) as delete_object:
+            num_deleted = self._storage.delete_many(['id1', 'id2', 'id3'])
+
+        self.assertEqual(num_deleted, 2)
+        self.assertEqual(sorted(call[0][1] for call in delete_object.call_args_list),
+                         ['id1.txt.gz', 'id1.txt.zst', 'id2.txt.gz', 'id2.txt.zst', 'id3.txt.gz', 'id3.txt.zst'])
+        self.assertEqual(listdir(join(self._folder, self._container)), [])
+        with self.assertRaises(ObjectDoesNotExistError):
+            self._storage.fetch_text('id1')
+
+    def test_deletes_many_with_progress(self):
+        self._storage.store_many_texts((f'id{i}', 'content') for i in range(5))
+        progress = []
+
+        with patch.object(AzureTextStorage, '_delete_batch_size', 2):
+            num_deleted = self._storage.delete_many([f'id{i}' for i in range(5)], progress.append)
+
+        self.assertEqual(num_deleted, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(list(self._storage.iter()), [])
+
+    def test_deletes_prefix_without_fetching_objects(self):
+        self._storage.store_many_texts([('one/a', 'a'), ('one/b', 'b'), ('two/c', 'c')])
+
+        with patch('opwen_email_server.services.storage._Container.get_object', side_effect=AssertionError):
+            num_deleted = self._storage.delete_prefix('one/')
+
+        self.assertEqual(num_deleted, 2)
+        self.assertEqual(list(self._storage.iter()), ['two/c'])
+
+    def test_fetch_many_raises_for_missing_resource(self):
+        self._storage.store_text('id1', 'content')
+
+        with self.assertRaises(ObjectDoesNotExistError):
+            list(self._storage.fetch_many_texts(['id1', 'missing']))
+
     def test_list(self):
+        self._given_legacy_codecs()
+
         self._storage.store_text('resource1', 'a')
         self._storage.store_text('resource2.txt.gz', 'b')
         self._storage.store_text('pa.th/to/re.sou.rce.txt.gz', 'b')
@@ -64,13 +172,58 @@ class AzureTextStorageTests(TestCase):
         self.assertEqual(sorted(self._storage.iter('one/')), sorted(['a', 'b']))
         self.assertEqual(sorted(self._storage.iter('two/')), sorted(['c', 'd', 'e']))
 
+    def test_list_pages(self):
+        for i in range(5):
+            self._storage.store_text(f'one/{i}', 'a')
+        self._storage.store_text('two/5', 'b')
+
+        page1 = self._storage.list_page('one/', page_size=2)
+        page2 = self._storage.list_page('one/', page_size=2, cursor=page1.cursor)
+        page3 = self._storage.list_page('one/', page_size=2, cursor=page2.cursor)
+
+        self.assertEqual(page1.resource_ids, ['0', '1'])
+        self.assertEqual(page2.resource_ids, ['2', '3'])
+        self.assertEqual(page3.resource_ids, ['4'])
+        self.assertIsNone(page3.cursor)
+
+    def test_opens_stored_bytes_as_stream(self):
+        content = b'line\n' * 100000
+
+        self._storage.store_bytes('id1', content)
+        with self._storage.open_bytes('id1') as stream:
+            self.assertEqual(stream.readline(), b'line\n')
+            self.assertEqual(len(stream.read()), len(content) - 5)
+
+    def test_opens_gzip_bytes_as_stream(self):
+        self._given_legacy_codecs()
+
+        gzip_storage = AzureTextStorage(
+            account=self._folder,
+            key='key',
+            container=self._container,
+            provider='LOCAL',
+            codec=GzipCodec(),
+        )
+        gzip_storage.store_text('id1', 'some text')
+
+        with self._storage.open_bytes('id1') as stream:
+            self.assertEqual(stream.read(), b'some text')
+
+    def test_open_bytes_raises_for_missing_resources(self):
+        self._storage.ensure_exists()
+
+        with self.assertRaises(ObjectDoesNotExistError):
+            with self._storage.open_bytes('missing'):
+                pass
+
     def test_ensure_exists(self):
         self.assertFalse(isdir(join(self._folder, self._container)))
         self._storage.ensure_exists()
         self.assertTrue(isdir(join(self._folder, self._container)))
 
     def test_handles_race_condition_when_creating_container(self):
-        with patch.object(self._storage, '_driver', new_callable=PropertyMock) as driver:
+        with patch.object(AzureTextStorage, '_driver', new_callable=PropertyMock) as driver_property:
+            driver = driver_property.return_value
             container = {'get_was_called': False}
 
             # noinspection PyUnusedLocal
@@ -86,7 +239,32 @@ class AzureTextStorageTests(TestCase):
             driver.create_container.side_effect = throw(ContainerAlreadyExistsError(None, driver, self._container))
             driver.get_container.side_effect = get_container
 
-            self.assertIs(self._storage._client._wrapped, container)
+            self.assertIs(self._storage._remote_container, container)
+
+    def test_uses_one_driver_per_thread(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            worker_driver = executor.submit(lambda: self._storage._driver).result()
+
+        self.assertIs(self._storage._driver, self._storage._driver)
+        self.assertIsNot(worker_driver, self._storage._driver)
+
+    def test_reads_only_the_current_codec_name_without_legacy_codecs(self):
+        self._storage.ensure_exists()
+
+        with patch.object(_Container, 'get_object', autospec=True, side_effect=_Container.get_object) as get_object:
+            with self.assertRaises(ObjectDoesNotExistError):
+                self._storage.fetch_text('missing')
+
+        self.assertEqual([call[0][1] for call in get_object.call_args_list], ['missing.txt.zst'])
+
+    def _given_legacy_codecs(self):
+        self._storage = AzureTextStorage(
+            account=self._folder,
+            key='key',
+            container=self._container,
+            provider='LOCAL',
+            legacy_codecs=True,
+        )
 
     def setUp(self):
         self._folder = mkdtemp()
@@ -139,6 +317,57 @@ class AzureTextStorageCaseInsensitiveTests(TestCase):
         rmtree(self._folder)
 
 
+class AzureBytesCacheTests(TestCase):
+
+    def test_gets_puts_and_deletes_values(self):
+        key = 'http://example.com/logo.png?size=large'
+
+        self.assertIsNone(self._cache.get(key))
+
+        self._cache.put(key, b'value')
+        self.assertEqual(self._cache.get(key), b'value')
+
+        self._cache.delete(key)
+        self.assertIsNone(self._cache.get(key))
+
+    def test_expires_values_after_max_age(self):
+        self._cache.put('key', b'value')
+
+        self._now += timedelta(days=7)
+
+        self.assertIsNone(self._cache.get('key'))
+
+    def test_put_deletes_expired_values(self):
+        self._cache.put('old', b'value')
+        self._now += timedelta(days=7)
+
+        self._cache.put('new', b'value')
+
+        self.assertEqual(len(list(self._cache.iter())), 1)
+        self.assertEqual(self._cache.get('new'), b'value')
+
+    def test_miss_reads_one_name(self):
+        with patch.object(_Container, 'get_object', side_effect=ObjectDoesNotExistError(None, None, 'key')) as get:
+            self.assertIsNone(self._cache.get('key'))
+
+        self.assertEqual(get.call_count, 1)
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._now = datetime(2020, 1, 6)
+        self._cache = AzureBytesCache(
+            account=self._folder,
+            key='key',
+            container='container',
+            provider='LOCAL',
+            max_age=timedelta(days=7),
+            clock=lambda: self._now,
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
+
+
 class AzureFileStorageTests(TestCase):
 
     def test_stores_fetches_and_deletes_file(self):
@@ -155,6 +384,19 @@ class AzureFileStorageTests(TestCase):
 
         self._storage.delete(resource_id)
 
+    def test_appends_bytes_from_several_processes(self):
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(_append_records, [self._folder] * 4, range(4)))
+
+        records = self._storage.fetch_bytes_from('log', 0).split()
+        self.assertEqual(sorted(records), sorted(f'{worker}-{i}'.encode() for worker in range(4) for i in range(50)))
+
+    def test_refuses_to_append_without_append_support(self):
+        container = _Container(Mock(driver=Mock(spec=StorageDriver)))
+
+        with self.assertRaises(LibcloudError):
+            container.append_object('log', b'record')
+
     def assertFileContains(self, path: str, content: str):
         with open(path, encoding='utf-8') as fobj:
             self.assertEqual(fobj.read(), content)
@@ -183,6 +425,49 @@ class AzureFileStorageTests(TestCase):
             remove(path)
 
 
+def _append_records(folder: str, worker: int):
+    storage = AzureFileStorage(account=folder, key='key', container='container', provider='LOCAL')
+    for i in range(50):
+        storage.append_bytes('log', f'{worker}-{i}\n'.encode())
+
+
+class AzureAppendBlobTests(TestCase):
+
+    def test_appends_small_payloads_as_one_block(self):
+        self._container.append_object('log', b'record')
+
+        self.assertEqual(self._requests(), [('appendblock', 6)])
+
+    def test_splits_large_payloads_into_leased_blocks(self):
+        data = b'x' * (9 * 1024 * 1024)
+
+        self._container.append_object('log', data)
+
+        self.assertEqual(self._requests(), [('lease', 0), ('appendblock', 4 * 1024 * 1024),
+                                            ('appendblock', 4 * 1024 * 1024), ('appendblock', 1024 * 1024),
+                                            ('lease', 0)])
+        appends = [call[1] for call in self._driver.connection.request.call_args_list[1:-1]]
+        self.assertTrue(all(append['headers']['x-ms-lease-id'] == 'lease-id' for append in appends))
+        self.assertEqual(b''.join(append['data'] for append in appends), data)
+
+    def test_creates_missing_blobs(self):
+        self._driver.connection.request.side_effect = [Mock(status=404), Mock(status=201), Mock(status=201)]
+
+        self._container.append_object('log', b'record')
+
+        self.assertEqual(self._requests(), [('appendblock', 6), (None, 0), ('appendblock', 6)])
+
+    def _requests(self):
+        return [(call[1]['params'].get('comp'), len(call[1]['data']))
+                for call in self._driver.connection.request.call_args_list]
+
+    def setUp(self):
+        self._driver = Mock(spec=AzureBlobsStorageDriver)
+        self._driver.connection = Mock()
+        self._driver.connection.request.return_value = Mock(status=201, headers={'x-ms-lease-id': 'lease-id'})
+        self._container = _Container(Mock(driver=self._driver))
+
+
 class AzureObjectsStorageTests(TestCase):
 
     def test_fetches_jsonl_objects(self):
@@ -195,6 +480,16 @@ class AzureObjectsStorageTests(TestCase):
 
         self.assertEqual(objs, [{'foo': 'bar'}, {'baz': [1, 2, 3]}])
 
+    def test_fetches_msgpack_records(self):
+        resource_id = '3d2bfa80-18f7-11e7-93ae-92361f002671.tar.gz'
+        name = 'file'
+        objs = [{'content': b'line\nbreak'}, {'baz': [1, 2, 3]}]
+        self._given_resource(resource_id, name, b''.join(map(to_msgpack_record, objs)))
+
+        fetched = list(self._storage.fetch_records(resource_id, name))
+
+        self.assertEqual(fetched, objs)
+
     def test_fetches_missing_file(self):
         with self.assertRaises(ObjectDoesNotExistError):
             list(self._storage.fetch_objects('missing', ('file', from_jsonl_bytes)))
@@ -246,6 +541,111 @@ class AzureObjectsStorageTests(TestCase):
         self.assertIsNotNone(resource_id)
         self.assertContainerHasNumFiles(1, suffix='.tar.gz')
 
+    def test_roundtrips_objects(self):
+        name = 'file'
+        objs = [{'foo': 'bar'}, {'baz': [1, 2, 3]}]
+
+        for compression in ('zstd', 'gz', 'bz2', 'xz'):
+            with self.subTest(compression=compression):
+                resource_id = self._storage.store_objects((name, objs, to_jsonl_bytes), compression)
+                actual = list(self._storage.fetch_objects(resource_id, (name, from_jsonl_bytes)))
+
+                self.assertEqual(actual, objs)
+
+    def test_fetches_objects_without_temporary_files(self):
+        name = 'file'
+        objs = [{'foo': 'bar'}, {'baz': [1, 2, 3]}]
+
+        resource_id = self._storage.store_objects((name, objs, to_jsonl_bytes))
+
+        with patch.object(self._storage._file_storage, 'fetch_file', side_effect=throw(AssertionError())):
+            actual = list(self._storage.fetch_objects(resource_id, (name, from_jsonl_bytes)))
+
+        self.assertEqual(actual, objs)
+
+    def test_stores_archives_with_multiple_files(self):
+        uploads = [('emails', [{'foo': 'bar'}], to_jsonl_bytes), ('empty', [], to_jsonl_bytes),
+                   ('users', [{'baz': 1}, {'baz': 2}], to_jsonl_bytes)]
+
+        for compression in ('zstd', 'gz'):
+            with self.subTest(compression=compression):
+                resource_id = self._storage.store_archive(uploads, compression)
+
+                self.assertEqual(list(self._storage.fetch_objects(resource_id, ('emails', from_jsonl_bytes))),
+                                 [{'foo': 'bar'}])
+                self.assertEqual(list(self._storage.fetch_objects(resource_id, ('users', from_jsonl_bytes))),
+                                 [{'baz': 1}, {'baz': 2}])
+
+    def test_records_compression_of_zstd_packages(self):
+        objs = [{'foo': 'bar' * 100}, {'baz': [1, 2, 3]}]
+
+        with patch.object(self._storage, 'log_event') as log_event:
+            resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd')
+
+        self.assertEqual(list(self._storage.fetch_objects(resource_id, ('file', from_jsonl_bytes))), objs)
+        (event, properties), _ = log_event.call_args
+        self.assertEqual(event, 'client_package_compressed')
+        self.assertEqual(properties['num_bytes'], sum(len(to_jsonl_bytes(obj)) for obj in objs))
+        self.assertGreater(properties['compressed_bytes'], 0)
+        self.assertGreater(properties['ratio'], 1)
+        self.assertIn('level', properties)
+        self.assertIn('seconds', properties)
+
+    def test_compresses_small_packages_with_shared_dictionary(self):
+        samples = [
+            to_jsonl_bytes({'subject': f'hello {i}', 'to': [f'user{i}@lokole.ca'], 'body': 'x' * i}) for i in range(500)
+        ]
+        dictionary_id = self._storage.store_dictionary(train_zstd_dictionary(samples, 4096))
+        objs = [{'subject': 'hello', 'to': ['user@lokole.ca'], 'body': 'xx'}]
+
+        resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+        plain_resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd')
+
+        compressed = Path(self._folder, self._container, resource_id).read_bytes()
+        self.assertEqual(get_frame_parameters(compressed).dict_id, dictionary_id)
+        self.assertEqual(
+            get_frame_parameters(Path(self._folder, self._container, plain_resource_id).read_bytes()).dict_id, 0)
+        dictionary = ZstdCompressionDict(self._storage.fetch_dictionary(dictionary_id))
+        decompressed = ZstdDecompressor(dict_data=dictionary).stream_reader(BytesIO(compressed))
+        with TarFile.open(fileobj=decompressed, mode='r|') as tar:
+            self.assertEqual(tar.extractfile(tar.next()).read(), to_jsonl_bytes(objs[0]))
+
+    def test_skips_dictionary_for_large_packages(self):
+        samples = [to_jsonl_bytes({'subject': f'hello {i}', 'body': 'x' * i}) for i in range(500)]
+        self._storage.store_dictionary(train_zstd_dictionary(samples, 4096))
+        objs = [{'body': 'x' * 2000}]
+
+        resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+
+        compressed = Path(self._folder, self._container, resource_id).read_bytes()
+        self.assertEqual(get_frame_parameters(compressed).dict_id, 0)
+
+    def test_downloads_dictionary_only_when_replaced(self):
+        samples = [to_jsonl_bytes({'subject': f'hello {i}', 'body': 'x' * i}) for i in range(500)]
+        other_samples = [to_jsonl_bytes({'subject': f'bye {i}', 'body': 'y' * i}) for i in range(500)]
+        objs = [{'subject': 'hello', 'body': 'xx'}]
+        self._storage.store_dictionary(train_zstd_dictionary(samples, 4096))
+        self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+
+        with patch.object(self._storage, '_dictionary_refresh_seconds', -1), \
+                patch.object(self._storage, 'fetch_dictionary', wraps=self._storage.fetch_dictionary) as fetch:
+            self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+            self.assertFalse(fetch.called)
+
+            dictionary_id = self._storage.store_dictionary(train_zstd_dictionary(other_samples, 4096))
+            resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+            fetch.assert_called_once_with(dictionary_id)
+
+        compressed = Path(self._folder, self._container, resource_id).read_bytes()
+        self.assertEqual(get_frame_parameters(compressed).dict_id, dictionary_id)
+
+    def test_falls_back_to_plain_zstd_without_dictionary(self):
+        objs = [{'foo': 'bar'}]
+
+        resource_id = self._storage.store_objects(('file', objs, to_jsonl_bytes), 'zstd', dictionary=True)
+
+        self.assertEqual(list(self._storage.fetch_objects(resource_id, ('file', from_jsonl_bytes))), objs)
+
     def test_does_not_create_file_without_objects(self):
         name = 'file'
         objs = []
@@ -297,6 +697,7 @@ class AzureObjectsStorageTests(TestCase):
                 provider='LOCAL',
             ),
             resource_id_source=NewGuid(0),
+            dictionary_max_bytes=1024,
         )
 
     def tearDown(self):
@@ -314,6 +715,14 @@ class AzureObjectStorageTests(TestCase):
 
         self.assertEqual(given, actual)
 
+    def test_roundtrip_many(self):
+        given = [(str(i), {'a': i}) for i in range(10)]
+
+        self._storage.store_many_objects(given)
+        actual = list(self._storage.fetch_many_objects(resource_id for resource_id, _ in given))
+
+        self.assertEqual([obj for _, obj in given], actual)
+
     def setUp(self):
         self._folder = mkdtemp()
         self._container = 'container'
@@ -327,3 +736,534 @@ class AzureObjectStorageTests(TestCase):
 
     def tearDown(self):
         rmtree(self._folder)
+
+
+class CachedAzureObjectStorageTests(TestCase):
+
+    def test_fetches_from_cache(self):
+        given = {'a': 1}
+        resource_id = '123'
+
+        self._storage.store_object(resource_id, given)
+        remove(join(self._folder, self._container, f'{resource_id}.msgpack.zst'))
+        actual = self._storage.fetch_object(resource_id)
+
+        self.assertEqual(given, actual)
+
+    def test_fills_cache_on_miss(self):
+        given = {'a': 1}
+        resource_id = '123'
+
+        AzureObjectStorage(
+            account=self._folder,
+            key='unused',
+            container=self._container,
+            provider='LOCAL',
+        ).store_object(resource_id, given)
+
+        self.assertIsNone(self._cache.get(f'{resource_id}.msgpack.zst'))
+        self._storage.fetch_object(resource_id)
+        self.assertIsNotNone(self._cache.get(f'{resource_id}.msgpack.zst'))
+
+    def test_returns_independent_copies(self):
+        resource_id = '123'
+
+        self._storage.store_object(resource_id, {'a': 1})
+        self._storage.fetch_object(resource_id)['a'] = 2
+
+        self.assertEqual(self._storage.fetch_object(resource_id), {'a': 1})
+
+    def test_delete_invalidates_cache(self):
+        resource_id = '123'
+
+        self._storage.store_object(resource_id, {'a': 1})
+        self._storage.delete(resource_id)
+
+        with self.assertRaises(ObjectDoesNotExistError):
+            self._storage.fetch_object(resource_id)
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._container = 'container'
+        mkdir(join(self._folder, self._container))
+        self._cache = MemoryBytesCache(max_bytes=1024)
+        self._storage = AzureObjectStorage(
+            account=self._folder,
+            key='unused',
+            container=self._container,
+            provider='LOCAL',
+            cache=self._cache,
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
+
+
+class AzureEmailStorageTests(TestCase):
+
+    def test_stores_attachments_separately_and_deduplicated(self):
+        attachment = {'filename': 'report.pdf', 'content': b'pdf content'}
+
+        self._storage.store_object('email1', {'_uid': 'email1', 'attachments': [dict(attachment)]})
+        self._storage.store_object('email2', {'_uid': 'email2', 'attachments': [dict(attachment)]})
+
+        self.assertEqual(len(listdir(join(self._folder, self._attachments_container))), 1)
+
+        lazy = self._storage.fetch_object('email1', with_attachments=False)
+        self.assertNotIn('content', lazy['attachments'][0])
+        self.assertEqual(lazy['attachments'][0]['size'], len(attachment['content']))
+        self.assertEqual(self._storage.fetch_attachment(lazy['attachments'][0]), attachment['content'])
+
+        emails = list(self._storage.fetch_many_objects(['email1', 'email2']))
+        self.assertEqual([email['attachments'] for email in emails], [[attachment], [attachment]])
+
+    def test_stores_streamed_attachments(self):
+        content = b'pdf content' * 1000
+        attachment_storage = self._storage._attachment_storage
+
+        content_id = attachment_storage.store_attachment_file('content-id', BytesIO(content), len(content))
+        attachment_storage.store_attachment_file('content-id', BytesIO(b'ignored'))
+
+        self.assertEqual(content_id, 'content-id')
+        self.assertEqual(attachment_storage.fetch_attachment(content_id), content)
+        self.assertEqual(len(listdir(join(self._folder, self._attachments_container))), 1)
+
+    def test_stores_forwarded_lazy_attachments_by_reference(self):
+        self._storage.store_object('email1', {'attachments': [{'filename': 'a.txt', 'content': b'a'}]})
+        lazy = self._storage.fetch_object('email1', with_attachments=False)
+
+        self._storage.store_object('email2', {'attachments': lazy['attachments']})
+
+        self.assertEqual(self._storage.fetch_object('email2')['attachments'], [{'filename': 'a.txt', 'content': b'a'}])
+        self.assertEqual(len(listdir(join(self._folder, self._attachments_container))), 1)
+
+    def test_keeps_attachment_references_without_separating(self):
+        content_id = self._storage._attachment_storage.store_attachment_file('content-id', BytesIO(b'pdf content'))
+        inline_storage = AzureEmailStorage(
+            account=self._folder,
+            key='unused',
+            container=self._container,
+            provider='LOCAL',
+            attachment_storage=self._storage._attachment_storage,
+        )
+        reference = {'filename': 'report.pdf', 'content_id': content_id, 'size': 11}
+
+        inline_storage.store_object('email1', {'attachments': [reference]})
+
+        self.assertEqual(inline_storage.fetch_object('email1', with_attachments=False)['attachments'], [reference])
+        self.assertEqual(
+            inline_storage.fetch_object('email1')['attachments'],
+            [{'filename': 'report.pdf', 'content': b'pdf content'}])
+
+    def test_reads_inline_attachments(self):
+        inline_storage = AzureEmailStorage(
+            account=self._folder,
+            key='unused',
+            container=self._container,
+            provider='LOCAL',
+        )
+        given = {'attachments': [{'filename': 'a.txt', 'content': b'a'}]}
+
+        inline_storage.store_object('email1', given)
+
+        self.assertEqual(self._storage.fetch_object('email1'), given)
+        self.assertEqual(self._storage.fetch_object('email1', with_attachments=False), given)
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._container = 'container'
+        self._attachments_container = 'attachments'
+        mkdir(join(self._folder, self._container))
+        mkdir(join(self._folder, self._attachments_container))
+        self._storage = AzureEmailStorage(
+            account=self._folder,
+            key='unused',
+            container=self._container,
+            provider='LOCAL',
+            attachment_storage=AzureAttachmentStorage(
+                account=self._folder,
+                key='unused',
+                container=self._attachments_container,
+                provider='LOCAL',
+            ),
+            separate_attachments=True,
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
+
+
+class AzureBundleStorageTests(TestCase):
+
+    def test_prebuilt_bundles_are_readable_archives(self):
+        self._storage.add(['foo.com', 'bar.com'], 'email1', to_jsonl_bytes({'_uid': 'email1'}))
+        self._storage.add(['foo.com'], 'email2', to_jsonl_bytes({'_uid': 'email2'}))
+        self._storage.add(['foo.com'], 'email3', to_jsonl_bytes({'_uid': 'email3'}))
+
+        bundle = self._storage.fetch('foo.com', ['email3', 'email1', 'email4'])
+        frames = [email.frame for email in bundle.emails]
+        resource_id = self._client_storage.store_frames([('emails.jsonl', frames, sum(e.size for e in bundle.emails))])
+
+        self.assertEqual([email.email_id for email in bundle.emails], ['email1', 'email3'])
+        self.assertTrue(resource_id.endswith('.tar.zstd'))
+        emails = list(self._client_storage.fetch_objects(resource_id, ('emails.jsonl', from_jsonl_bytes)))
+        self.assertEqual(emails, [{'_uid': 'email1'}, {'_uid': 'email3'}])
+
+    def test_empty_bundles_are_not_stored(self):
+        bundle = self._storage.fetch('foo.com', ['email1'])
+
+        self.assertEqual(bundle.emails, [])
+        self.assertIsNone(self._client_storage.store_frames([('emails.jsonl', [], 0)]))
+
+    def test_prebuilt_bundles_keep_attachments_separately(self):
+        attachments = [('attachment1', b'"content":"YQ=="}\n'), ('attachment2', b'"content":"Yg=="}\n')]
+        self._storage.add(['foo.com'], 'email1', to_jsonl_bytes({'_uid': 'email1'}), 1, attachments[:1])
+        self._storage.add(['foo.com'], 'email2', to_jsonl_bytes({'_uid': 'email2'}), 1, attachments[1:])
+
+        bundle = self._storage.fetch('foo.com', ['email1'])
+
+        self.assertEqual([email.attachment_ids for email in bundle.emails], [['attachment1']])
+        self.assertEqual(list(bundle.attachments), ['attachment1'])
+        attachment = bundle.attachments['attachment1']
+        prefix = b'{"emails":["email1"],'
+        resource_id = self._client_storage.store_frames([
+            ('emails.jsonl', [bundle.emails[0].frame], bundle.emails[0].size),
+            ('zattachments.jsonl', [self._storage.compress(prefix), attachment.frame], len(prefix) + attachment.size),
+        ])
+        fetched = list(self._client_storage.fetch_objects(resource_id, ('zattachments.jsonl', from_jsonl_bytes)))
+        self.assertEqual(fetched, [{'emails': ['email1'], 'content': 'YQ=='}])
+
+    def test_acknowledge_deletes_closed_segments(self):
+        self._storage.add(['foo.com'], 'email1', b'{}\n')
+        self._now += timedelta(hours=3)
+        self._storage.add(['foo.com'], 'email2', b'{}\n')
+
+        self._storage.acknowledge('foo.com', ['email2'])
+
+        self.assertEqual(listdir(join(self._folder, 'bundles', 'foo.com', 'segments')), ['2020010103'])
+        self.assertEqual([email.email_id for email in self._storage.fetch('foo.com', ['email2']).emails], ['email2'])
+
+    def test_acknowledge_skips_delivered_records_on_fetch(self):
+        attachments = [('attachment1', b'"content":"YQ=="}\n')]
+        self._storage.add(['foo.com'], 'email1', b'{}\n', 0, attachments)
+        self._storage.add(['foo.com'], 'email2', b'{}\n')
+        self._storage.add(['foo.com'], 'email3', b'{}\n', 0, attachments)
+
+        self._storage.acknowledge('foo.com', ['email2', 'email3'])
+        self._storage.add(['foo.com'], 'email4', b'{}\n')
+
+        with patch.object(AzureFileStorage,
+                          'fetch_bytes_from',
+                          autospec=True,
+                          side_effect=AzureFileStorage.fetch_bytes_from) as fetch_bytes_from:
+            bundle = self._storage.fetch('foo.com', ['email1', 'email3', 'email4'])
+
+        (_, _, offset), _ = fetch_bytes_from.call_args
+        self.assertGreater(offset, 0)
+        self.assertEqual([email.email_id for email in bundle.emails], ['email3', 'email4'])
+        self.assertEqual(list(bundle.attachments), ['attachment1'])
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._now = datetime(2020, 1, 1, 0, 30)
+        self._storage = AzureBundleStorage(
+            log_storage=AzureFileStorage(
+                account=self._folder,
+                key='key',
+                container='bundles',
+                provider='LOCAL',
+            ),
+            compression_level=3,
+            clock=lambda: self._now,
+        )
+        self._client_storage = AzureObjectsStorage(
+            file_storage=AzureFileStorage(
+                account=self._folder,
+                key='key',
+                container='packages',
+                provider='LOCAL',
+            ),
+            resource_id_source=NewGuid(0),
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
+
+
+class AzurePendingStorageTests(TestCase):
+
+    def test_fetches_and_acknowledges_pending_emails(self):
+        self._storage.enqueue('foo.com', 'email1')
+        self._storage.enqueue('foo.com', 'email2')
+        self._storage.enqueue('bar.com', 'email3')
+
+        pending = self._storage.fetch('foo.com')
+        self._storage.enqueue('foo.com', 'email4')
+        self._storage.acknowledge(pending)
+
+        self.assertEqual(pending.email_ids, ['email1', 'email2'])
+        self.assertEqual(self._storage.fetch('foo.com').email_ids, ['email4'])
+        self.assertEqual(self._storage.count('bar.com'), 1)
+
+    def test_requeues_undelivered_emails(self):
+        self._storage.enqueue('foo.com', 'email1')
+        self._storage.enqueue('foo.com', 'email2')
+        self._storage.enqueue('foo.com', 'email3')
+
+        pending = self._storage.fetch('foo.com')
+        self._storage.acknowledge(pending, ['email2'])
+
+        self.assertEqual(self._storage.fetch('foo.com').email_ids, ['email1', 'email3'])
+
+    def test_keeps_estimates_of_requeued_emails(self):
+        self._storage.enqueue('foo.com', 'email1', 100, 1)
+        self._storage.enqueue('foo.com', 'email2')
+        self._storage.enqueue('foo.com', 'email3', 50, 0)
+
+        pending = self._storage.fetch('foo.com')
+        self._storage.acknowledge(pending, ['email3'])
+
+        self.assertEqual(pending.estimates, {'email1': [100, 1], 'email3': [50, 0]})
+        self.assertEqual(self._storage.fetch('foo.com').estimates, {'email1': [100, 1]})
+
+    def test_stores_outstanding_deliveries(self):
+        self._storage.enqueue('foo.com', 'email1')
+        pending = self._storage.fetch('foo.com')
+
+        self.assertIsNone(self._storage.fetch_delivery('foo.com'))
+
+        self._storage.store_delivery(Delivery('resource', pending, ['email1']))
+        delivery = self._storage.fetch_delivery('foo.com')
+
+        self.assertEqual(delivery, Delivery('resource', pending, ['email1']))
+        self.assertEqual(self._storage.fetch('foo.com').email_ids, ['email1'])
+
+        self._storage.delete_delivery('foo.com')
+
+        self.assertIsNone(self._storage.fetch_delivery('foo.com'))
+
+    def test_compacts_drained_segments(self):
+        self._storage.enqueue('foo.com', 'email1')
+        self._now += timedelta(hours=3)
+        self._storage.enqueue('foo.com', 'email2')
+
+        pending = self._storage.fetch('foo.com')
+        self._storage.acknowledge(pending)
+
+        self.assertEqual(pending.email_ids, ['email1', 'email2'])
+        self.assertEqual(pending.drained, ['2020010100'])
+        self.assertEqual(listdir(join(self._folder, 'log', 'foo.com', 'segments')), ['2020010103'])
+        self.assertEqual(self._storage.fetch('foo.com').email_ids, [])
+
+    def test_reads_and_migrates_legacy_pending_emails(self):
+        self._legacy_storage.store_text('foo.com/email1', 'pending')
+        self._storage.enqueue('foo.com', 'email2')
+
+        pending = self._storage.fetch('foo.com')
+        self.assertEqual(pending.email_ids, ['email2', 'email1'])
+
+        num_migrated = self._storage.migrate(self._legacy_storage)
+
+        self.assertEqual(num_migrated, 1)
+        self.assertEqual(list(self._legacy_storage.iter()), [])
+        self.assertEqual(self._storage.fetch('foo.com').email_ids, ['email2', 'email1'])
+
+    def test_deletes_prefix(self):
+        self._legacy_storage.store_text('foo.com/email1', 'pending')
+        self._storage.enqueue('foo.com', 'email2')
+        self._storage.enqueue('bar.com', 'email3')
+
+        self._storage.delete_prefix('foo.com/')
+
+        self.assertEqual(self._storage.count('foo.com'), 0)
+        self.assertEqual(self._storage.count('bar.com'), 1)
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._now = datetime(2020, 1, 1, 0, 30)
+        self._legacy_storage = AzureTextStorage(
+            account=self._folder,
+            key='key',
+            container='legacy',
+            provider='LOCAL',
+        )
+        self._storage = AzurePendingStorage(
+            log_storage=AzureFileStorage(
+                account=self._folder,
+                key='key',
+                container='log',
+                provider='LOCAL',
+            ),
+            legacy_storage=self._legacy_storage,
+            clock=lambda: self._now,
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
+
+
+class AzureMailboxIndexTests(TestCase):
+
+    def test_lists_entries_newest_first(self):
+        self._index.add('foo.com/a@foo.com/received', [self._entry(2), self._entry(3)])
+        self._index.add('foo.com/a@foo.com/received', [self._entry(1)])
+        self._index.add('foo.com/a@foo.com/sent', [self._entry(4)])
+
+        page1 = self._index.list_page('foo.com/a@foo.com/received', 2)
+        page2 = self._index.list_page('foo.com/a@foo.com/received', 2, page1.cursor)
+
+        self.assertEqual([entry.email_id for entry in page1.entries], ['email1', 'email2'])
+        self.assertEqual(page1.entries[0].summary, {'subject': 'subject1'})
+        self.assertEqual([entry.email_id for entry in page2.entries], ['email3'])
+        self.assertIsNone(page2.cursor)
+
+    def test_deletes_entries_with_tombstones(self):
+        self._index.add('foo.com/a@foo.com/received', [self._entry(1), self._entry(2)])
+
+        self._index.delete('foo.com/a@foo.com/received', ['email1', 'unknown'])
+
+        page = self._index.list_page('foo.com/a@foo.com/received', 10)
+        self.assertEqual([entry.email_id for entry in page.entries], ['email2'])
+
+    def test_merges_segments(self):
+        for i in range(1, 4):
+            self._index.add('foo.com/a@foo.com/received', [self._entry(i)])
+        self._index.delete('foo.com/a@foo.com/received', ['email2'])
+
+        self._index.add('foo.com/a@foo.com/received', [self._entry(4)])
+
+        page = self._index.list_page('foo.com/a@foo.com/received', 10)
+        self.assertEqual([entry.email_id for entry in page.entries], ['email1', 'email3', 'email4'])
+        self.assertEqual(self._segment_ids('foo.com/a@foo.com/received'), ['00000005-m01-0001', '00000005-m01-0000'])
+
+    def test_merges_segments_on_delete(self):
+        for i in range(1, 5):
+            self._index.add('foo.com/a@foo.com/received', [self._entry(i)])
+
+        self._index.delete('foo.com/a@foo.com/received', ['email2'])
+
+        page = self._index.list_page('foo.com/a@foo.com/received', 10)
+        self.assertEqual([entry.email_id for entry in page.entries], ['email1', 'email3', 'email4'])
+        self.assertEqual(self._segment_ids('foo.com/a@foo.com/received'), ['00000005-m01-0001', '00000005-m01-0000'])
+
+    def test_keeps_tombstones_until_merged_into_oldest_level(self):
+        mailbox = 'foo.com/a@foo.com/received'
+        for i in range(1, 6):
+            self._index.add(mailbox, [self._entry(i)])
+        self._index.delete(mailbox, ['email2'])
+        for i in range(6, 10):
+            self._index.add(mailbox, [self._entry(i)])
+
+        self.assertEqual(self._segment_ids(mailbox), [
+            '00000010-m01-0002',
+            '00000010-m01-0001',
+            '00000010-m01-0000',
+            '00000005-m01-0002',
+            '00000005-m01-0001',
+            '00000005-m01-0000',
+        ])
+        self.assertNotIn('email2', [entry.email_id for entry in self._index.list_page(mailbox, 100).entries])
+
+        for i in range(10, 25):
+            self._index.add(mailbox, [self._entry(i)])
+
+        page = self._index.list_page(mailbox, 100)
+        self.assertEqual([entry.email_id for entry in page.entries], [f'email{i}' for i in range(1, 25) if i != 2])
+        self.assertEqual({segment_id.split('-')[1] for segment_id in self._segment_ids(mailbox)}, {'m02'})
+        self.assertEqual(len(self._segment_ids(mailbox)), 12)
+
+    def test_rewrites_each_entry_once_per_level(self):
+        mailbox = 'foo.com/a@foo.com/received'
+        num_inserts = 125
+        num_written = 0
+        write_segment = self._index._write_segment
+
+        def write_segment_mock(mailbox, entries, tombstones, segment_id=None):
+            nonlocal num_written
+            num_written += len(entries)
+            return write_segment(mailbox, entries, tombstones, segment_id)
+
+        with patch.object(self._index, '_write_segment', side_effect=write_segment_mock):
+            for i in range(num_inserts):
+                self._index.add(mailbox, [self._entry(i)])
+
+        # one write when the entry is added and one for each of the three levels it was merged into
+        self.assertEqual(num_written, num_inserts * 4)
+
+    def test_lists_pages_from_the_segments_that_hold_them(self):
+        self._index.add('foo.com/a@foo.com/received', [self._entry(i) for i in range(1, 8)])
+        self._index.delete('foo.com/a@foo.com/received', ['unknown'])
+        self._index.add('foo.com/a@foo.com/received', [self._entry(8)])
+        self._index.delete('foo.com/a@foo.com/received', ['email3'])
+
+        fetched = []
+        fetch_many_objects = self._segment_storage.fetch_many_objects
+
+        def fetch_many_objects_mock(resource_ids):
+            resource_ids = list(resource_ids)
+            fetched.extend(resource_id.split('~')[0] for resource_id in resource_ids)
+            return fetch_many_objects(resource_ids)
+
+        with patch.object(self._segment_storage, 'fetch_many_objects', side_effect=fetch_many_objects_mock):
+            page1 = self._index.list_page('foo.com/a@foo.com/received', 2)
+            page2 = self._index.list_page('foo.com/a@foo.com/received', 2, page1.cursor)
+
+        self.assertEqual([entry.email_id for entry in page1.entries], ['email1', 'email2'])
+        self.assertEqual([entry.email_id for entry in page2.entries], ['email4', 'email5'])
+        self.assertEqual(sorted(fetched), [
+            'foo.com/a@foo.com/received/00000005-m01-0000',
+            'foo.com/a@foo.com/received/00000005-m01-0001',
+            'foo.com/a@foo.com/received/00000005-m01-0001',
+            'foo.com/a@foo.com/received/00000005-m01-0002',
+            'foo.com/a@foo.com/received/00000007',
+            'foo.com/a@foo.com/received/00000007',
+        ])
+
+    def test_iterates_recently_indexed_emails_first(self):
+        self._index.add('foo.com/a@foo.com/received', [self._entry(3), self._entry(4)])
+        self._index.add('bar.com/b@bar.com/received', [self._entry(1)])
+        self._index.delete('bar.com/b@bar.com/received', ['email1'])
+        self._index.add('foo.com/a@foo.com/sent', [self._entry(2)])
+
+        email_ids = list(self._index.iter_recent_email_ids())
+
+        self.assertEqual(email_ids, ['email2', 'email1', 'email3', 'email4'])
+
+    def test_deletes_prefix(self):
+        self._index.add('foo.com/a@foo.com/received', [self._entry(1)])
+        self._index.add('bar.com/b@bar.com/received', [self._entry(2)])
+
+        self._index.delete_prefix('foo.com/')
+
+        self.assertEqual(self._index.list_page('foo.com/a@foo.com/received', 10).entries, [])
+        self.assertEqual(len(self._index.list_page('bar.com/b@bar.com/received', 10).entries), 1)
+
+    @classmethod
+    def _entry(cls, i: int) -> MailboxEntry:
+        return MailboxEntry(f'{i:03d}/email{i}', f'email{i}', {'subject': f'subject{i}'})
+
+    def _segment_ids(self, mailbox: str) -> List[str]:
+        return [name.split('~')[0] for name in sorted(self._segment_storage.iter(f'{mailbox}/'), reverse=True)]
+
+    def _new_segment_id(self) -> str:
+        self._num_segments += 1
+        return f'{self._num_segments:08d}'
+
+    def setUp(self):
+        self._folder = mkdtemp()
+        self._num_segments = 0
+        self._segment_storage = AzureObjectStorage(
+            account=self._folder,
+            key='key',
+            container='index',
+            provider='LOCAL',
+        )
+        self._index = AzureMailboxIndex(
+            segment_storage=self._segment_storage,
+            max_segments=4,
+            max_segment_entries=2,
+            segment_id_source=self._new_segment_id,
+        )
+
+    def tearDown(self):
+        rmtree(self._folder)
@@ -1,6 +1,8 @@
 from collections import defaultdict
 from copy import deepcopy
+from io import BytesIO
 from unittest import TestCase
+from unittest.mock import ANY
 from unittest.mock import MagicMock
 from unittest.mock import Mock
 from unittest.mock import patch
@@ -8,10 +10,20 @@ from unittest.mock import patch
 from libcloud.storage.types import ObjectDoesNotExistError
 
 from opwen_email_server import actions
+from opwen_email_server.constants import events
 from opwen_email_server.constants import sync
 from opwen_email_server.services.storage import AccessInfo
+from opwen_email_server.services.storage import BundledAttachment
+from opwen_email_server.services.storage import BundledEmail
+from opwen_email_server.services.storage import Delivery
+from opwen_email_server.services.storage import MailboxEntry
+from opwen_email_server.services.storage import PendingEmails
+from opwen_email_server.services.storage import PrebuiltBundle
+from opwen_email_server.utils.email_parser import estimate_delivery_size
+from opwen_email_server.utils.email_parser import summarize_email
 from opwen_email_server.utils.serialization import from_jsonl_bytes
 from opwen_email_server.utils.serialization import to_jsonl_bytes
+from opwen_email_server.utils.serialization import to_msgpack_record
 from tests.opwen_email_server.helpers import throw
 
 
@@ -86,7 +98,7 @@ class SendOutboundEmailsTests(TestCase):
 class StoreInboundEmailsTests(TestCase):
 
     def setUp(self):
-        self.raw_email_storage = Mock()
+        self.raw_email_storage = MagicMock()
         self.email_storage = Mock()
         self.pending_storage = Mock()
         self.email_parser = MagicMock()
@@ -95,36 +107,36 @@ class StoreInboundEmailsTests(TestCase):
     def test_202(self):
         resource_id = 'eb93fde9-0cc6-4339-b7d6-f6e838e78f1c'
 
-        self.raw_email_storage.fetch_text.side_effect = throw(ObjectDoesNotExistError(None, None, None))
+        self.raw_email_storage.open_bytes.side_effect = throw(ObjectDoesNotExistError(None, None, None))
 
         _, status = self._execute_action(resource_id)
 
         self.assertEqual(status, 202)
-        self.raw_email_storage.fetch_text.assert_called_once_with(resource_id)
+        self.raw_email_storage.open_bytes.assert_called_once_with(resource_id)
         self.assertFalse(self.raw_email_storage.delete.called)
         self.assertFalse(self.email_storage.store_object.called)
-        self.assertFalse(self.pending_storage.store_text.called)
+        self.assertFalse(self.pending_storage.enqueue.called)
         self.assertFalse(self.email_parser.called)
 
     def test_200(self):
         resource_id = 'b8dcaf40-fd14-4a89-8898-c9514b0ad724'
         domain = 'test.lokole.ca'
-        raw_email = 'dummy-mime'
+        raw_email = BytesIO(b'dummy-mime')
         parsed_email = {'to': [f'foo@{domain}', 'bar@test.com'], 'sent_at': '2020-02-01 21:17'}
         email_id = '03cbd3b41deca5f92a1d25cc0c50a6eae908d23770fd47ebca0d614eef96a46e'
         stored_email = dict(parsed_email)
         stored_email['_uid'] = email_id
 
-        self.raw_email_storage.fetch_text.return_value = raw_email
+        self.raw_email_storage.open_bytes.return_value.__enter__.return_value = raw_email
         self.email_parser.return_value = parsed_email
 
         _, status = self._execute_action(resource_id)
 
         self.assertEqual(status, 200)
-        self.raw_email_storage.fetch_text.assert_called_once_with(resource_id)
+        self.raw_email_storage.open_bytes.assert_called_once_with(resource_id)
         self.raw_email_storage.delete.assert_called_once_with(resource_id)
         self.email_storage.store_object.assert_called_once_with(email_id, stored_email)
-        self.pending_storage.store_text.assert_called_once_with(f'{domain}/{email_id}', 'pending')
+        self.pending_storage.enqueue.assert_called_once_with(domain, email_id, estimate_delivery_size(stored_email), 0)
         self.email_parser.assert_called_once_with(raw_email)
         self.next_task.assert_called_once_with(email_id)
 
@@ -144,7 +156,7 @@ class IndexReceivedEmailForMailboxTests(TestCase):
 
     def setUp(self):
         self.email_storage = Mock()
-        self.mailbox_storage = Mock()
+        self.mailbox_index = Mock()
 
     def test_200(self):
         email_id = '123'
@@ -158,17 +170,36 @@ class IndexReceivedEmailForMailboxTests(TestCase):
         _, status = self._execute_action(email_id)
 
         self.assertEqual(status, 200)
-        self.email_storage.fetch_object.assert_called_once_with(email_id)
-        self.mailbox_storage.store_text.assert_any_call('bar.lokole.ca/1@bar.lokole.ca/received/527869980/123',
-                                                        'indexed')
-        self.mailbox_storage.store_text.assert_any_call('baz.lokole.ca/2@baz.lokole.ca/received/527869980/123',
-                                                        'indexed')
-        self.assertEqual(self.mailbox_storage.store_text.call_count, 2)
+        self.email_storage.fetch_object.assert_called_once_with(email_id, with_attachments=False)
+        entries = [MailboxEntry('527869980/123', '123', summarize_email(email))]
+        self.mailbox_index.add.assert_any_call('bar.lokole.ca/1@bar.lokole.ca/received', entries)
+        self.mailbox_index.add.assert_any_call('baz.lokole.ca/2@baz.lokole.ca/received', entries)
+        self.assertEqual(self.mailbox_index.add.call_count, 2)
+
+    def test_stores_summary_without_attachment_content(self):
+        email = {
+            'to': ['1@bar.lokole.ca'],
+            'sent_at': '2019-10-26 22:47',
+            'from': 'foo@foo',
+            'subject': 'subject',
+            'body': '<p>Hello <b>there</b></p>',
+            'attachments': [{'filename': 'a.txt', 'content': b'12345'}],
+        }
+
+        self.email_storage.fetch_object.return_value = email
+
+        self._execute_action('123')
+
+        (_, [entry]), _ = self.mailbox_index.add.call_args
+        summary = entry.summary
+        self.assertEqual(summary['snippet'], 'Hello there')
+        self.assertEqual(summary['attachments'], [{'_uid': 0, 'filename': 'a.txt', 'cid': None, 'size': 5}])
+        self.assertNotIn('body', summary)
 
     def _execute_action(self, *args, **kwargs):
         action = actions.IndexReceivedEmailForMailbox(
             email_storage=self.email_storage,
-            mailbox_storage=self.mailbox_storage,
+            mailbox_index=self.mailbox_index,
         )
 
         return action(*args, **kwargs)
@@ -178,7 +209,7 @@ class IndexSentEmailForMailboxTests(TestCase):
 
     def setUp(self):
         self.email_storage = Mock()
-        self.mailbox_storage = Mock()
+        self.mailbox_index = Mock()
 
     def test_200(self):
         email_id = '123'
@@ -192,14 +223,16 @@ class IndexSentEmailForMailboxTests(TestCase):
         _, status = self._execute_action(email_id)
 
         self.assertEqual(status, 200)
-        self.email_storage.fetch_object.assert_called_once_with(email_id)
-        self.mailbox_storage.store_text.assert_called_once_with('foo.lokole.ca/foo@foo.lokole.ca/sent/527869980/123',
-                                                                'indexed')
+        self.email_storage.fetch_object.assert_called_once_with(email_id, with_attachments=False)
+        self.mailbox_index.add.assert_called_once_with(
+            'foo.lokole.ca/foo@foo.lokole.ca/sent',
+            [MailboxEntry('527869980/123', '123', summarize_email(email))],
+        )
 
     def _execute_action(self, *args, **kwargs):
         action = actions.IndexSentEmailForMailbox(
             email_storage=self.email_storage,
-            mailbox_storage=self.mailbox_storage,
+            mailbox_index=self.mailbox_index,
         )
 
         return action(*args, **kwargs)
@@ -252,6 +285,51 @@ class StoreWrittenClientEmailsTests(TestCase):
         self.user_storage.store_object.assert_called_once_with(f'developer1.lokole.ca/{user_email}', user)
         self.client_storage.delete.assert_called_once_with(resource_id)
 
+    def test_200_msgpack(self):
+        user = {'email': 'clemens@lokole.ca', 'password': 'secret'}
+        email = {'from': 'foo@test.com', '_uid': '123', 'attachments': [{'filename': 'a', 'content': b'\n\x00'}]}
+
+        self.client_storage.fetch_records.side_effect = [[deepcopy(email)], [user]]
+
+        _, status = self._execute_action('resource', 'msgpack')
+
+        self.assertEqual(status, 200)
+        self.client_storage.fetch_records.assert_any_call('resource', sync.EMAILS_MSGPACK_FILE)
+        self.client_storage.fetch_records.assert_any_call('resource', sync.USERS_MSGPACK_FILE)
+        self.client_storage.fetch_objects.assert_not_called()
+        self.email_storage.store_object.assert_called_once_with('123', email)
+        self.user_storage.store_object.assert_called_once_with('lokole.ca/clemens@lokole.ca', user)
+
+    def test_200_deduplicated_attachments(self):
+        attachment = {'_uid': 'abc', 'emails': ['1', '2'], 'filename': 'a.txt', 'content': 'c29tZSBmaWxlIGNvbnRlbnQ='}
+        emails = [{'from': 'foo@test.com', '_uid': '1'}, {'from': 'foo@test.com', '_uid': '2', 'attachments': []}]
+
+        self.client_storage.fetch_objects.side_effect = [[attachment], emails, []]
+
+        _, status = self._execute_action('resource', 'jsonl', 'deduplicated')
+
+        self.assertEqual(status, 200)
+        self.client_storage.fetch_objects.assert_any_call('resource', (sync.ATTACHMENTS_FILE, from_jsonl_bytes))
+        stored = {args[0]: args[1] for args, _ in self.email_storage.store_object.call_args_list}
+        expected = [{'filename': 'a.txt', 'content': b'some file content'}]
+        self.assertEqual(stored['1']['attachments'], expected)
+        self.assertEqual(stored['2']['attachments'], expected)
+
+    def test_200_deduplicated_without_attachments_file(self):
+
+        def missing_attachments():
+            raise ObjectDoesNotExistError(None, None, None)
+            yield  # pragma: no cover
+
+        self.client_storage.fetch_objects.side_effect = [
+            missing_attachments(), [{'from': 'foo@test.com', '_uid': '1'}], []
+        ]
+
+        _, status = self._execute_action('resource', 'jsonl', 'deduplicated')
+
+        self.assertEqual(status, 200)
+        self.email_storage.store_object.assert_called_once_with('1', {'from': 'foo@test.com', '_uid': '1'})
+
     def _execute_action(self, *args, **kwargs):
         action = actions.StoreWrittenClientEmails(
             client_storage=self.client_storage,
@@ -295,7 +373,7 @@ class ReceiveInboundEmailTests(TestCase):
 
         self.assertEqual(status, 200)
         self.auth.domain_for.assert_called_once_with(client_id)
-        self.raw_email_storage.store_text.assert_called_once_with(email_id, email)
+        self.raw_email_storage.store_bytes.assert_called_once_with(email_id, email.encode('utf-8'))
         self.next_task.assert_called_once_with(email_id)
 
     def test_is_idempotent(self):
@@ -310,7 +388,7 @@ class ReceiveInboundEmailTests(TestCase):
             _, status = self._execute_action(client_id, email)
             self.assertEqual(status, 200)
 
-        self.assertHasSameCalls(self.raw_email_storage.store_text, num_repeated_emails)
+        self.assertHasSameCalls(self.raw_email_storage.store_bytes, num_repeated_emails)
         self.assertHasSameCalls(self.next_task, num_repeated_emails)
 
     def assertHasSameCalls(self, mocked_function, num_calls):
@@ -331,7 +409,7 @@ class ReceiveInboundEmailTests(TestCase):
 class ProcessServiceEmailTests(TestCase):
 
     def setUp(self):
-        self.raw_email_storage = Mock()
+        self.raw_email_storage = MagicMock()
         self.email_storage = Mock()
         self.next_task = MagicMock()
         self.registry = {'service@lokole.ca': (lambda email: email)}
@@ -339,22 +417,25 @@ class ProcessServiceEmailTests(TestCase):
 
     def test_202(self):
         resource_id = 'eb93fde9-0cc6-4339-b7d6-f6e838e78f1c'
-        self.raw_email_storage.fetch_text.side_effect = throw(ObjectDoesNotExistError(None, None, None))
+        self.raw_email_storage.open_bytes.side_effect = throw(ObjectDoesNotExistError(None, None, None))
 
         _, status = self._execute_action(resource_id)
         self.assertEqual(status, 202)
+        self.assertFalse(self.email_parser.called)
 
     def test_200(self):
         resource_id = 'eb93fde9-0cc6-4339-b7d6-f6e838e78f1c'
-        email = 'some-mime'
+        email = BytesIO(b'some-mime')
         parsed_email = {
             'to': ['service@lokole.ca', 'foo@test.com'], 'from': 'user@lokole.ca', 'sent_at': '2020-02-01 21:17'
         }
-        self.raw_email_storage.return_value = email
+        self.raw_email_storage.open_bytes.return_value.__enter__.return_value = email
         self.email_parser.return_value = parsed_email
 
         _, status = self._execute_action(resource_id)
         self.assertEqual(status, 200)
+        self.raw_email_storage.open_bytes.assert_called_once_with(resource_id)
+        self.email_parser.assert_called_once_with(email)
         self.email_storage.store_object.assert_called_once()
         self.next_task.assert_called_once()
 
@@ -376,7 +457,9 @@ class DownloadClientEmailsTests(TestCase):
         self.auth = Mock()
         self.client_storage = Mock()
         self.email_storage = Mock()
+        self.email_storage.cache_stats = {}
         self.pending_storage = Mock()
+        self.bundle_storage = Mock()
 
     def test_400(self):
         client_id = 'af962175-8757-4ac4-a199-2387b06379fa'
@@ -411,6 +494,32 @@ class DownloadClientEmailsTests(TestCase):
             attachment_content_base64=None,
         )
 
+    @patch.object(actions.DownloadClientEmails, 'log_event')
+    def test_200_logs_email_cache_stats(self, mock_log_event):
+        client_id = 'f4e2cdc6-c79c-44ad-af35-071f8ea6e176'
+        email_id = 'b69bee6b-72fb-4b7f-a2ad-9aa7e375cf18'
+        domain = 'test.com'
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = PendingEmails(domain=domain,
+                                                                email_ids=[email_id],
+                                                                watermark={},
+                                                                drained=[],
+                                                                legacy_email_ids=[])
+        self.email_storage.fetch_many_objects.return_value = [{'_uid': email_id}]
+        self.email_storage.cache_stats = {'hits': 3, 'hits_memory': 3, 'misses': 1}
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        self._execute_action(client_id, 'gz')
+
+        mock_log_event.assert_called_once_with(events.EMAILS_DELIVERED_TO_CLIENT, {
+            'domain': domain,
+            'num_emails': 1,
+            'hits': 3,
+            'hits_memory': 3,
+            'misses': 1,
+        })
+
     def _test_200(self, attachment_content_bytes, attachment_content_base64):
         client_id = 'f4e2cdc6-c79c-44ad-af35-071f8ea6e176'
         email_id = 'b69bee6b-72fb-4b7f-a2ad-9aa7e375cf18'
@@ -425,11 +534,13 @@ class DownloadClientEmailsTests(TestCase):
         if attachment_content_base64:
             client_email['attachments'][0]['content'] = attachment_content_base64
 
+        pending = PendingEmails(domain=domain, email_ids=[email_id], watermark={}, drained=[], legacy_email_ids=[])
+
         _stored = defaultdict(list)
         _compression = defaultdict(list)
         _serializers = defaultdict(list)
 
-        def store_objects_mock(upload, compression):
+        def store_objects_mock(upload, compression, dictionary):
             name, emails, serializer = upload
             _stored[name].extend(emails)
             _compression[name].append(compression)
@@ -437,8 +548,8 @@ class DownloadClientEmailsTests(TestCase):
             return resource_id
 
         self.auth.domain_for.return_value = domain
-        self.pending_storage.iter.return_value = [email_id]
-        self.email_storage.fetch_object.return_value = server_email
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.side_effect = lambda email_ids: [server_email for _ in email_ids]
         self.client_storage.store_objects.side_effect = store_objects_mock
         self.client_storage.compression_formats.return_value = ['gz']
 
@@ -446,19 +557,408 @@ class DownloadClientEmailsTests(TestCase):
 
         self.assertEqual(response.get('resource_id'), resource_id)
         self.auth.domain_for.assert_called_once_with(client_id)
-        self.pending_storage.iter.assert_called_once_with(f'{domain}/')
-        self.pending_storage.delete.assert_called_once_with(f'{domain}/{email_id}')
-        self.email_storage.fetch_object.assert_called_once_with(email_id)
+        self.pending_storage.fetch.assert_called_once_with(domain)
+        self.pending_storage.acknowledge.assert_called_once_with(pending, [email_id])
+        self.email_storage.fetch_many_objects.assert_called_once_with([email_id])
         self.assertEqual(_stored[sync.EMAILS_FILE], [client_email])
         self.assertEqual(_compression[sync.EMAILS_FILE], ['gz'])
         self.assertEqual(_serializers[sync.EMAILS_FILE], [to_jsonl_bytes])
 
-    def _execute_action(self, *args, **kwargs):
+    def test_200_prebuilt(self):
+        domain = 'test.com'
+        pending = PendingEmails(domain=domain, email_ids=['1', '2'], watermark={}, drained=[], legacy_email_ids=[])
+        bundle = PrebuiltBundle(
+            domain=domain,
+            emails=[BundledEmail('1', 0, 10, b'frame1', []),
+                    BundledEmail('2', 1, 5, b'stripped', ['abc'])],
+            attachments={})
+        missing_email = {'_uid': '2', 'attachments': [{'filename': 'a.txt', 'content': b'some file content'}]}
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.bundle_storage.fetch.return_value = bundle
+        self.bundle_storage.compress.return_value = b'frame2'
+        self.email_storage.fetch_many_objects.return_value = [missing_email]
+        self.client_storage.compression_formats.return_value = ['gz', 'zstd']
+        self.client_storage.store_frames.return_value = 'resource'
+
+        response = self._execute_action('client', 'zstd', bundle_storage=self.bundle_storage)
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.bundle_storage.fetch.assert_called_once_with(domain, ['1', '2'])
+        self.email_storage.fetch_many_objects.assert_called_once_with(['2'])
+        missing_content = to_jsonl_bytes(
+            {'_uid': '2', 'attachments': [{'filename': 'a.txt', 'content': 'c29tZSBmaWxlIGNvbnRlbnQ='}]})
+        (members, ), _ = self.client_storage.store_frames.call_args
+        self.assertEqual(len(members), 1)
+        name, frames, num_bytes = members[0]
+        self.assertEqual(name, sync.EMAILS_FILE)
+        self.assertEqual(list(frames), [b'frame1', b'frame2'])
+        self.assertEqual(num_bytes, 10 + len(missing_content))
+        self.client_storage.store_objects.assert_not_called()
+        self.bundle_storage.compress.assert_called_once_with(missing_content)
+        self.bundle_storage.acknowledge.assert_called_once_with(domain, ['1', '2'])
+        self.pending_storage.acknowledge.assert_called_once_with(pending, ['1', '2'])
+
+    def test_200_prebuilt_deduplicated_attachments(self):
+        domain = 'test.com'
+        attachment = {'filename': 'a.txt', 'content': b'some file content'}
+        attachment_id = actions._attachment_id(attachment)
+        tail = b'"content":"c29tZSBmaWxlIGNvbnRlbnQ=","filename":"a.txt","_uid":"' + attachment_id.encode() + b'"}\n'
+        pending = PendingEmails(domain=domain, email_ids=['1', '2'], watermark={}, drained=[], legacy_email_ids=[])
+        bundle = PrebuiltBundle(domain=domain,
+                                emails=[BundledEmail('1', 1, 10, b'frame1', [attachment_id])],
+                                attachments={attachment_id: BundledAttachment(attachment_id, len(tail), b'tail')})
+        missing_email = {'_uid': '2', 'attachments': [dict(attachment)]}
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.bundle_storage.fetch.return_value = bundle
+        self.bundle_storage.compress.side_effect = lambda content: b'<' + content + b'>'
+        self.email_storage.fetch_many_objects.return_value = [missing_email]
+        self.client_storage.compression_formats.return_value = ['zstd']
+        self.client_storage.store_frames.return_value = 'resource'
+
+        response = self._execute_action('client',
+                                        'zstd',
+                                        attachments='deduplicated',
+                                        bundle_storage=self.bundle_storage)
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        (members, ), _ = self.client_storage.store_frames.call_args
+        (emails_name, email_frames, _), (attachments_name, attachment_frames, num_bytes) = members
+        self.assertEqual(emails_name, sync.EMAILS_FILE)
+        self.assertEqual(list(email_frames), [b'frame1', b'<' + to_jsonl_bytes({'_uid': '2'}) + b'>'])
+        self.assertEqual(attachments_name, sync.ATTACHMENTS_FILE)
+        prefix = b'{"emails":["1","2"],'
+        self.assertEqual(list(attachment_frames), [b'<' + prefix + b'>', b'tail'])
+        self.assertEqual(num_bytes, len(prefix) + len(tail))
+        self.assertEqual(from_jsonl_bytes(prefix + tail),
+                         dict(attachment, content='c29tZSBmaWxlIGNvbnRlbnQ=', emails=['1', '2'], _uid=attachment_id))
+
+    def test_200_acknowledged_delivery_waits_for_acknowledgement(self):
+        pending = PendingEmails(domain='test.com', email_ids=['1'], watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch.return_value = pending
+        self.pending_storage.fetch_delivery.return_value = None
+        self.email_storage.fetch_many_objects.return_value = [{'_uid': '1'}]
+        self.client_storage.compression_formats.return_value = ['gz']
+        self.client_storage.store_objects.return_value = 'resource'
+
+        response = self._execute_action('client', 'gz', delivery='acknowledged')
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.pending_storage.store_delivery.assert_called_once_with(Delivery('resource', pending, ['1']))
+        self.pending_storage.acknowledge.assert_not_called()
+
+    def test_200_acknowledged_delivery_resends_outstanding_part(self):
+        pending = PendingEmails(domain='test.com', email_ids=['1'], watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch_delivery.return_value = Delivery('resource', pending, ['1'])
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        response = self._execute_action('client', 'gz', delivery='acknowledged', acknowledged_resource_id='other')
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.pending_storage.fetch.assert_not_called()
+        self.client_storage.store_objects.assert_not_called()
+        self.pending_storage.acknowledge.assert_not_called()
+
+    def test_200_acknowledged_delivery_completes_acknowledged_part(self):
+        delivered = PendingEmails(domain='test.com', email_ids=['1'], watermark={}, drained=[], legacy_email_ids=[])
+        pending = PendingEmails(domain='test.com', email_ids=[], watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch_delivery.return_value = Delivery('resource', delivered, ['1'])
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.return_value = []
+        self.client_storage.compression_formats.return_value = ['gz']
+        self.client_storage.store_objects.return_value = None
+
+        response = self._execute_action('client',
+                                        'gz',
+                                        delivery='acknowledged',
+                                        acknowledged_resource_id='resource',
+                                        bundle_storage=self.bundle_storage)
+
+        self.assertIsNone(response.get('resource_id'))
+        self.pending_storage.acknowledge.assert_any_call(delivered, ['1'])
+        self.pending_storage.acknowledge.assert_any_call(pending, [])
+        self.bundle_storage.acknowledge.assert_called_with('test.com', [])
+        self.pending_storage.delete_delivery.assert_called_once_with('test.com')
+        self.pending_storage.store_delivery.assert_not_called()
+
+    def test_200_msgpack_keeps_attachment_bytes(self):
+        domain = 'test.com'
+        pending = PendingEmails(domain=domain, email_ids=['1'], watermark={}, drained=[], legacy_email_ids=[])
+        email = {'_uid': '1', 'attachments': [{'filename': 'a.txt', 'content': b'some file content'}]}
+        _stored = []
+
+        def store_objects_mock(upload, compression, dictionary):
+            name, objs, encoder = upload
+            _stored.extend(encoder(obj) for obj in objs)
+            return 'resource'
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.return_value = [deepcopy(email)]
+        self.client_storage.compression_formats.return_value = ['zstd']
+        self.client_storage.store_objects.side_effect = store_objects_mock
+
+        response = self._execute_action('client', 'zstd', format='msgpack', bundle_storage=self.bundle_storage)
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.bundle_storage.fetch.assert_not_called()
+        self.bundle_storage.acknowledge.assert_called_once_with(domain, ['1'])
+        self.client_storage.store_objects.assert_called_once_with((sync.EMAILS_MSGPACK_FILE, ANY, to_msgpack_record),
+                                                                  'zstd', False)
+        self.assertEqual(_stored, [to_msgpack_record(email)])
+
+    def test_400_unknown_format(self):
+        self.auth.domain_for.return_value = 'test.com'
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        _, status = self._execute_action('client', 'gz', format='xml')
+
+        self.assertEqual(status, 400)
+
+    def test_400_unknown_delivery_mode(self):
+        self.auth.domain_for.return_value = 'test.com'
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        _, status = self._execute_action('client', 'gz', delivery='unknown')
+
+        self.assertEqual(status, 400)
+
+    def test_200_delivers_size_capped_parts(self):
+        domain = 'test.com'
+        emails = {
+            'large': {'_uid': 'large', 'body': 'x' * 100},
+            'attachment': {'_uid': 'attachment', 'attachments': [{'filename': 'a.txt', 'content': b'a'}]},
+            'small': {'_uid': 'small', 'body': 'x'},
+            'medium': {'_uid': 'medium', 'body': 'x' * 50},
+        }
+        pending = PendingEmails(domain=domain, email_ids=list(emails), watermark={}, drained=[], legacy_email_ids=[])
+        _stored = []
+
+        def store_archive_mock(uploads, compression, dictionary):
+            for name, lines, encoder in uploads:
+                if name == sync.EMAILS_FILE:
+                    _stored.extend(from_jsonl_bytes(encoder(line)) for line in lines)
+            return 'resource'
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.side_effect = lambda email_ids: [emails[i] for i in email_ids]
+        self.client_storage.store_archive.side_effect = store_archive_mock
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        response = self._execute_action('client', 'gz', max_part_bytes=200)
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.assertEqual([email['_uid'] for email in _stored], ['small', 'medium'])
+        self.pending_storage.acknowledge.assert_called_once_with(pending, ['small', 'medium'])
+
+    def test_200_delivers_emails_larger_than_the_part_cap(self):
+        domain = 'test.com'
+        emails = {
+            'large': {'_uid': 'large', 'body': 'x' * 500},
+            'larger': {'_uid': 'larger', 'body': 'x' * 1000},
+        }
+        pending = PendingEmails(domain=domain, email_ids=list(emails), watermark={}, drained=[], legacy_email_ids=[])
+        _stored = []
+
+        def store_archive_mock(uploads, compression, dictionary):
+            for name, lines, encoder in uploads:
+                if name == sync.EMAILS_FILE:
+                    _stored.extend(from_jsonl_bytes(encoder(line)) for line in lines)
+            return 'resource'
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.side_effect = lambda email_ids: [emails[i] for i in email_ids]
+        self.client_storage.store_archive.side_effect = store_archive_mock
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        self._execute_action('client', 'gz', max_part_bytes=200)
+
+        self.assertEqual([email['_uid'] for email in _stored], ['large'])
+        self.pending_storage.acknowledge.assert_called_once_with(pending, ['large'])
+
+    def test_200_fetches_only_the_emails_of_a_part(self):
+        domain = 'test.com'
+        pending = PendingEmails(domain=domain,
+                                email_ids=['1', '2', '3'],
+                                watermark={},
+                                drained=[],
+                                legacy_email_ids=[],
+                                estimates={
+                                    '1': [150, 0],
+                                    '2': [100, 1],
+                                    '3': [50, 0],
+                                })
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.side_effect = lambda email_ids: [{'_uid': i} for i in email_ids]
+        self.client_storage.store_archive.return_value = 'resource'
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        self._execute_action('client', 'gz', max_part_bytes=200)
+
+        self.email_storage.fetch_many_objects.assert_called_once_with(['3', '1'])
+        self.pending_storage.acknowledge.assert_called_once_with(pending, ['3', '1'])
+
+    @patch.object(actions.DownloadClientEmails, '_measure_batch_size', 2)
+    @patch.object(actions.DownloadClientEmails, '_max_measured_emails', 3)
+    def test_200_measures_unestimated_emails_in_capped_batches(self):
+        domain = 'test.com'
+        emails = {
+            '1': {'_uid': '1', 'body': 'x' * 150},
+            '2': {'_uid': '2', 'body': 'x'},
+            '3': {'_uid': '3', 'body': 'x' * 100},
+            '4': {'_uid': '4', 'body': 'x'},
+        }
+        pending = PendingEmails(domain=domain, email_ids=list(emails), watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = domain
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.side_effect = lambda email_ids: [emails[i] for i in email_ids]
+        self.client_storage.store_archive.return_value = 'resource'
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        self._execute_action('client', 'gz', max_part_bytes=200)
+
+        self.assertEqual([call[0][0] for call in self.email_storage.fetch_many_objects.call_args_list],
+                         [['1', '2'], ['3'], ['3']])
+        self.pending_storage.acknowledge.assert_called_once_with(pending, ['2', '3'])
+
+    def test_200_deduplicates_attachments(self):
+        attachment = {'filename': 'a.txt', 'content': b'some file content'}
+        emails = [
+            {'_uid': '1', 'attachments': [dict(attachment)]},
+            {'_uid': '2', 'attachments': [dict(attachment), {'filename': 'b.txt', 'content': b'other'}]},
+            {'_uid': '3'},
+        ]
+        pending = PendingEmails(domain='test.com',
+                                email_ids=['1', '2', '3'],
+                                watermark={},
+                                drained=[],
+                                legacy_email_ids=[])
+        _stored = defaultdict(list)
+
+        def store_archive_mock(uploads, compression, dictionary):
+            for name, lines, encoder in uploads:
+                _stored[name].extend(from_jsonl_bytes(encoder(line)) for line in lines)
+            return 'resource'
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.return_value = emails
+        self.client_storage.compression_formats.return_value = ['gz']
+        self.client_storage.store_archive.side_effect = store_archive_mock
+
+        response = self._execute_action('client', 'gz', attachments='deduplicated')
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.assertEqual(_stored[sync.EMAILS_FILE], [{'_uid': '1'}, {'_uid': '2'}, {'_uid': '3'}])
+        self.assertEqual([(a['filename'], a['emails']) for a in _stored[sync.ATTACHMENTS_FILE]], [('a.txt', ['1', '2']),
+                                                                                                  ('b.txt', ['2'])])
+        self.assertEqual(_stored[sync.ATTACHMENTS_FILE][0]['content'], 'c29tZSBmaWxlIGNvbnRlbnQ=')
+        self.assertEqual(_stored[sync.ATTACHMENTS_FILE][0]['_uid'], actions._attachment_id(attachment))
+        self.client_storage.store_objects.assert_not_called()
+
+    def test_200_dictionary(self):
+        pending = PendingEmails(domain='test.com', email_ids=['1'], watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.return_value = [{'_uid': '1'}]
+        self.client_storage.compression_formats.return_value = ['zstd']
+        self.client_storage.store_objects.return_value = 'resource'
+
+        response = self._execute_action('client', 'zstd', dictionary=True)
+
+        self.assertEqual(response.get('resource_id'), 'resource')
+        self.client_storage.store_objects.assert_called_once_with((sync.EMAILS_FILE, ANY, to_jsonl_bytes), 'zstd', True)
+
+    def test_400_unknown_attachments_mode(self):
+        self.auth.domain_for.return_value = 'test.com'
+        self.client_storage.compression_formats.return_value = ['gz']
+
+        _, status = self._execute_action('client', 'gz', attachments='unknown')
+
+        self.assertEqual(status, 400)
+
+    def test_200_prebuilt_falls_back_for_other_compressions(self):
+        pending = PendingEmails(domain='test.com', email_ids=[], watermark={}, drained=[], legacy_email_ids=[])
+
+        self.auth.domain_for.return_value = 'test.com'
+        self.pending_storage.fetch.return_value = pending
+        self.email_storage.fetch_many_objects.return_value = []
+        self.client_storage.compression_formats.return_value = ['gz', 'zstd']
+
+        self._execute_action('client', 'gz', bundle_storage=self.bundle_storage)
+
+        self.bundle_storage.fetch.assert_not_called()
+        self.client_storage.store_objects.assert_called_once_with((sync.EMAILS_FILE, ANY, to_jsonl_bytes), 'gz', False)
+
+    def _execute_action(self, *args, bundle_storage=None, max_part_bytes=0, **kwargs):
         action = actions.DownloadClientEmails(
             auth=self.auth,
             client_storage=self.client_storage,
             email_storage=self.email_storage,
             pending_storage=self.pending_storage,
+            bundle_storage=bundle_storage,
+            max_part_bytes=max_part_bytes,
+        )
+
+        return action(*args, **kwargs)
+
+
+class AddEmailToClientBundlesTests(TestCase):
+
+    def setUp(self):
+        self.email_storage = Mock()
+        self.bundle_storage = Mock()
+
+    def test_200(self):
+        email = {
+            '_uid': '123',
+            'to': ['1@bar.lokole.ca', 'foo@gmail.com'],
+            'cc': ['2@baz.lokole.ca'],
+            'attachments': [{'filename': 'a.txt', 'content': b'some file content'}],
+        }
+
+        self.email_storage.fetch_object.return_value = email
+
+        _, status = self._execute_action('123')
+
+        self.assertEqual(status, 200)
+        attachment_id = actions._attachment_id({'filename': 'a.txt', 'content': b'some file content'})
+        attachment = {'filename': 'a.txt', 'content': 'c29tZSBmaWxlIGNvbnRlbnQ=', '_uid': attachment_id}
+        self.bundle_storage.add.assert_called_once_with(
+            ['bar.lokole.ca', 'baz.lokole.ca'],
+            '123',
+            to_jsonl_bytes({'_uid': '123', 'to': ['1@bar.lokole.ca', 'foo@gmail.com'], 'cc': ['2@baz.lokole.ca']}),
+            1,
+            [(attachment_id, to_jsonl_bytes(attachment)[1:])],
+        )
+
+    def test_skips_emails_without_client_domains(self):
+        self.email_storage.fetch_object.return_value = {'_uid': '123', 'to': ['foo@gmail.com']}
+
+        _, status = self._execute_action('123')
+
+        self.assertEqual(status, 200)
+        self.bundle_storage.add.assert_not_called()
+
+    def _execute_action(self, *args, **kwargs):
+        action = actions.AddEmailToClientBundles(
+            email_storage=self.email_storage,
+            bundle_storage=self.bundle_storage,
         )
 
         return action(*args, **kwargs)
@@ -494,7 +994,31 @@ class UploadClientEmailsTests(TestCase):
 
         self.assertEqual(status, 200)
         self.auth.domain_for.assert_called_once_with(client_id)
-        self.next_task.assert_called_once_with(resource_id)
+        self.next_task.assert_called_once_with(resource_id, 'jsonl', 'embedded')
+
+    def test_200_msgpack(self):
+        self.auth.domain_for.return_value = 'test.com'
+
+        _, status = self._execute_action('client', {'resource_id': 'resource', 'format': 'msgpack'})
+
+        self.assertEqual(status, 200)
+        self.next_task.assert_called_once_with('resource', 'msgpack', 'embedded')
+
+    def test_200_deduplicated_attachments(self):
+        self.auth.domain_for.return_value = 'test.com'
+
+        _, status = self._execute_action('client', {'resource_id': 'resource', 'attachments': 'deduplicated'})
+
+        self.assertEqual(status, 200)
+        self.next_task.assert_called_once_with('resource', 'jsonl', 'deduplicated')
+
+    def test_400_unknown_format(self):
+        self.auth.domain_for.return_value = 'test.com'
+
+        _, status = self._execute_action('client', {'resource_id': 'resource', 'format': 'xml'})
+
+        self.assertEqual(status, 400)
+        self.next_task.assert_not_called()
 
     def _execute_action(self, *args, **kwargs):
         action = actions.UploadClientEmails(
@@ -695,8 +1219,9 @@ class DeleteClientTests(TestCase):
         self.auth = Mock()
         self.delete_mailbox = MagicMock()
         self.delete_mx_records = MagicMock()
-        self.mailbox_storage = Mock()
+        self.mailbox_index = Mock()
         self.pending_storage = Mock()
+        self.bundle_storage = Mock()
         self.user_storage = Mock()
 
     def test_400(self):
@@ -739,9 +1264,6 @@ class DeleteClientTests(TestCase):
 
         self.auth.client_id_for.return_value = client_id
         self.auth.is_owner.return_value = True
-        self.mailbox_storage.iter.return_value = ['1/2/a', '1/2/b']
-        self.pending_storage.iter.return_value = ['c', 'd', 'e']
-        self.user_storage.iter.return_value = [f'{user}@{domain}']
 
         _, status = self._execute_action(domain, user=user)
 
@@ -751,25 +1273,19 @@ class DeleteClientTests(TestCase):
         self.auth.delete.assert_called_once_with(client_id, domain)
         self.delete_mailbox.assert_called_once_with(client_id, domain)
         self.delete_mx_records.assert_called_once_with(domain)
-        self.mailbox_storage.iter.assert_called_once_with(f'{domain}/')
-        self.mailbox_storage.delete.assert_any_call(f'{domain}/1/2/a')
-        self.mailbox_storage.delete.assert_any_call(f'{domain}/1/2/b')
-        self.assertEqual(self.mailbox_storage.delete.call_count, 2)
-        self.pending_storage.iter.assert_called_once_with(f'{domain}/')
-        self.pending_storage.delete.assert_any_call(f'{domain}/c')
-        self.pending_storage.delete.assert_any_call(f'{domain}/d')
-        self.pending_storage.delete.assert_any_call(f'{domain}/e')
-        self.assertEqual(self.pending_storage.delete.call_count, 3)
-        self.user_storage.iter.assert_called_once_with(f'{domain}/')
-        self.user_storage.delete.assert_called_once_with(f'{domain}/{user}@{domain}')
+        self.mailbox_index.delete_prefix.assert_called_once_with(f'{domain}/', ANY)
+        self.pending_storage.delete_prefix.assert_called_once_with(f'{domain}/', ANY)
+        self.bundle_storage.delete_prefix.assert_called_once_with(f'{domain}/', ANY)
+        self.user_storage.delete_prefix.assert_called_once_with(f'{domain}/', ANY)
 
     def _execute_action(self, *args, **kwargs):
         action = actions.DeleteClient(
             auth=self.auth,
             delete_mailbox=self.delete_mailbox,
             delete_mx_records=self.delete_mx_records,
-            mailbox_storage=self.mailbox_storage,
+            mailbox_index=self.mailbox_index,
             pending_storage=self.pending_storage,
+            bundle_storage=self.bundle_storage,
             user_storage=self.user_storage,
         )
 
@@ -845,13 +1361,13 @@ class CalculatePendingEmailsMetricTests(TestCase):
         ]
 
         self.auth.is_owner.return_value = True
-        self.pending_storage.iter.return_value = pending_email_ids
+        self.pending_storage.count.return_value = len(pending_email_ids)
 
         response = self._execute_action(domain, user=user)
 
         self.assertEqual(response['pending_emails'], len(pending_email_ids))
         self.auth.is_owner.assert_called_once_with(domain, user)
-        self.pending_storage.iter.assert_called_once_with(f'{domain}/')
+        self.pending_storage.count.assert_called_once_with(domain)
 
     def _execute_action(self, *args, **kwargs):
         action = actions.CalculatePendingEmailsMetric(
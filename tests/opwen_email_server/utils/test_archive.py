@@ -0,0 +1,134 @@
+from io import BytesIO
+from tarfile import open as tarfile_open
+from unittest import TestCase
+
+from zstandard import ZstdCompressor
+from zstandard import ZstdDecompressor
+
+from opwen_email_server.utils import archive
+
+
+class StreamTarTests(TestCase):
+
+    def test_creates_readable_archives(self):
+        for compression in ('tar', 'gz', 'bz2', 'xz'):
+            with self.subTest(compression=compression):
+                content = b'{"foo":"bar"}\n' * 10000
+
+                chunks = archive.stream_tar('file', BytesIO(content), len(content), compression)
+                stream = BytesIO(b''.join(chunks))
+
+                mode = 'r|' if compression == 'tar' else f'r|{compression}'
+                with tarfile_open(fileobj=stream, mode=mode) as tar:
+                    member = tar.next()
+                    self.assertEqual(member.name, 'file')
+                    self.assertEqual(tar.extractfile(member).read(), content)
+
+    def test_creates_readable_zstd_archives(self):
+        content = b'some content'
+
+        chunks = archive.stream_tar('file', BytesIO(content), len(content), 'zstd', level=20)
+        stream = ZstdDecompressor().stream_reader(BytesIO(b''.join(chunks)))
+
+        with tarfile_open(fileobj=stream, mode='r|') as tar:
+            member = tar.next()
+            self.assertEqual(tar.extractfile(member).read(), content)
+
+    def test_uses_given_zstd_compressor(self):
+        content = b'some content'
+        zstd_compressor = ZstdCompressor(level=1, write_content_size=False)
+
+        chunks = archive.stream_tar_members([('file', BytesIO(content), len(content))],
+                                            'zstd',
+                                            zstd_compressor=zstd_compressor)
+        stream = ZstdDecompressor().stream_reader(BytesIO(b''.join(chunks)))
+
+        with tarfile_open(fileobj=stream, mode='r|') as tar:
+            self.assertEqual(tar.extractfile(tar.next()).read(), content)
+
+    def test_wraps_precompressed_zstd_frames(self):
+        lines = [b'{"foo":"bar"}\n', b'{"baz":1}\n']
+        frames = [ZstdCompressor(level=19).compress(line) for line in lines]
+
+        chunks = archive.stream_tar_frames([('file', frames, sum(map(len, lines)))])
+
+        decompressed = BytesIO()
+        ZstdDecompressor().copy_stream(BytesIO(b''.join(chunks)), decompressed)
+        decompressed.seek(0)
+        with tarfile_open(fileobj=decompressed, mode='r|') as tar:
+            member = tar.next()
+            self.assertEqual(member.name, 'file')
+            self.assertEqual(tar.extractfile(member).read(), b''.join(lines))
+
+    def test_creates_archives_with_multiple_members(self):
+        members = [('first', BytesIO(b'first content'), 13), ('second', BytesIO(b'second'), 6)]
+
+        chunks = archive.stream_tar_members(members, 'gz')
+
+        with tarfile_open(fileobj=BytesIO(b''.join(chunks)), mode='r|gz') as tar:
+            self.assertEqual([(member.name, tar.extractfile(member).read()) for member in tar],
+                             [('first', b'first content'), ('second', b'second')])
+
+    def test_wraps_precompressed_zstd_frames_of_multiple_members(self):
+        compressor = ZstdCompressor()
+        members = [('first', [compressor.compress(b'a' * 600)], 600), ('second', [compressor.compress(b'b')], 1)]
+
+        chunks = archive.stream_tar_frames(members)
+
+        decompressed = BytesIO()
+        ZstdDecompressor().copy_stream(BytesIO(b''.join(chunks)), decompressed)
+        decompressed.seek(0)
+        with tarfile_open(fileobj=decompressed, mode='r|') as tar:
+            self.assertEqual([(member.name, tar.extractfile(member).read()) for member in tar], [('first', b'a' * 600),
+                                                                                                 ('second', b'b')])
+
+    def test_yields_chunks_incrementally(self):
+        content = b'x' * (5 * archive.CHUNK_SIZE)
+
+        chunks = list(archive.stream_tar('file', BytesIO(content), len(content), 'tar'))
+
+        self.assertGreater(len(chunks), 5)
+
+    def test_raises_on_truncated_input(self):
+        with self.assertRaises(EOFError):
+            list(archive.stream_tar('file', BytesIO(b'short'), 100, 'gz'))
+
+    def test_can_stream(self):
+        self.assertTrue(archive.can_stream('zstd'))
+        self.assertTrue(archive.can_stream('gz'))
+        self.assertFalse(archive.can_stream('unknown'))
+
+
+class OpenTarStreamTests(TestCase):
+
+    def test_reads_streamed_archives(self):
+        for compression in ('tar', 'gz', 'bz2', 'xz', 'zstd'):
+            with self.subTest(compression=compression):
+                content = b'{"foo":"bar"}\n' * 1000
+                chunks = archive.stream_tar('file', BytesIO(content), len(content), compression)
+
+                with archive.open_tar_stream(self._rechunk(chunks, 7), compression) as tar:
+                    member = tar.next()
+                    self.assertEqual(member.name, 'file')
+                    self.assertEqual(tar.extractfile(member).read(), content)
+
+    def test_consumes_chunks_lazily(self):
+        content = b'line\n' * 100000
+        chunks = list(archive.stream_tar('file', BytesIO(content), len(content), 'tar'))
+        consumed = []
+
+        def track(chunks):
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+
+        with archive.open_tar_stream(track(self._rechunk(chunks, 1024)), 'tar') as tar:
+            fobj = tar.extractfile(tar.next())
+            self.assertEqual(next(iter(fobj)), b'line\n')
+            self.assertLess(sum(map(len, consumed)), len(content))
+
+    @classmethod
+    def _rechunk(cls, chunks, size):
+        data = b''.join(chunks)
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
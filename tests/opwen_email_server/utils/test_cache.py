@@ -0,0 +1,135 @@
+from os import listdir
+from os import utime
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from opwen_email_server.utils import cache
+
+
+class MemoryBytesCacheTests(TestCase):
+
+    def test_roundtrip(self):
+        self.cache.put('a', b'123')
+
+        self.assertEqual(self.cache.get('a'), b'123')
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_evicts_least_recently_used_entries(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.get('a')
+        self.cache.put('c', b'1234')
+
+        self.assertEqual(self.cache.get('a'), b'1234')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), b'1234')
+
+    def test_ignores_entries_larger_than_cache(self):
+        self.cache.put('a', b'12345678901')
+
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_deletes(self):
+        self.cache.put('a', b'123')
+        self.cache.delete('a')
+        self.cache.delete('b')
+
+        self.assertIsNone(self.cache.get('a'))
+
+    def setUp(self):
+        self.cache = cache.MemoryBytesCache(max_bytes=10)
+
+
+class DiskBytesCacheTests(TestCase):
+
+    def test_roundtrip(self):
+        self.cache.put('a', b'123')
+
+        self.assertEqual(self.cache.get('a'), b'123')
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_evicts_entries_over_capacity(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.put('c', b'1234')
+
+        self.assertEqual(len(listdir(self.root)), 2)
+        self.assertEqual(self.cache.get('c'), b'1234')
+
+    def test_evicts_least_recently_used_entries(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.get('a')
+        self.cache.put('c', b'1234')
+
+        self.assertEqual(self.cache.get('a'), b'1234')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), b'1234')
+
+    def test_reuses_existing_entries(self):
+        self.cache.put('a', b'123')
+
+        reopened = cache.DiskBytesCache(root=self.root, max_bytes=10)
+
+        self.assertEqual(reopened.get('a'), b'123')
+
+    def test_evicts_oldest_existing_entries_first(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        utime(join(self.root, listdir(self.root)[0]), (0, 0))
+        oldest = listdir(self.root)[0]
+
+        reopened = cache.DiskBytesCache(root=self.root, max_bytes=10)
+        reopened.put('c', b'1234')
+
+        self.assertNotIn(oldest, listdir(self.root))
+        self.assertEqual(len(listdir(self.root)), 2)
+
+    def test_deletes(self):
+        self.cache.put('a', b'123')
+        self.cache.delete('a')
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(listdir(self.root), [])
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.cache = cache.DiskBytesCache(root=self.root, max_bytes=10)
+
+    def tearDown(self):
+        rmtree(self.root)
+
+
+class TieredBytesCacheTests(TestCase):
+
+    def test_promotes_entries_and_counts_hits(self):
+        self.disk.put('a', b'123')
+
+        self.assertEqual(self.cache.get('a'), b'123')
+        self.assertEqual(self.cache.get('a'), b'123')
+        self.assertIsNone(self.cache.get('b'))
+
+        self.assertEqual(self.memory.get('a'), b'123')
+        self.assertEqual(self.cache.stats, {'hits': 2, 'hits_disk': 1, 'hits_memory': 1, 'misses': 1})
+
+    def test_writes_and_deletes_through_all_tiers(self):
+        self.cache.put('a', b'123')
+
+        self.assertEqual(self.memory.get('a'), b'123')
+        self.assertEqual(self.disk.get('a'), b'123')
+
+        self.cache.delete('a')
+
+        self.assertIsNone(self.memory.get('a'))
+        self.assertIsNone(self.disk.get('a'))
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.memory = cache.MemoryBytesCache(max_bytes=10)
+        self.disk = cache.DiskBytesCache(root=self.root, max_bytes=100)
+        self.cache = cache.TieredBytesCache(self.memory, self.disk)
+
+    def tearDown(self):
+        rmtree(self.root)
@@ -0,0 +1,177 @@
+from io import BufferedReader
+from io import BytesIO
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from unittest.mock import patch
+
+from opwen_email_server.utils import compression
+
+
+class GzipCodecTests(TestCase):
+
+    def test_roundtrip(self):
+        codec = compression.GzipCodec()
+
+        compressed = codec.compress(b'some content')
+
+        self.assertTrue(codec.matches(compressed))
+        self.assertEqual(codec.decompress(compressed), b'some content')
+
+    def test_stream_roundtrip(self):
+        _assert_stream_roundtrip(self, compression.GzipCodec())
+
+
+class ZstdCodecTests(TestCase):
+
+    def test_roundtrip(self):
+        codec = compression.ZstdCodec()
+
+        compressed = codec.compress(b'some content')
+
+        self.assertTrue(codec.matches(compressed))
+        self.assertFalse(compression.GzipCodec().matches(compressed))
+        self.assertEqual(codec.decompress(compressed), b'some content')
+
+    def test_stream_roundtrip(self):
+        _assert_stream_roundtrip(self, compression.ZstdCodec())
+
+    def test_decompresses_streams_of_unknown_size(self):
+        codec = compression.ZstdCodec()
+
+        compressed = b''.join(codec.compress_stream(BytesIO(b'some content')))
+
+        self.assertEqual(codec.decompress(compressed), b'some content')
+
+    def test_stream_roundtrip_with_dictionary(self):
+        dictionary = compression.train_zstd_dictionary(_samples(), size=1024)
+
+        _assert_stream_roundtrip(self, compression.ZstdCodec(dictionaries=[dictionary]))
+
+    def test_roundtrip_with_dictionary(self):
+        dictionary = compression.train_zstd_dictionary(_samples(), size=1024)
+        codec = compression.ZstdCodec(dictionaries=[dictionary])
+        sample = b'{"from":"user7@test.lokole.ca","subject":"report 7"}'
+
+        compressed = codec.compress(sample)
+
+        self.assertLess(len(compressed), len(compression.ZstdCodec().compress(sample)))
+        self.assertEqual(codec.decompress(compressed), sample)
+
+    def test_decompresses_with_older_dictionaries(self):
+        old_dictionary = compression.train_zstd_dictionary(_samples('old'), size=1024)
+        new_dictionary = compression.train_zstd_dictionary(_samples('new'), size=1024)
+        old_codec = compression.ZstdCodec(dictionaries=[old_dictionary])
+        new_codec = compression.ZstdCodec(dictionaries=[new_dictionary, old_dictionary])
+
+        compressed = old_codec.compress(b'content')
+
+        self.assertEqual(new_codec.decompress(compressed), b'content')
+        self.assertEqual(new_codec.decompress(compression.ZstdCodec().compress(b'plain')), b'plain')
+
+    def test_fails_without_dictionary(self):
+        dictionary = compression.train_zstd_dictionary(_samples(), size=1024)
+
+        compressed = compression.ZstdCodec(dictionaries=[dictionary]).compress(b'content')
+
+        with self.assertRaises(ValueError):
+            compression.ZstdCodec().decompress(compressed)
+
+
+class ZstdPolicyTests(TestCase):
+
+    def test_lowers_level_for_large_payloads(self):
+        policy = compression.ZstdPolicy(max_level=15, threads=1, cpu_budget_seconds=1)
+
+        self.assertEqual(policy.settings(1024).level, 15)
+        self.assertLess(policy.settings(100 * 1024 * 1024).level, 15)
+        self.assertEqual(policy.settings(10 * 1024 * 1024 * 1024).level, 1)
+
+    def test_budgets_cpu_regardless_of_threads(self):
+        num_bytes = 200 * 1024 * 1024
+        single = compression.ZstdPolicy(threads=1, cpu_budget_seconds=1).settings(num_bytes)
+        multi = compression.ZstdPolicy(threads=8, cpu_budget_seconds=1).settings(num_bytes)
+
+        self.assertEqual(multi.level, single.level)
+        self.assertEqual(multi.threads, 8)
+
+    @patch.object(compression, 'available_cpus', return_value=3)
+    def test_defaults_threads_to_available_cpus(self, mock_available_cpus):
+        self.assertEqual(compression.ZstdPolicy(threads=-1).settings(1024).threads, 3)
+
+    def test_enables_long_distance_matching_for_large_payloads(self):
+        policy = compression.ZstdPolicy(long_distance_bytes=1000)
+
+        self.assertFalse(policy.settings(999).long_distance)
+        self.assertTrue(policy.settings(1000).long_distance)
+        self.assertFalse(compression.ZstdPolicy(long_distance_bytes=0).settings(1000).long_distance)
+
+    def test_compressor_roundtrip(self):
+        content = b'some content ' * 1000
+
+        compressed = compression.ZstdPolicy(threads=2, long_distance_bytes=1).compressor(len(content)).compress(content)
+
+        self.assertEqual(compression.ZstdCodec().decompress(compressed), content)
+
+    def test_compressor_uses_given_settings(self):
+        policy = compression.ZstdPolicy()
+        settings = compression.ZstdSettings(level=1, threads=0, long_distance=False)
+
+        with patch.object(policy, 'settings') as mock_settings:
+            compressor = policy.compressor(1024, settings=settings)
+
+        mock_settings.assert_not_called()
+        self.assertEqual(compressor.compress(b'content')[:4], b'\x28\xb5\x2f\xfd')
+
+
+class SniffCodecTests(TestCase):
+
+    def test_detects_codec_from_magic_bytes(self):
+        gzip, zstd = compression.GzipCodec(), compression.ZstdCodec()
+
+        self.assertIs(compression.sniff_codec(gzip.compress(b'a'), [zstd, gzip]), gzip)
+        self.assertIs(compression.sniff_codec(zstd.compress(b'a'), [zstd, gzip]), zstd)
+
+        with self.assertRaises(ValueError):
+            compression.sniff_codec(b'unknown', [zstd, gzip])
+
+
+class LoadCodecTests(TestCase):
+
+    def test_loads_codecs(self):
+        self.assertIsInstance(compression.load_codec('gz'), compression.GzipCodec)
+        self.assertIsInstance(compression.load_codec('zst'), compression.ZstdCodec)
+
+        with self.assertRaises(ValueError):
+            compression.load_codec('unknown')
+
+    def test_loads_dictionaries(self):
+        path = join(self.folder, 'dictionary')
+        with open(path, 'wb') as fobj:
+            fobj.write(compression.train_zstd_dictionary(_samples(), size=1024))
+
+        codec = compression.load_codec('zst', [path])
+
+        self.assertEqual(codec.decompress(codec.compress(b'content')), b'content')
+
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+
+def _samples(prefix='user'):
+    return [f'{{"from":"{prefix}{i}@test.lokole.ca","subject":"report {i}"}}'.encode('ascii') for i in range(500)]
+
+
+def _assert_stream_roundtrip(test: TestCase, codec: compression.Codec) -> None:
+    content = b'line of content\n' * 10000
+
+    compressed = b''.join(codec.compress_stream(BytesIO(content), len(content)))
+
+    test.assertEqual(codec.decompress(compressed), content)
+    with codec.decompress_stream(BufferedReader(BytesIO(compressed))) as stream:
+        test.assertEqual(stream.readline(), b'line of content\n')
+        test.assertEqual(stream.read(), content[16:])
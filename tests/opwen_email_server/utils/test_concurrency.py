@@ -0,0 +1,91 @@
+from os import cpu_count
+from os import mkdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+
+from opwen_email_server.utils import concurrency
+
+
+class OrderedMapTests(TestCase):
+
+    def test_keeps_results_in_order(self):
+        items = [5, 1, 4, 2, 3]
+
+        def slow_square(item):
+            sleep(item / 1000)
+            return item * item
+
+        results = concurrency.ordered_map(slow_square, items, max_workers=4)
+
+        self.assertEqual(list(results), [25, 1, 16, 4, 9])
+
+    def test_runs_serially_with_single_worker(self):
+        results = concurrency.ordered_map(str, [1, 2, 3], max_workers=1)
+
+        self.assertEqual(list(results), ['1', '2', '3'])
+
+    def test_bounds_number_of_items_in_flight(self):
+        lock = Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def track(item):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            sleep(0.001)
+            with lock:
+                state['running'] -= 1
+            return item
+
+        results = concurrency.ordered_map(track, range(50), max_workers=3)
+
+        self.assertEqual(list(results), list(range(50)))
+        self.assertLessEqual(state['max_running'], 3)
+
+    def test_propagates_errors(self):
+
+        def fail_on_two(item):
+            if item == 2:
+                raise ValueError(item)
+            return item
+
+        results = concurrency.ordered_map(fail_on_two, [1, 2, 3], max_workers=2)
+
+        self.assertEqual(next(results), 1)
+        with self.assertRaises(ValueError):
+            next(results)
+
+
+class AvailableCpusTests(TestCase):
+
+    def test_reads_cgroup_v2_quota(self):
+        self._given_file('cpu.max', '250000 100000\n')
+
+        self.assertEqual(concurrency.available_cpus(self.folder), min(2, cpu_count()))
+
+    def test_reads_cgroup_v1_quota(self):
+        mkdir(join(self.folder, 'cpu'))
+        self._given_file(join('cpu', 'cpu.cfs_quota_us'), '50000\n')
+        self._given_file(join('cpu', 'cpu.cfs_period_us'), '100000\n')
+
+        self.assertEqual(concurrency.available_cpus(self.folder), 1)
+
+    def test_falls_back_to_host_cpus_without_quota(self):
+        self._given_file('cpu.max', 'max 100000\n')
+
+        self.assertEqual(concurrency.available_cpus(self.folder), cpu_count())
+        self.assertEqual(concurrency.available_cpus(join(self.folder, 'missing')), cpu_count())
+
+    def _given_file(self, name: str, content: str):
+        with open(join(self.folder, name), 'w') as fobj:
+            fobj.write(content)
+
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from unittest import TestCase
+
+from libcloud.storage.types import Provider
+
+from opwen_email_server.utils.drivers import DriverRegistry
+
+
+class DriverRegistryTests(TestCase):
+
+    def test_shares_session_between_containers_of_same_account(self):
+        driver1 = self._registry.get(Provider.AZURE_BLOBS, 'account', 'a2V5', None, True)
+        driver2 = self._registry.get(Provider.AZURE_BLOBS, 'account', 'a2V5', None, True)
+        driver3 = self._registry.get(Provider.AZURE_BLOBS, 'other', 'a2V5', None, True)
+
+        self.assertIs(driver1, driver2)
+        self.assertIsNot(driver1, driver3)
+        self.assertIsNot(driver1.connection.connection.session, driver3.connection.connection.session)
+
+    def test_creates_driver_per_thread_with_shared_session(self):
+        barrier = Barrier(2)
+
+        def get_driver_in_thread(_):
+            barrier.wait()
+            return self._get_driver()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            drivers = list(executor.map(get_driver_in_thread, range(2)))
+        drivers.append(self._get_driver())
+
+        self.assertEqual(len({id(driver) for driver in drivers}), 3)
+        self.assertEqual(len({id(driver.connection.connection.session) for driver in drivers}), 1)
+
+    def test_stats(self):
+        self._get_driver()
+        self._registry.get(Provider.LOCAL, '/tmp', 'key', None, True)
+
+        stats = self._registry.stats
+
+        self.assertEqual(stats['azure_blobs://account@'], {'drivers': 1, 'connections': 0, 'requests': 0})
+        self.assertEqual(stats['local:///tmp@']['drivers'], 1)
+
+    def _get_driver(self):
+        return self._registry.get(Provider.AZURE_BLOBS, 'account', 'a2V5', None, True)
+
+    def setUp(self):
+        self._registry = DriverRegistry(pool_size=2)
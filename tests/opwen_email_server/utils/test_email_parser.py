@@ -1,14 +1,34 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from email.encoders import encode_base64
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from enum import Enum
 from enum import unique
+from hashlib import sha256
+from io import BytesIO
+from mimetypes import guess_type
+from os import urandom
 from os.path import abspath
 from os.path import dirname
 from os.path import join
+from os.path import splitext
+from threading import Barrier
+from threading import Event
 from unittest import TestCase
+from unittest.mock import Mock
 from unittest.mock import patch
 
+from PIL import Image
 from responses import mock as mock_responses
 
 from opwen_email_server.utils import email_parser
+from opwen_email_server.utils import images
+from opwen_email_server.utils.cache import BytesCache
+from opwen_email_server.utils.cache import MemoryBytesCache
+from opwen_email_server.utils.cache import TieredBytesCache
 from tests.opwen_email_server.helpers import throw
 
 TEST_DATA_DIRECTORY = abspath(
@@ -90,6 +110,112 @@ class MimeEmailParserTests(ParseMimeEmailTests):
     _parse = email_parser.MimeEmailParser()
 
 
+class ParseMimeStreamTests(ParseMimeEmailTests):
+
+    @classmethod
+    def _parse(cls, mime_email):
+        return email_parser.parse_mime_stream(BytesIO(mime_email.encode('utf-8')))
+
+    def test_parses_the_same_as_the_text(self):
+        for filename in ('email-attachment.mime', 'email-ccbcc.mime', 'email-cid.mime', 'email-html.mime'):
+            for line_ending in ('\n', '\r\n'):
+                with self.subTest(filename=filename, line_ending=repr(line_ending)):
+                    mime_email = self._given_mime_email(filename).replace('\n', line_ending)
+
+                    self.assertEqual(self._parse(mime_email), email_parser.parse_mime_email(mime_email))
+
+    def test_hands_off_large_attachments(self):
+        mime_email = self._given_mime_email('email-attachment.mime')
+        on_large_attachment = Mock(side_effect=lambda attachment, leaf: dict(attachment, size=leaf.size))
+
+        email = email_parser.parse_mime_stream(BytesIO(mime_email.encode('utf-8')), 1024, on_large_attachment)
+
+        self.assertEqual(email['attachments'], [{'filename': 'cute-mouse-clipart-mouse4.png', 'size': 9149}])
+
+
+class MimeEmailParserStreamTests(TestCase):
+
+    def test_stores_large_attachments(self):
+        mime_email = self._given_mime_email('report.pdf', 'application/pdf', b'%PDF' * 1024)
+        attachment_store = Mock(return_value='content-id')
+        parser = email_parser.MimeEmailParser(attachment_store=attachment_store, spool_bytes=1024)
+
+        email = parser(BytesIO(mime_email))
+
+        self.assertEqual(email['attachments'], [{'filename': 'report.pdf', 'content_id': 'content-id', 'size': 4096}])
+        content_id, fobj, size = attachment_store.call_args[0]
+        self.assertEqual(content_id, sha256(b'%PDF' * 1024).hexdigest())
+        self.assertEqual(size, 4096)
+
+    def test_keeps_large_attachments_without_store(self):
+        mime_email = self._given_mime_email('report.pdf', 'application/pdf', b'%PDF' * 1024)
+        parser = email_parser.MimeEmailParser(spool_bytes=1024)
+
+        email = parser(BytesIO(mime_email))
+
+        self.assertEqual(email['attachments'], [{'filename': 'report.pdf', 'content': b'%PDF' * 1024}])
+
+    def test_transcodes_large_images_before_storing(self):
+        image = Image.frombytes('RGB', (400, 300), urandom(400 * 300 * 3))
+        buffer = BytesIO()
+        image.save(buffer, 'PNG')
+        mime_email = self._given_mime_email('photo.png', 'image/png', buffer.getvalue())
+        attachment_store = Mock()
+        transcoder = images.ImageTranscoder(max_image_bytes=32 * 1024, formats=('JPEG', ))
+        parser = email_parser.MimeEmailParser(image_transcoder=transcoder,
+                                              attachment_store=attachment_store,
+                                              spool_bytes=64 * 1024)
+
+        email = parser(BytesIO(mime_email))
+
+        attachment, = email['attachments']
+        self.assertEqual(attachment['filename'], 'photo.jpg')
+        self.assertLessEqual(len(attachment['content']), 64 * 1024)
+        self.assertFalse(attachment_store.called)
+
+    def test_parses_streams_in_the_process_pool(self):
+        mime_email = self._given_mime_email('report.pdf', 'application/pdf', b'%PDF' * 128)
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            processes = Mock(wraps=executor)
+            email = email_parser.MimeEmailParser(processes=processes, spool_bytes=1024)(BytesIO(mime_email))
+
+        self.assertEqual(processes.submit.call_args_list[0][0][0], email_parser.parse_mime_file)
+        self.assertEqual(email, email_parser.MimeEmailParser(spool_bytes=1024)(BytesIO(mime_email)))
+
+    def test_stores_large_attachments_parsed_in_the_process_pool(self):
+        mime_email = self._given_mime_email('report.pdf', 'application/pdf', b'%PDF' * 1024)
+        stored = {}
+
+        def attachment_store(content_id, fobj, size):
+            stored[content_id] = fobj.read()
+            return 'content-id'
+
+        with ProcessPoolExecutor(max_workers=1) as processes:
+            parser = email_parser.MimeEmailParser(processes=processes,
+                                                  attachment_store=attachment_store,
+                                                  spool_bytes=1024)
+            email = parser(BytesIO(mime_email))
+
+        self.assertEqual(email['attachments'], [{'filename': 'report.pdf', 'content_id': 'content-id', 'size': 4096}])
+        self.assertEqual(stored, {sha256(b'%PDF' * 1024).hexdigest(): b'%PDF' * 1024})
+
+    @classmethod
+    def _given_mime_email(cls, filename: str, mimetype: str, content: bytes) -> bytes:
+        message = MIMEMultipart()
+        message['From'] = 'sender@test.com'
+        message['To'] = 'recipient@test.com'
+        message['Subject'] = 'Large attachment'
+        message.attach(MIMEText('See attached', 'plain'))
+        maintype, subtype = mimetype.split('/')
+        attachment = MIMEBase(maintype, subtype)
+        attachment.set_payload(content)
+        encode_base64(attachment)
+        attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+        message.attach(attachment)
+        return message.as_bytes()
+
+
 class GetDomainsTests(TestCase):
 
     def test_gets_domains(self):
@@ -117,19 +243,41 @@ class GetReceipientsTests(TestCase):
         self.assertSetEqual(set(recipients), {'foo@bar.com', 'baz@bar.com', 'foo@com'})
 
 
-class ResizeImageTests(TestCase):
-    error_message = 'If default MAX_WIDTH_IMAGES and/or MAX_HEIGHT_IMAGES were changed ' \
-                    'you may need to change the test base64 in "images_base64.json".'
+class MimeEmailParserStagesTests(TestCase):
+
+    def test_parses_the_same_in_a_process_pool(self):
+        mime_email = ParseMimeEmailTests._given_mime_email('email-cid.mime')
+
+        with ProcessPoolExecutor(max_workers=1) as processes:
+            email = email_parser.MimeEmailParser(processes=processes)(mime_email)
+
+        self.assertEqual(email, email_parser.MimeEmailParser()(mime_email))
+
+    @patch.object(email_parser.MimeEmailParser, 'log_info')
+    def test_logs_stage_timings(self, mock_log_info):
+        mime_email = ParseMimeEmailTests._given_mime_email('email-cid.mime')
+
+        with ThreadPoolExecutor(max_workers=1) as processes:
+            email_parser.MimeEmailParser(processes=processes)(mime_email)
+
+        message, timings, mode = next(call[0] for call in mock_log_info.call_args_list
+                                      if call[0][0].startswith('Parsed'))
+        self.assertIn('parse=', timings)
+        self.assertIn('attachments=', timings)
+        self.assertEqual(mode, 'process pool')
+
 
-    def test_change_image_size(self):
-        input_bytes = _given_test_image(size=ImageSize.large)
-        output_bytes = email_parser._change_image_size(input_bytes)
-        self.assertNotEqual(input_bytes, output_bytes, self.error_message)
+class TemplateInlineImagesTests(TestCase):
 
-    def test_change_image_size_when_already_small(self):
-        input_bytes = _given_test_image(size=ImageSize.small)
-        output_bytes = email_parser._change_image_size(input_bytes)
-        self.assertEqual(input_bytes, output_bytes, self.error_message)
+    def test_fills_in_fetched_images_and_replaces_missing_ones(self):
+        body = '<div><img src="http://a.png"/><img src="cid:b"/><img src="http://c.png?x=1&amp;y=2"/></div>'
+
+        template, placeholder, image_urls = email_parser._template_inline_images(body)
+        filled = email_parser._fill_inline_images(template, placeholder, image_urls, {'http://a.png': 'data:a'})
+
+        self.assertEqual(image_urls, ['http://a.png', 'http://c.png?x=1&y=2'])
+        self.assertEqual(filled,
+                         f'<div><img src="data:a"/><img src="cid:b"/><img src="{email_parser._MISSING_IMAGE}"/></div>')
 
 
 class ConvertImgUrlToBase64Tests(TestCase):
@@ -141,7 +289,7 @@ class ConvertImgUrlToBase64Tests(TestCase):
 
         output_email = email_parser.format_inline_images(input_email, self.fail_if_called)
 
-        self.assertStartsWith(output_email['body'], '<div><h3>test image</h3><img src="data:image/png;')
+        self.assertStartsWith(output_email['body'], '<div><h3>test image</h3><img src="data:image/')
 
     @mock_responses.activate
     def test_format_inline_images_with_query_string(self):
@@ -151,10 +299,10 @@ class ConvertImgUrlToBase64Tests(TestCase):
 
         output_email = email_parser.format_inline_images(input_email, self.fail_if_called)
 
-        self.assertStartsWith(output_email['body'], '<div><h3>test image</h3><img src="data:image/png;')
+        self.assertStartsWith(output_email['body'], '<div><h3>test image</h3><img src="data:image/')
 
     @mock_responses.activate
-    @patch.object(email_parser, 'Image')
+    @patch.object(images, 'Image')
     def test_handles_exceptions_when_processing_image(self, mock_pil):
         mock_pil.open.side_effect = throw(IOError())
         handled_errors = []
@@ -168,7 +316,8 @@ class ConvertImgUrlToBase64Tests(TestCase):
         output_email = email_parser.format_inline_images(input_email, on_error)
 
         self.assertEqual(len(handled_errors), 1)
-        self.assertEqual(output_email, input_email)
+        self.assertEqual(output_email['body'],
+                         f'<div><h3>test image</h3><img src="{email_parser._MISSING_IMAGE}"/></div>')
 
     def test_format_inline_images_with_img_tag_without_src_attribute(self):
         input_email = {'body': '<div><img/></div>'}
@@ -191,7 +340,7 @@ class ConvertImgUrlToBase64Tests(TestCase):
 
         output_email = email_parser.format_inline_images(input_email, self.fail_if_called)
 
-        self.assertEqual(output_email, input_email)
+        self.assertEqual(output_email['body'], f'<div><img src="{email_parser._MISSING_IMAGE}"/></div>')
 
     @mock_responses.activate
     def test_format_inline_images_with_many_img_tags(self):
@@ -216,7 +365,73 @@ class ConvertImgUrlToBase64Tests(TestCase):
 
         output_email = email_parser.format_inline_images(input_email, self.fail_if_called)
 
-        self.assertStartsWith(output_email['body'], '<div><img src="data:image/png;')
+        self.assertStartsWith(output_email['body'], '<div><img src="data:image/')
+
+    @mock_responses.activate
+    def test_format_inline_images_fetches_each_url_once(self):
+        self.givenTestImage()
+        input_email = {'body': '<div><img src="http://test-url.png"/><img src="http://test-url.png"/></div>'}
+
+        email_parser.format_inline_images(input_email, self.fail_if_called)
+
+        self.assertEqual(len(mock_responses.calls), 1)
+
+    @mock_responses.activate
+    def test_format_inline_images_fetches_concurrently(self):
+        barrier = Barrier(2, timeout=5)
+        image_bytes = self.givenTestImageBytes()
+
+        def callback(request):
+            barrier.wait()
+            return 200, {'Content-Type': 'image/png'}, image_bytes
+
+        mock_responses.add_callback(mock_responses.GET, 'http://first.png', callback=callback)
+        mock_responses.add_callback(mock_responses.GET, 'http://second.png', callback=callback)
+        input_email = {'body': '<div><img src="http://first.png"/><img src="http://second.png"/></div>'}
+        fetcher = email_parser.InlineImageFetcher(max_workers=2)
+
+        output_email = email_parser.format_inline_images(input_email, self.fail_if_called, fetcher)
+
+        self.assertHasCount(output_email['body'], 'src="data:', 2)
+
+    @mock_responses.activate
+    def test_format_inline_images_skips_oversized_images(self):
+        self.givenTestImage()
+        handled_errors = []
+        input_email = {'body': '<div><img src="http://test-url.png"/></div>'}
+        fetcher = email_parser.InlineImageFetcher(max_image_bytes=10)
+
+        output_email = email_parser.format_inline_images(input_email, lambda *args: handled_errors.append(args),
+                                                         fetcher)
+
+        self.assertEqual(len(handled_errors), 1)
+        self.assertEqual(output_email['body'], f'<div><img src="{email_parser._MISSING_IMAGE}"/></div>')
+
+    @mock_responses.activate
+    def test_format_inline_images_replaces_images_over_time_budget(self):
+        self.givenTestImage(url='http://fast.png')
+        release = Event()
+        image_bytes = self.givenTestImageBytes()
+
+        def callback(request):
+            release.wait(5)
+            return 200, {'Content-Type': 'image/png'}, image_bytes
+
+        mock_responses.add_callback(mock_responses.GET, 'http://slow.png', callback=callback)
+        handled_errors = []
+        input_email = {'body': '<div><img src="http://fast.png"/><img src="http://slow.png"/></div>'}
+        fetcher = email_parser.InlineImageFetcher(email_timeout_seconds=0.5)
+
+        try:
+            output_email = email_parser.format_inline_images(input_email, lambda *args: handled_errors.append(args),
+                                                             fetcher)
+        finally:
+            release.set()
+
+        self.assertEqual(len(handled_errors), 1)
+        self.assertHasCount(output_email['body'], 'src="data:', 2)
+        self.assertHasCount(output_email['body'], f'src="{email_parser._MISSING_IMAGE}"', 1)
+        self.assertNotIn('http://slow.png', output_email['body'])
 
     def assertStartsWith(self, data, prefix):
         self.assertEqual(data[:len(prefix)], prefix)
@@ -228,21 +443,104 @@ class ConvertImgUrlToBase64Tests(TestCase):
 
     @classmethod
     def givenTestImage(cls, content_type='image/png', status=200, url='http://test-url.png'):
-        with open(join(TEST_DATA_DIRECTORY, 'test_image.png'), 'rb') as image:
-            image_bytes = image.read()
-
         mock_responses.add(
             mock_responses.GET,
             url,
             content_type=content_type,
-            body=image_bytes,
+            body=cls.givenTestImageBytes(),
             status=status,
         )
 
+    @classmethod
+    def givenTestImageBytes(cls):
+        with open(join(TEST_DATA_DIRECTORY, 'test_image.png'), 'rb') as image:
+            return image.read()
+
     def fail_if_called(self, message, *args):
         self.fail(message % args)
 
 
+class CachedInlineImageFetcherTests(TestCase):
+
+    @mock_responses.activate
+    def test_serves_fresh_images_from_cache(self):
+        self.givenImage(headers={'Cache-Control': 'max-age=3600'})
+
+        first = self.fetch()
+        second = self.fetch()
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(mock_responses.calls), 1)
+        self.assertEqual(self._cache.stats['hits'], 1)
+
+    @mock_responses.activate
+    def test_does_not_cache_uncacheable_images(self):
+        for cache_control in ('no-store', 'private, max-age=3600'):
+            with self.subTest(cache_control=cache_control):
+                mock_responses.reset()
+                self.givenImage(url=f'http://{len(cache_control)}.png', headers={'Cache-Control': cache_control})
+
+                self.fetch(f'http://{len(cache_control)}.png')
+                self.fetch(f'http://{len(cache_control)}.png')
+
+                self.assertEqual(len(mock_responses.calls), 2)
+
+    @mock_responses.activate
+    def test_revalidates_stale_images_with_etag(self):
+        self.givenImage(headers={'Cache-Control': 'no-cache', 'ETag': '"v1"'})
+        first = self.fetch()
+
+        mock_responses.reset()
+        mock_responses.add(mock_responses.GET, 'http://test-url.png', status=304, headers={'ETag': '"v1"'})
+        second = self.fetch()
+
+        self.assertEqual(first, second)
+        self.assertEqual(mock_responses.calls[0].request.headers['If-None-Match'], '"v1"')
+
+    @mock_responses.activate
+    def test_refetches_changed_images(self):
+        self.givenImage(headers={'Expires': 'Thu, 01 Jan 1970 00:00:00 GMT', 'Last-Modified': 'yesterday'})
+        self.fetch()
+
+        mock_responses.reset()
+        self.givenImage()
+        self.fetch()
+
+        self.assertEqual(mock_responses.calls[0].request.headers['If-Modified-Since'], 'yesterday')
+        self.assertEqual(len(mock_responses.calls), 1)
+
+    @mock_responses.activate
+    def test_ignores_cache_failures(self):
+        self.givenImage()
+        self._cache = Mock(spec=BytesCache)
+        self._cache.get.side_effect = IOError()
+        self._cache.put.side_effect = IOError()
+
+        encoded = self.fetch()
+
+        self.assertTrue(encoded.startswith('data:image/'))
+
+    def fetch(self, url='http://test-url.png'):
+        fetcher = email_parser.InlineImageFetcher(cache=self._cache)
+        return fetcher.fetch_all([url], self.fail_if_called)[url]
+
+    @classmethod
+    def givenImage(cls, url='http://test-url.png', headers=None):
+        mock_responses.add(
+            mock_responses.GET,
+            url,
+            content_type='image/png',
+            body=ConvertImgUrlToBase64Tests.givenTestImageBytes(),
+            headers=headers or {},
+        )
+
+    def fail_if_called(self, message, *args):
+        self.fail(message % args)
+
+    def setUp(self):
+        self._cache = TieredBytesCache(MemoryBytesCache(max_bytes=1024 * 1024))
+
+
 class EnsureHasSentAtTests(TestCase):
 
     def test_sets_sent_at_if_missing(self):
@@ -294,7 +592,26 @@ class FormatAttachedFilesTests(TestCase):
         output_content = output_attachments[0].get('content', '')
 
         self.assertNotEqual(input_content, output_content)
-        self.assertEqual(input_filename, output_filename)
+        self.assertEqual(splitext(output_filename)[0], splitext(input_filename)[0])
+        self.assertEqual(guess_type(output_filename)[0], Image.open(BytesIO(output_content)).get_format_mimetype())
+
+    def test_format_attachments_records_transcoded_bytes(self):
+        input_content = _given_test_image(size=ImageSize.large)
+        input_email = {'attachments': [{'filename': 'test_image.png', 'content': input_content}]}
+        stats = Counter()
+
+        output_email = email_parser.format_attachments(input_email, stats=stats)
+
+        self.assertEqual(stats['images'], 1)
+        self.assertEqual(stats['original_bytes'], len(input_content))
+        self.assertEqual(stats['transcoded_bytes'], len(output_email['attachments'][0]['content']))
+
+    def test_format_attachments_ignores_other_files(self):
+        input_email = {'attachments': [{'filename': 'notes.txt', 'content': b'notes'}]}
+
+        output_email = email_parser.format_attachments(input_email)
+
+        self.assertIs(output_email, input_email)
 
 
 class DescendingTimestampTests(TestCase):
@@ -0,0 +1,108 @@
+from io import BytesIO
+from os import urandom
+from unittest import TestCase
+
+from PIL import Image
+
+from opwen_email_server.utils.images import ImageTranscoder
+
+
+class ImageTranscoderTests(TestCase):
+
+    def test_resizes_large_images(self):
+        content = self._given_image((400, 300))
+
+        transcoded = self._transcoder.transcode(content)
+
+        self.assertEqual(self._open(transcoded.content).size, (200, 150))
+
+    def test_transcodes_file_objects(self):
+        content = self._given_image((400, 300), image_format='JPEG')
+
+        transcoded = self._transcoder.transcode(BytesIO(content))
+
+        self.assertEqual(self._open(transcoded.content).size, (200, 150))
+
+    def test_keeps_small_file_objects_within_budget(self):
+        content = self._given_image((100, 100))
+
+        transcoded = self._transcoder.transcode(BytesIO(content), max_bytes=len(content))
+
+        self.assertEqual(transcoded.content, content)
+
+    def test_keeps_small_images_within_budget(self):
+        content = self._given_image((100, 100))
+
+        transcoded = self._transcoder.transcode(content, max_bytes=len(content))
+
+        self.assertIs(transcoded.content, content)
+        self.assertEqual(transcoded.mimetype, 'image/png')
+
+    def test_transcodes_small_images_over_budget(self):
+        content = self._given_image((200, 200))
+
+        transcoded = self._transcoder.transcode(content, max_bytes=20 * 1024)
+
+        self.assertLessEqual(len(transcoded.content), 20 * 1024)
+        self.assertEqual(transcoded.mimetype, 'image/jpeg')
+        self.assertEqual(transcoded.extension, 'jpg')
+        self.assertEqual(self._open(transcoded.content).info.get('progressive'), 1)
+
+    def test_falls_back_to_lower_quality_until_under_budget(self):
+        content = self._given_image((200, 200))
+        generous = self._transcoder.transcode(content, max_bytes=len(content) - 1)
+
+        strict = self._transcoder.transcode(content, max_bytes=len(generous.content) - 1)
+
+        self.assertLess(len(strict.content), len(generous.content))
+
+    def test_strips_metadata(self):
+        exif = Image.Exif()
+        exif[0x010e] = 'secret description'
+        content = self._given_image((400, 300), image_format='JPEG', exif=exif.tobytes())
+
+        transcoded = self._transcoder.transcode(content)
+
+        self.assertNotIn(b'secret description', transcoded.content)
+
+    def test_flattens_transparency_for_jpeg(self):
+        content = self._given_image((400, 300), mode='RGBA')
+
+        transcoded = self._transcoder.transcode(content, max_bytes=1)
+
+        self.assertEqual(self._open(transcoded.content).mode, 'RGB')
+
+    def test_keeps_animations(self):
+        frames = [Image.new('RGB', (400, 300), color) for color in ('red', 'blue')]
+        buffer = BytesIO()
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:])
+        content = buffer.getvalue()
+
+        transcoded = self._transcoder.transcode(content)
+
+        self.assertIs(transcoded.content, content)
+
+    def test_budget_is_shared_between_images_of_an_email(self):
+        self.assertEqual(self._transcoder.budget_for(0), 50 * 1024)
+        self.assertEqual(self._transcoder.budget_for(2), 50 * 1024)
+        self.assertEqual(self._transcoder.budget_for(8), 25 * 1024)
+
+    def test_ignores_unsupported_formats(self):
+        transcoder = ImageTranscoder(formats=('JPEG', 'UNKNOWN'))
+
+        self.assertEqual(transcoder.cache_key, '200x200/JPEG/85,70,55,40,25')
+
+    @classmethod
+    def _given_image(cls, size, mode='RGB', image_format='PNG', **kwargs) -> bytes:
+        width, height = size
+        image = Image.frombytes(mode, size, urandom(width * height * len(mode)))
+        buffer = BytesIO()
+        image.save(buffer, image_format, **kwargs)
+        return buffer.getvalue()
+
+    @classmethod
+    def _open(cls, content: bytes) -> Image.Image:
+        return Image.open(BytesIO(content))
+
+    def setUp(self):
+        self._transcoder = ImageTranscoder(max_image_bytes=50 * 1024, max_email_bytes=200 * 1024, formats=('JPEG', ))
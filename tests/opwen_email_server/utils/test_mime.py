@@ -0,0 +1,90 @@
+from base64 import b64encode
+from io import BytesIO
+from os import urandom
+from unittest import TestCase
+
+from opwen_email_server.utils.mime import read_mime_stream
+
+
+class ReadMimeStreamTests(TestCase):
+
+    def test_reads_nested_multiparts(self):
+        mime_email = (b'Subject: Nested\r\n'
+                      b'Content-Type: multipart/mixed; boundary="outer"\r\n'
+                      b'\r\n'
+                      b'preamble\r\n'
+                      b'--outer\r\n'
+                      b'Content-Type: multipart/alternative; boundary="inner"\r\n'
+                      b'\r\n'
+                      b'--inner\r\n'
+                      b'Content-Type: text/plain\r\n'
+                      b'\r\n'
+                      b'plain\r\n'
+                      b'--inner\r\n'
+                      b'Content-Type: text/html\r\n'
+                      b'\r\n'
+                      b'<p>html</p>\r\n'
+                      b'--inner--\r\n'
+                      b'--outer\r\n'
+                      b'Content-Type: application/octet-stream\r\n'
+                      b'\r\n'
+                      b'line1\r\n'
+                      b'line2\r\n'
+                      b'\r\n'
+                      b'--outer--\r\n'
+                      b'epilogue\r\n')
+
+        with read_mime_stream(BytesIO(mime_email)) as (message, leaves):
+            self.assertEqual(message['Subject'], 'Nested')
+            alternative, attachment = message.get_payload()
+            plain, html = alternative.get_payload()
+            self.assertEqual(plain.get_content_type(), 'text/plain')
+            self.assertEqual(leaves[plain].content.read(), b'plain')
+            self.assertEqual(leaves[html].content.read(), b'<p>html</p>')
+            self.assertEqual(leaves[attachment].content.read(), b'line1\r\nline2\r\n')
+            self.assertEqual(len(leaves), 3)
+
+    def test_decodes_long_base64_lines(self):
+        content = urandom(10000)
+        mime_email = self._given_mime_email(b'Content-Transfer-Encoding: base64\n', b64encode(content))
+
+        with read_mime_stream(BytesIO(mime_email), max_line_bytes=100) as (_, leaves):
+            leaf, = leaves.values()
+            self.assertEqual(leaf.content.read(), content)
+            self.assertEqual(leaf.size, len(content))
+
+    def test_decodes_quoted_printable_soft_line_breaks(self):
+        mime_email = self._given_mime_email(b'Content-Transfer-Encoding: quoted-printable\n', b'caf=C3=\n=A9 ok')
+
+        with read_mime_stream(BytesIO(mime_email)) as (_, leaves):
+            leaf, = leaves.values()
+            self.assertEqual(leaf.content.read(), 'café ok'.encode('utf-8'))
+
+    def test_spools_large_parts_to_disk(self):
+        content = urandom(5000)
+        mime_email = self._given_mime_email(b'Content-Transfer-Encoding: base64\n', b64encode(content))
+
+        with read_mime_stream(BytesIO(mime_email), spool_bytes=1000) as (_, leaves):
+            leaf, = leaves.values()
+            self.assertTrue(leaf.content._rolled)
+            self.assertEqual(leaf.content.read(), content)
+
+        self.assertTrue(leaf.content.closed)
+
+    def test_reads_truncated_emails(self):
+        mime_email = (b'Content-Type: multipart/mixed; boundary="b"\n'
+                      b'\n'
+                      b'--b\n'
+                      b'\n'
+                      b'cut off\n')
+
+        with read_mime_stream(BytesIO(mime_email)) as (message, leaves):
+            part, = message.get_payload()
+            self.assertEqual(leaves[part].content.read(), b'cut off')
+
+    @classmethod
+    def _given_mime_email(cls, headers: bytes, body: bytes) -> bytes:
+        return (b'Content-Type: multipart/mixed; boundary="b"\n'
+                b'\n'
+                b'--b\n' + headers + b'\n' + body + b'\n'
+                b'--b--\n')